@@ -138,6 +138,38 @@ USE_TZ = True
 
 STATIC_URL = "static/"
 
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+#
+# Stored procedure results are cached in "procedures", which every process
+# shares so that collect_report_data can invalidate what the web workers
+# cached. Its table is created by migrate (or `manage.py createcachetable`).
+#
+# DatabaseCache trades speed for needing no extra service:
+#   - Every hit costs at least 2 SQL round trips: one get_many() for the data
+#     versions in the key, then one get() for the entry. A miss adds the
+#     procedure call and the set(), which runs a few statements of its own.
+#   - Culling is not LRU. Once MAX_ENTRIES is passed, a set() deletes the
+#     expired rows and then 1/CULL_FREQUENCY (default 1/3) of the rest in
+#     cache_key order, however recently they were read.
+# Where a Redis or Memcached server is available, point "procedures" at it
+# (django.core.cache.backends.redis.RedisCache, PyMemcacheCache) instead.
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "procedures": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "vfd_proc_cache",
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+}
+
+PROC_CACHE_ALIAS = "procedures"
+
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -0,0 +1,21 @@
+from typing import Iterator
+
+# Plain DB-API cursor helpers with no Django dependency, shared by
+# vfd_pro.common.db and the collector, which runs on its own mysql.connector
+# connections.
+
+# Rows per fetchmany() when a result is streamed rather than buffered.
+STREAM_BATCH_SIZE = 1000
+
+
+def iter_batches(cursor, batch_size: int = STREAM_BATCH_SIZE) -> Iterator[list]:
+    """Yields the executed cursor's rows in fetchmany() batches of batch_size.
+
+    With an unbuffered cursor only one batch is held at a time. The
+    connection cannot run other queries until the rows are exhausted.
+    """
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield rows
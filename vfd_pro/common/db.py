@@ -1,14 +1,173 @@
 from __future__ import annotations
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
 from django.db import connection
-from typing import Any, Iterable, Optional
+from functools import lru_cache
+from typing import Any, Iterable, Iterator, NamedTuple, Optional, Sequence
 from datetime import date, datetime
 from decimal import Decimal
-from uuid import UUID
+from uuid import UUID, uuid4
+import hashlib
+import json
 import logging
 
+from vfd_pro.common.cursors import STREAM_BATCH_SIZE, iter_batches
+from vfd_pro.common.db_metrics import multi_row_count, result_set_shapes, timed
+
 sp_logger = logging.getLogger("sp_logger")
 
+# Result shapes of fetch_all_rows() and callproc_all_dicts():
+#   dict     a dict per row (what fetch_all_dicts returns)
+#   tuple    TupleRows: the driver's row tuples with one shared column index
+#   record   a record_class() instance per row, attribute or item access
+#   columns  {column: [value, ...]}, one list per column
+ROW_SHAPES = ("dict", "tuple", "record", "columns")
+
+# Stored procedure results cached by cached_callproc_one_dict() and
+# cached_callproc_all_dicts() live in the PROC_CACHE_ALIAS cache for
+# PROC_CACHE_TIMEOUT seconds (0 disables caching). The cache must be shared
+# by every process: collect_report_data and the web workers invalidate each
+# other's entries through bump_data_version(). A LocMemCache alias is per
+# process, so with one the results are not cached at all. Size is bounded by
+# the backend's own culling (DatabaseCache past OPTIONS["MAX_ENTRIES"], Redis
+# and Memcached by their eviction policy).
+DEFAULT_PROC_CACHE_ALIAS = "default"
+DEFAULT_PROC_CACHE_TIMEOUT = 300
+
+
+class TupleRows(NamedTuple):
+    columns: list
+    index: dict
+    rows: list
+
+    def value(self, row: Sequence[Any], column: str) -> Any:
+        return row[self.index[column]]
+
+
+@lru_cache(maxsize=256)
+def record_class(columns: tuple) -> type:
+    """A __slots__ record class for one column signature, cached.
+
+    Columns that are valid identifiers are attributes; every column is also
+    reachable as record[column], which is the only access for names such as
+    "GM%_Month_TY". Names starting with an underscore are item access only,
+    so no column can shadow _asdict(). A repeated column name resolves to
+    its last value, as it does in a dict row.
+    """
+    slots = [f"_{i}" for i in range(len(columns))]
+    index = {}
+    for i in reversed(range(len(columns))):
+        column = columns[i]
+        if column in index:
+            continue
+        if column.isidentifier() and not column.startswith("_"):
+            slots[i] = column
+        index[column] = slots[i]
+    index = {column: index[column] for column in dict.fromkeys(columns)}
+    slots = tuple(slots)
+
+    def __init__(self, row):
+        for slot, value in zip(slots, row):
+            setattr(self, slot, value)
+
+    def __getitem__(self, column):
+        return getattr(self, index[column])
+
+    def _asdict(self):
+        return {column: getattr(self, slot) for column, slot in index.items()}
+
+    def __repr__(self):
+        return f"Record({self._asdict()!r})"
+
+    return type(
+        "Record",
+        (),
+        {
+            "__slots__": slots,
+            "_columns": columns,
+            "__init__": __init__,
+            "__getitem__": __getitem__,
+            "_asdict": _asdict,
+            "__repr__": __repr__,
+        },
+    )
+
+
+def shape_rows(cols: list, rows: Sequence[Sequence[Any]], shape: str = "dict") -> Any:
+    """Builds the ROW_SHAPES result of a fetched result set."""
+    if shape == "dict":
+        return [dict(zip(cols, r)) for r in rows]
+    if shape == "tuple":
+        return TupleRows(cols, {c: i for i, c in enumerate(cols)}, list(rows))
+    if shape == "record":
+        record = record_class(tuple(cols))
+        return [record(r) for r in rows]
+    if shape == "columns":
+        if not rows:
+            return {c: [] for c in cols}
+        return {c: list(values) for c, values in zip(cols, zip(*rows))}
+    raise ValueError(f"Unknown row shape: {shape}")
+
+
+# DATABASES OPTIONS of the mysqlclient backend and their mysql.connector
+# names; "ssl" is a dict mapped key by key through CONNECTOR_SSL_OPTIONS.
+CONNECTOR_OPTIONS = {
+    "charset": "charset",
+    "init_command": "init_command",
+    "sql_mode": "sql_mode",
+    "unix_socket": "unix_socket",
+    "connect_timeout": "connection_timeout",
+    "autocommit": "autocommit",
+    "read_default_file": "option_files",
+}
+CONNECTOR_SSL_OPTIONS = {
+    "ca": "ssl_ca",
+    "cert": "ssl_cert",
+    "key": "ssl_key",
+    "cipher": "ssl_cipher",
+}
+
+
+def get_connector_config(alias: str = "default") -> dict:
+    """mysql.connector config for a Django database, as the collector takes it.
+
+    OPTIONS are carried over by their mysql.connector names; any without
+    one (isolation_level, say) are logged and left out.
+    """
+    database = settings.DATABASES[alias]
+    config = {
+        "host": database.get("HOST") or "localhost",
+        "user": database.get("USER"),
+        "password": database.get("PASSWORD"),
+        "database": database.get("NAME"),
+    }
+    if database.get("PORT"):
+        config["port"] = int(database["PORT"])
+    for name, value in (database.get("OPTIONS") or {}).items():
+        if name == "ssl" and isinstance(value, dict):
+            for ssl_name, ssl_value in value.items():
+                if ssl_name in CONNECTOR_SSL_OPTIONS:
+                    config[CONNECTOR_SSL_OPTIONS[ssl_name]] = ssl_value
+                else:
+                    sp_logger.warning(
+                        "DATABASES[%r] OPTIONS ssl %r has no mysql.connector "
+                        "equivalent; ignored",
+                        alias,
+                        ssl_name,
+                    )
+        elif name in CONNECTOR_OPTIONS:
+            config[CONNECTOR_OPTIONS[name]] = value
+        else:
+            sp_logger.warning(
+                "DATABASES[%r] OPTIONS %r has no mysql.connector equivalent; ignored",
+                alias,
+                name,
+            )
+    return config
+
 
+@timed("sql")
 def fetch_one_dict(sql: str, params: Optional[Iterable[Any]] = None) -> Optional[dict]:
     """Executes a SELECT and returns one row as dict (or None)."""
     with connection.cursor() as cursor:
@@ -20,6 +179,7 @@ def fetch_one_dict(sql: str, params: Optional[Iterable[Any]] = None) -> Optional
         return dict(zip(cols, row))
 
 
+@timed("sql")
 def fetch_all_dicts(sql: str, params: Optional[Iterable[Any]] = None) -> list[dict]:
     """Executes a SELECT and returns all rows as list[dict]."""
     with connection.cursor() as cursor:
@@ -31,6 +191,48 @@ def fetch_all_dicts(sql: str, params: Optional[Iterable[Any]] = None) -> list[di
         return [dict(zip(cols, r)) for r in rows]
 
 
+def iter_dicts(
+    sql: str,
+    params: Optional[Iterable[Any]] = None,
+    batch_size: int = STREAM_BATCH_SIZE,
+) -> Iterator[dict]:
+    """Executes a SELECT and yields its rows as dicts, batch_size at a time.
+
+    On MySQL the rows are read through an unbuffered server side cursor
+    (SSCursor), so memory stays flat however large the result is. The
+    connection cannot run other queries until the generator is exhausted or
+    closed.
+    """
+    if connection.vendor == "mysql":
+        from MySQLdb.cursors import SSCursor
+
+        connection.ensure_connection()
+        cursor = connection.connection.cursor(SSCursor)
+    else:
+        cursor = connection.cursor()
+    try:
+        cursor.execute(sql, params or [])
+        cols = [c[0] for c in cursor.description]
+        for rows in iter_batches(cursor, batch_size):
+            for r in rows:
+                yield dict(zip(cols, r))
+    finally:
+        cursor.close()
+
+
+@timed("sql")
+def fetch_all_rows(
+    sql: str, params: Optional[Iterable[Any]] = None, shape: str = "dict"
+) -> Any:
+    """Executes a SELECT and returns all rows in one of ROW_SHAPES."""
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params or [])
+        rows = cursor.fetchall()
+        cols = [c[0] for c in cursor.description]
+        return shape_rows(cols, rows, shape)
+
+
+@timed("sql")
 def fetch_scalar(
     sql: str, params: Optional[Iterable[Any]] = None, default: Any = None
 ) -> Any:
@@ -41,6 +243,7 @@ def fetch_scalar(
         return row[0] if row else default
 
 
+@timed("procedure")
 def callproc_one_dict(proc_name: str, params: list[Any]) -> Optional[dict]:
     """Calls a stored procedure and maps first row result to dict (or None)."""
     with connection.cursor() as cursor:
@@ -52,8 +255,10 @@ def callproc_one_dict(proc_name: str, params: list[Any]) -> Optional[dict]:
         return dict(zip(cols, row))
 
 
-def callproc_all_dicts(proc_name: str, params: list):
-
+@timed("procedure")
+def callproc_all_dicts(proc_name: str, params: list, shape: str = "dict") -> Any:
+    """Calls a stored procedure and returns its first result set in one of
+    ROW_SHAPES, values made JSON safe."""
     with connection.cursor() as cursor:
         cursor.callproc(proc_name, params)
 
@@ -61,21 +266,255 @@ def callproc_all_dicts(proc_name: str, params: list):
             if cursor.description:
                 cols = [c[0] for c in cursor.description]
                 rows = cursor.fetchall()
-                if not rows:
-                    return []
+                if rows:
+                    rows = _json_safe_rows(cursor.description, rows)
+                return shape_rows(cols, rows, shape)
+
+            if not cursor.nextset():
+                break
+
+    return shape_rows([], [], shape)
 
-                out = []
-                for r in rows:
-                    d = dict(zip(cols, r))
-                    d = {k: _json_safe_value(v) for k, v in d.items()}
-                    out.append(d)
 
-                return out
+# MySQL field type codes (MySQLdb.constants.FIELD_TYPE) of cursor.description.
+_DECIMAL_TYPE_CODES = {0, 246}  # DECIMAL, NEWDECIMAL
+_DATE_TYPE_CODES = {7, 10, 12, 14}  # TIMESTAMP, DATE, DATETIME, NEWDATE
+# TINY, SHORT, LONG, FLOAT, DOUBLE, NULL, LONGLONG, INT24, TIME, YEAR
+_IDENTITY_TYPE_CODES = {1, 2, 3, 4, 5, 6, 8, 9, 11, 13}
+# VARCHAR, BIT, JSON, ENUM, SET, the BLOB types, VAR_STRING, STRING: text
+# comes back as str, binary collations as bytes.
+_STRING_TYPE_CODES = {15, 16, 245, 247, 248, 249, 250, 251, 252, 253, 254}
+
+
+@timed("procedure", count=multi_row_count)
+def callproc_multi(
+    proc_name: str,
+    params: list,
+    names: Optional[Sequence[str]] = None,
+    shape: Any = "dict",
+    json_safe: bool = True,
+) -> dict:
+    """Calls a stored procedure and returns every result set it produces.
+
+    The result is {name: rows} in result set order, where names[i] names the
+    i-th result set and any further ones are "result_<i>". Each result set is
+    shaped as one of ROW_SHAPES: shape for all of them, or shape[i] for the
+    i-th (the last shape repeats). json_safe applies the column conversion
+    plan as callproc_all_dicts() does. Empty result sets are kept.
+    """
+    names = list(names or [])
+    sets = []
+    with connection.cursor() as cursor:
+        cursor.callproc(proc_name, params)
+
+        while True:
+            if cursor.description:
+                cols = [c[0] for c in cursor.description]
+                rows = cursor.fetchall()
+                if json_safe:
+                    rows = _json_safe_rows(cursor.description, rows)
+                sets.append((cols, rows))
 
             if not cursor.nextset():
                 break
 
-    return []
+    shapes = result_set_shapes(shape, len(sets))
+    return {
+        names[i] if i < len(names) else f"result_{i}": shape_rows(cols, rows, shapes[i])
+        for i, (cols, rows) in enumerate(sets)
+    }
+
+
+def _proc_cache():
+    return caches[getattr(settings, "PROC_CACHE_ALIAS", DEFAULT_PROC_CACHE_ALIAS)]
+
+
+@lru_cache(maxsize=None)
+def _warn_process_local_cache(alias: str) -> None:
+    sp_logger.warning(
+        "PROC_CACHE_ALIAS %r is a per process LocMemCache; stored procedure "
+        "results are not cached. Point it at a shared cache (DatabaseCache, "
+        "Redis or Memcached).",
+        alias,
+    )
+
+
+# Client 0 holds the default report config, which every client without its
+# own config uses, so bumping it invalidates every cached result.
+DEFAULT_CONFIG_CLIENT_ID = 0
+# Part of every data version, bumped with DEFAULT_CONFIG_CLIENT_ID.
+GLOBAL_DATA_VERSION_KEY = "vfd:data_version:global"
+
+
+def _data_version_key(client_id: Optional[int]) -> str:
+    return f"vfd:data_version:{'all' if client_id is None else int(client_id)}"
+
+
+def get_data_version(client_id: Optional[int] = None) -> str:
+    """The current data version of a client, or of all clients for None,
+    joined with the global version that every cache key includes.
+
+    Both are read in one get_many(). A version missing from the cache (never
+    set, or evicted) is replaced by a new one, so entries cached under an
+    evicted version are never served.
+    """
+    cache = _proc_cache()
+    keys = [GLOBAL_DATA_VERSION_KEY, _data_version_key(client_id)]
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        for key in missing:
+            cache.add(key, uuid4().hex, None)
+        versions.update(cache.get_many(missing))
+    return ".".join(versions.get(key) or uuid4().hex for key in keys)
+
+
+def bump_data_version(client_ids: Iterable[int]) -> None:
+    """Invalidates the cached procedure results of these clients, and every
+    company wide result, after their data or report config changed. The
+    default config's client (DEFAULT_CONFIG_CLIENT_ID) invalidates every
+    result of every client."""
+    client_ids = [int(client_id) for client_id in client_ids]
+    version = uuid4().hex
+    keys = [_data_version_key(client_id) for client_id in client_ids]
+    if keys:
+        keys.append(_data_version_key(None))
+        if DEFAULT_CONFIG_CLIENT_ID in client_ids:
+            keys.append(GLOBAL_DATA_VERSION_KEY)
+        _proc_cache().set_many(dict.fromkeys(keys, version), None)
+
+
+def _normalize_param(v):
+    # Equal parameters share an entry: 1, 1.0, True and Decimal("1.00").
+    if isinstance(v, bool):
+        return int(v)
+    if isinstance(v, float) and v.is_integer():
+        return int(v)
+    if isinstance(v, Decimal) and v.is_finite():
+        return int(v) if v == v.to_integral_value() else float(v)
+    if isinstance(v, (datetime, date)):
+        return v.isoformat()
+    return v
+
+
+def _proc_cache_key(
+    proc_name: str, params: list, client_id: Optional[int], shape: Optional[str] = None
+) -> str:
+    normalized = json.dumps(
+        [proc_name, [_normalize_param(v) for v in params or []]]
+        + ([] if shape is None else [shape]),
+        default=str,
+        separators=(",", ":"),
+    )
+    digest = hashlib.sha1(normalized.encode()).hexdigest()
+    scope = "all" if client_id is None else int(client_id)
+    return f"vfd:proc:{scope}:{get_data_version(client_id)}:{digest}"
+
+
+def _cached_callproc(
+    helper, proc_name: str, params: list, client_id, timeout, shape=None
+):
+    # shape, when given, is passed on to the helper and is part of the key.
+    args = (proc_name, params) if shape is None else (proc_name, params, shape)
+    if timeout is None:
+        timeout = getattr(settings, "PROC_CACHE_TIMEOUT", DEFAULT_PROC_CACHE_TIMEOUT)
+    if not timeout:
+        return helper(*args)
+    cache = _proc_cache()
+    if isinstance(cache, LocMemCache):
+        # Another process's bump_data_version() could not reach this copy.
+        _warn_process_local_cache(
+            getattr(settings, "PROC_CACHE_ALIAS", DEFAULT_PROC_CACHE_ALIAS)
+        )
+        return helper(*args)
+    key = _proc_cache_key(proc_name, params, client_id, shape)
+    # Stored as a 1-tuple so a cached None is told apart from a miss.
+    hit = cache.get(key)
+    if hit is not None:
+        return hit[0]
+    result = helper(*args)
+    cache.set(key, (result,), timeout)
+    return result
+
+
+def cached_callproc_one_dict(
+    proc_name: str,
+    params: list[Any],
+    client_id: Optional[int] = None,
+    timeout: Optional[int] = None,
+) -> Optional[dict]:
+    """callproc_one_dict() through the procedure result cache.
+
+    client_id is the client whose data the procedure reads (None for a
+    company wide call); its entry is dropped by bump_data_version().
+    """
+    return _cached_callproc(callproc_one_dict, proc_name, params, client_id, timeout)
+
+
+def cached_callproc_all_dicts(
+    proc_name: str,
+    params: list,
+    client_id: Optional[int] = None,
+    timeout: Optional[int] = None,
+    shape: str = "dict",
+) -> Any:
+    """callproc_all_dicts() through the procedure result cache, as
+    cached_callproc_one_dict().
+
+    The cache holds the "tuple" shape, which every shape is built from, so
+    one entry serves them all and no record class has to be pickled.
+    """
+    result = _cached_callproc(
+        callproc_all_dicts, proc_name, params, client_id, timeout, "tuple"
+    )
+    if shape == "tuple":
+        return result
+    return shape_rows(result.columns, result.rows, shape)
+
+
+def _bytes_to_hex(v):
+    if isinstance(v, (bytes, bytearray, memoryview)):
+        return bytes(v).hex()
+    return v
+
+
+def _date_isoformat(v):
+    return v.isoformat() if isinstance(v, (datetime, date)) else v
+
+
+def _json_conversion_plan(description) -> list:
+    """One converter per result column, None where values pass unchanged.
+
+    Built from the description's type codes once per result set; columns
+    of an unknown type (or another backend) fall back to _json_safe_value().
+    """
+    plan = []
+    for column in description:
+        type_code = column[1]
+        if type_code in _IDENTITY_TYPE_CODES:
+            plan.append(None)
+        elif type_code in _DECIMAL_TYPE_CODES:
+            plan.append(float)
+        elif type_code in _DATE_TYPE_CODES:
+            plan.append(_date_isoformat)
+        elif type_code in _STRING_TYPE_CODES:
+            plan.append(_bytes_to_hex)
+        else:
+            plan.append(_json_safe_value)
+    return plan
+
+
+def _json_safe_rows(description, rows: Sequence[Sequence[Any]]) -> list:
+    """Rows with _json_safe_value() applied, column by column: only the
+    columns the conversion plan converts are touched."""
+    plan = _json_conversion_plan(description)
+    if not rows or not any(plan):
+        return list(rows)
+    columns = list(zip(*rows))
+    for i, convert in enumerate(plan):
+        if convert is not None:
+            columns[i] = [None if v is None else convert(v) for v in columns[i]]
+    return list(zip(*columns))
 
 
 def _json_safe_value(v):
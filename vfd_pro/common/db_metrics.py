@@ -0,0 +1,210 @@
+from __future__ import annotations
+from collections import deque
+from functools import lru_cache, wraps
+from typing import Any, Callable, Optional
+import inspect
+import logging
+import re
+import threading
+import time
+
+from django.conf import settings
+
+sp_logger = logging.getLogger("sp_logger")
+
+# Latency histogram bucket bounds, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Calls at or over DB_SLOW_CALL_SECONDS are logged and kept in the last
+# DB_SLOW_CALL_LOG_SIZE slow calls.
+DEFAULT_SLOW_CALL_SECONDS = 0.5
+DEFAULT_SLOW_CALL_LOG_SIZE = 200
+
+_lock = threading.Lock()
+# {(kind, name): {"buckets": [count per bound], "count", "sum", "rows", "errors"}}
+_calls: dict = {}
+_slow_calls: deque = deque(
+    maxlen=getattr(settings, "DB_SLOW_CALL_LOG_SIZE", DEFAULT_SLOW_CALL_LOG_SIZE)
+)
+
+_STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_VALUE_LIST = re.compile(r"\(\s*(?:\?|%s)(?:\s*,\s*(?:\?|%s))*\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=1024)
+def sql_fingerprint(sql: str) -> str:
+    """The statement with literals and value lists replaced by ?, so every
+    call of one query shape shares a key."""
+    sql = _STRING_LITERAL.sub("?", sql)
+    sql = _NUMBER_LITERAL.sub("?", sql)
+    sql = _VALUE_LIST.sub("(?)", sql)
+    return _WHITESPACE.sub(" ", sql).strip()
+
+
+def row_count(result: Any, shape: str = "dict") -> int:
+    """Rows in a db helper result: a row list, a single row or scalar, a
+    TupleRows, or a "columns" shaped dict of lists."""
+    if result is None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    if hasattr(result, "rows"):
+        return len(result.rows)
+    if shape == "columns" and isinstance(result, dict):
+        return len(next(iter(result.values()), []))
+    return 1
+
+
+def multi_row_count(result: dict, shape: Any = "dict") -> int:
+    """Rows over every result set of a callproc_multi() result."""
+    shapes = result_set_shapes(shape, len(result))
+    return sum(row_count(rows, s) for rows, s in zip(result.values(), shapes))
+
+
+def result_set_shapes(shape: Any, count: int) -> list:
+    """The shape of each of count result sets: shape itself, or one per
+    result set from a sequence, the last one repeated."""
+    if isinstance(shape, str):
+        return [shape] * count
+    shapes = list(shape) or ["dict"]
+    return shapes[:count] + shapes[-1:] * (count - len(shapes))
+
+
+def record_call(
+    kind: str, name: str, seconds: float, rows: int = 0, error: Optional[str] = None
+) -> None:
+    """Adds one call to the per kind and name latency histogram."""
+    key = (kind, name)
+    with _lock:
+        call = _calls.get(key)
+        if call is None:
+            call = {
+                "buckets": [0] * len(LATENCY_BUCKETS),
+                "count": 0,
+                "sum": 0.0,
+                "rows": 0,
+                "errors": 0,
+            }
+            _calls[key] = call
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                call["buckets"][i] += 1
+        call["count"] += 1
+        call["sum"] += seconds
+        call["rows"] += rows
+        if error is not None:
+            call["errors"] += 1
+
+    slow_seconds = getattr(settings, "DB_SLOW_CALL_SECONDS", DEFAULT_SLOW_CALL_SECONDS)
+    if seconds >= slow_seconds:
+        entry = {
+            "at": time.time(),
+            "kind": kind,
+            "name": name,
+            "seconds": round(seconds, 6),
+            "rows": rows,
+            "error": error,
+        }
+        with _lock:
+            _slow_calls.append(entry)
+        sp_logger.warning("Slow %s call %.3fs (%s rows): %s", kind, seconds, rows, name)
+
+
+def timed(kind: str, count: Callable = row_count) -> Callable:
+    """Decorator recording a db helper's latency, rows and errors.
+
+    The helper's first argument names the call: the procedure name for
+    kind "procedure", the SQL (fingerprinted) for kind "sql". count(result,
+    shape) gives the rows of a result, shape being the helper's shape
+    argument however it was passed.
+    """
+
+    def decorator(func):
+        # shape may be passed by position or keyword; find its slot once.
+        parameters = list(inspect.signature(func).parameters.values())
+        shape_index, shape_default = None, "dict"
+        for i, parameter in enumerate(parameters):
+            if parameter.name == "shape":
+                shape_index, shape_default = i, parameter.default
+                break
+
+        def call_shape(args, kwargs):
+            if "shape" in kwargs:
+                return kwargs["shape"]
+            # args excludes the name, the helper's first parameter.
+            if shape_index is not None and len(args) >= shape_index:
+                return args[shape_index - 1]
+            return shape_default
+
+        @wraps(func)
+        def wrapper(name, *args, **kwargs):
+            key = sql_fingerprint(name) if kind == "sql" else name
+            started = time.perf_counter()
+            try:
+                result = func(name, *args, **kwargs)
+            except Exception as exc:
+                record_call(
+                    kind, key, time.perf_counter() - started, error=type(exc).__name__
+                )
+                raise
+            seconds = time.perf_counter() - started
+            record_call(kind, key, seconds, count(result, call_shape(args, kwargs)))
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def get_call_metrics() -> dict:
+    """A copy of the histograms, {(kind, name): call}."""
+    with _lock:
+        return {
+            key: dict(call, buckets=list(call["buckets"]))
+            for key, call in _calls.items()
+        }
+
+
+def get_slow_calls() -> list:
+    """The rolling slow call log, newest first."""
+    with _lock:
+        return list(reversed(_slow_calls))
+
+
+def reset_call_metrics() -> None:
+    with _lock:
+        _calls.clear()
+        _slow_calls.clear()
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def render_prometheus() -> str:
+    """The histograms in the Prometheus text exposition format. Values are
+    per process; each worker exposes its own."""
+    lines = [
+        "# HELP vfd_db_call_seconds Latency of db helper calls.",
+        "# TYPE vfd_db_call_seconds histogram",
+    ]
+    calls = get_call_metrics()
+    for (kind, name), call in sorted(calls.items()):
+        labels = f'kind="{kind}",name="{_label(name)}"'
+        for bound, count in zip(LATENCY_BUCKETS, call["buckets"]):
+            lines.append(f'vfd_db_call_seconds_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(
+            f'vfd_db_call_seconds_bucket{{{labels},le="+Inf"}} {call["count"]}'
+        )
+        lines.append(f"vfd_db_call_seconds_sum{{{labels}}} {call['sum']:.6f}")
+        lines.append(f"vfd_db_call_seconds_count{{{labels}}} {call['count']}")
+    for metric, key, help_text in (
+        ("vfd_db_call_rows_total", "rows", "Rows returned by db helper calls."),
+        ("vfd_db_call_errors_total", "errors", "Failed db helper calls."),
+    ):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} counter")
+        for (kind, name), call in sorted(calls.items()):
+            lines.append(f'{metric}{{kind="{kind}",name="{_label(name)}"}} {call[key]}')
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,262 @@
+import json
+import logging
+
+import mysql.connector
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from vfd_pro.common.db import get_connector_config
+from vfd_pro.reports.caam import selectors
+from vfd_pro.vfd_collect_report_data import (
+    ENGINES,
+    close_prepared_statements,
+    get_metrics_for_clients,
+)
+from vfd_pro.vfd_collect_report_profile import new_query_profile
+
+sp_logger = logging.getLogger("sp_logger")
+
+# Relative growth of a statement's query_cost reported as a regression.
+COST_REGRESSION_RATIO = 1.5
+
+
+def get_selector_calls(client_id, company_id):
+    """The SQL based CAAM selectors, as (label, callable) pairs."""
+    calls = [
+        (
+            "selectors:_get_caam_report_config",
+            lambda: selectors._get_caam_report_config(client_id),
+        ),
+        ("selectors:_get_sales_trend", lambda: selectors._get_sales_trend(client_id)),
+        (
+            "selectors:_get_client_report_metrics",
+            lambda: selectors._get_client_report_metrics(client_id),
+        ),
+    ]
+    if company_id is not None:
+        calls += [
+            (
+                "selectors:_get_caam_report_details",
+                lambda: selectors._get_caam_report_details(company_id, client_id),
+            ),
+            (
+                "selectors:_get_caam_report_config_by_company",
+                lambda: selectors._get_caam_report_config_by_company(company_id),
+            ),
+        ]
+    return calls
+
+
+def get_collector_plans(client_id, engines):
+    """{label: EXPLAIN FORMAT=JSON document} for the collector's statements."""
+    plans = {}
+    config = get_connector_config()
+    collector_connection = mysql.connector.connect(**config)
+    try:
+        for engine in engines:
+            profile = new_query_profile(
+                explain=True, rows_examined=False, explain_format="JSON"
+            )
+            get_metrics_for_clients(
+                config,
+                client_ids=[client_id],
+                engine=engine,
+                refresh_aggregates=False,
+                connection=collector_connection,
+                profile=profile,
+            )
+            for query in profile["queries"]:
+                add_plan(plans, f"{engine}:{query['label']}", query["plan"])
+    finally:
+        close_prepared_statements(collector_connection)
+        collector_connection.close()
+    return plans
+
+
+def get_selector_plans(client_id, company_id):
+    """{label: EXPLAIN FORMAT=JSON document} for the selectors' statements.
+
+    Each selector is run once while its statements are captured, then every
+    statement is explained on the same connection. Stored procedure calls do
+    not pass through execute() and cannot be explained, so they are left out.
+    The procedure result cache is bypassed: a hit would run the cache
+    backend's own statements (DatabaseCache's SELECT on its table) in place
+    of the selector's.
+    """
+    statements = []
+
+    def capture(execute, sql, params, many, context):
+        statements.append((sql, params))
+        return execute(sql, params, many, context)
+
+    plans = {}
+    for label, call in get_selector_calls(client_id, company_id):
+        del statements[:]
+        with override_settings(PROC_CACHE_TIMEOUT=0):
+            with connection.execute_wrapper(capture):
+                call()
+        for sql, params in statements:
+            with connection.cursor() as cursor:
+                cursor.execute(f"EXPLAIN FORMAT=JSON {sql}", params)
+                add_plan(plans, label, cursor.fetchall())
+    return plans
+
+
+def add_plan(plans, label, rows):
+    # Repeated labels (a chunked or retried statement) are numbered.
+    key = label
+    number = 1
+    while key in plans:
+        number += 1
+        key = f"{label}#{number}"
+    plans[key] = parse_explain_rows(rows)
+
+
+def parse_explain_rows(rows):
+    if not rows:
+        return {}
+    row = rows[0]
+    value = next(iter(row.values())) if isinstance(row, dict) else row[0]
+    if isinstance(value, (bytes, bytearray)):
+        value = value.decode()
+    return json.loads(value)
+
+
+def iter_plan_nodes(node):
+    if isinstance(node, dict):
+        yield node
+        for value in node.values():
+            yield from iter_plan_nodes(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from iter_plan_nodes(value)
+
+
+def summarize_plan(plan):
+    """Table accesses, query cost and findings of one JSON plan."""
+    tables = {}
+    findings = set()
+    for node in iter_plan_nodes(plan):
+        if node.get("using_filesort"):
+            findings.add("filesort")
+        if node.get("using_temporary_table"):
+            findings.add("temporary table")
+        if "table_name" not in node or "access_type" not in node:
+            continue
+        table = node["table_name"]
+        access_type = node["access_type"]
+        tables[table] = {
+            "access_type": access_type,
+            "key": node.get("key"),
+            "rows": node.get("rows_examined_per_scan"),
+        }
+        if access_type == "ALL":
+            findings.add(f"full scan: {table}")
+        elif access_type == "index":
+            findings.add(f"full index scan: {table}")
+        if node.get("key") is None and node.get("possible_keys"):
+            findings.add(f"index not used: {table}")
+    cost = plan.get("query_block", {}).get("cost_info", {}).get("query_cost")
+    return {
+        "cost": float(cost) if cost is not None else None,
+        "tables": tables,
+        "findings": sorted(findings),
+    }
+
+
+def diff_summaries(previous, current):
+    """Regressions of current against previous, as {label: [message]}."""
+    regressions = {}
+    for label, summary in current.items():
+        before = previous.get(label)
+        if before is None:
+            continue
+        messages = [
+            f"new: {finding}"
+            for finding in summary["findings"]
+            if finding not in before["findings"]
+        ]
+        for table, access in summary["tables"].items():
+            before_access = before["tables"].get(table)
+            if before_access is not None and before_access["key"] != access["key"]:
+                messages.append(
+                    f"{table} key {before_access['key']} -> {access['key']}"
+                )
+        if (
+            before["cost"]
+            and summary["cost"] is not None
+            and summary["cost"] > before["cost"] * COST_REGRESSION_RATIO
+        ):
+            messages.append(f"cost {before['cost']:.1f} -> {summary['cost']:.1f}")
+        if messages:
+            regressions[label] = messages
+    return regressions
+
+
+class Command(BaseCommand):
+    help = (
+        "EXPLAIN FORMAT=JSON the collector's and the CAAM selectors' statements "
+        "for one client and report full scans, filesorts, temporary tables and "
+        "unused indexes. --save keeps the plans, --compare diffs against a "
+        "saved run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("client", type=int)
+        parser.add_argument("--company", type=int, help="Also audit company lookups.")
+        parser.add_argument(
+            "--engine",
+            choices=ENGINES,
+            action="append",
+            dest="engines",
+            help="Collector engine to audit; repeat for several (default all).",
+        )
+        parser.add_argument("--no-collector", action="store_true")
+        parser.add_argument("--no-selectors", action="store_true")
+        parser.add_argument("--all", action="store_true", help="List clean plans too.")
+        parser.add_argument("--save", help="Write the plan summaries to this file.")
+        parser.add_argument("--compare", help="Diff against a file written by --save.")
+
+    def handle(self, *args, **options):
+        plans = {}
+        if not options["no_collector"]:
+            plans.update(
+                get_collector_plans(options["client"], options["engines"] or ENGINES)
+            )
+        if not options["no_selectors"]:
+            plans.update(get_selector_plans(options["client"], options["company"]))
+        summaries = {label: summarize_plan(plan) for label, plan in plans.items()}
+
+        flagged = 0
+        for label, summary in summaries.items():
+            if summary["findings"]:
+                flagged += 1
+            elif not options["all"]:
+                continue
+            cost = "-" if summary["cost"] is None else f"{summary['cost']:.1f}"
+            self.stdout.write(
+                f"{label} (cost {cost}): {', '.join(summary['findings']) or 'ok'}"
+            )
+        self.stdout.write(f"{len(summaries)} statements, {flagged} flagged")
+
+        if options["save"]:
+            with open(options["save"], "w") as f:
+                json.dump(
+                    {"client": options["client"], "plans": summaries},
+                    f,
+                    indent=2,
+                    sort_keys=True,
+                )
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                previous = json.load(f)["plans"]
+            regressions = diff_summaries(previous, summaries)
+            missing = sorted(set(previous) - set(summaries))
+            for label, messages in regressions.items():
+                self.stdout.write(f"REGRESSION {label}: {'; '.join(messages)}")
+            if missing:
+                self.stdout.write(f"{len(missing)} statements no longer issued")
+            if regressions:
+                sp_logger.warning("Query plan regressions: %s", json.dumps(regressions))
+                raise CommandError(f"{len(regressions)} query plans regressed")
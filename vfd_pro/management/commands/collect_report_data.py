@@ -0,0 +1,241 @@
+import logging
+import time
+from datetime import date, datetime
+
+import mysql.connector
+from django.core.management.base import BaseCommand, CommandError
+
+from vfd_pro.common.db import bump_data_version, get_connector_config
+from vfd_pro.vfd_collect_report_data import (
+    BATCH_CHUNK_SIZE,
+    ENGINE_PREFIX_SUM,
+    ENGINE_SINGLE_PASS,
+    ENGINES,
+    get_all_client_ids,
+    get_clients_changed_since,
+    collect_report_data,
+    get_company_client_ids,
+    save_report_metrics,
+)
+from vfd_pro.vfd_collect_report_profile import (
+    log_query_profile,
+    new_query_counter,
+    new_query_profile,
+)
+from vfd_pro.vfd_collect_report_runner import (
+    DEFAULT_CLIENT_TIMEOUT,
+    DEFAULT_WORKERS,
+    run_collector,
+)
+
+sp_logger = logging.getLogger("sp_logger")
+
+
+def parse_since(value):
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f"--since must be an ISO date or datetime, got {value!r}")
+
+
+def parse_as_of(value):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f"--as-of must be an ISO date, got {value!r}")
+
+
+def collect_batch(config, client_ids, options, collection_marks):
+    """collect_report_data() over chunks of clients in this process, with a
+    summary shaped like run_collector()'s. A failing chunk aborts the run."""
+    if options["profile"]:
+        profile = new_query_profile(explain=True)
+    else:
+        profile = new_query_counter()
+    client_metric_values = collect_report_data(
+        config,
+        client_ids=client_ids,
+        engine=options["engine"],
+        vectorized=options["vectorized"],
+        chunk_size=options["chunk_size"],
+        incremental=options["incremental"],
+        profile=profile,
+        use_month_buckets=options["month_buckets"],
+        as_of=options["as_of"],
+        collection_marks=collection_marks,
+    )
+    collected = len(client_metric_values)
+    summary = {
+        "clients": collected,
+        "succeeded": collected,
+        "failed": 0,
+        "skipped": len(client_ids) - collected,
+        "workers": 1,
+        "queries": profile["query_count"],
+        "errors": {},
+    }
+    if options["profile"]:
+        summary["query_profile"] = log_query_profile(profile)
+    return client_metric_values, summary
+
+
+class Command(BaseCommand):
+    help = (
+        "Collect report metrics for clients and save them to "
+        "vfd_client_report_metric. Selects every client unless --company or "
+        "--client is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--company", type=int, help="Only this company's clients.")
+        parser.add_argument(
+            "--client",
+            type=int,
+            action="append",
+            dest="clients",
+            help="Only this client; repeat for several.",
+        )
+        parser.add_argument(
+            "--since",
+            type=parse_since,
+            help="Only clients with transactions synced or modified since this date.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=DEFAULT_WORKERS,
+            help=(
+                "Worker processes, each collecting one client at a time. A "
+                f"client gets {DEFAULT_CLIENT_TIMEOUT}s: the worker interrupts "
+                "its Python code, and MySQL aborts a SELECT still running then "
+                "(MAX_EXECUTION_TIME); other statements run to completion."
+            ),
+        )
+        parser.add_argument(
+            "--batch",
+            action="store_true",
+            help=(
+                "Collect chunks of clients with grouped queries in this process "
+                "instead of one client per worker task; --workers is ignored."
+            ),
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=BATCH_CHUNK_SIZE,
+            help="Clients per chunk with --batch.",
+        )
+        parser.add_argument("--engine", choices=ENGINES, default=ENGINE_SINGLE_PASS)
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Skip clients unchanged since their last collection.",
+        )
+        parser.add_argument("--vectorized", action="store_true")
+        parser.add_argument(
+            "--month-buckets",
+            action="store_true",
+            help="Resolve offsets from transaction month buckets at query time.",
+        )
+        parser.add_argument(
+            "--as-of",
+            type=parse_as_of,
+            help="Report every client as of this month (implies --month-buckets).",
+        )
+        parser.add_argument(
+            "--profile",
+            action="store_true",
+            help=(
+                "Log every query with its time, rows examined and EXPLAIN plan; "
+                "results are then buffered instead of streamed, which slows "
+                "the run. Statements are counted either way."
+            ),
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="List the selected clients without collecting them.",
+        )
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1")
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be at least 1")
+        if options["as_of"] is not None and (
+            options["incremental"] or options["engine"] == ENGINE_PREFIX_SUM
+        ):
+            raise CommandError(
+                "--as-of cannot be used with --incremental or prefix_sum"
+            )
+        config = get_connector_config()
+
+        connection = mysql.connector.connect(**config)
+        try:
+            cursor = connection.cursor(dictionary=True)
+            if options["clients"]:
+                client_ids = sorted(set(options["clients"]))
+            elif options["company"] is not None:
+                client_ids = get_company_client_ids(cursor, options["company"])
+            else:
+                client_ids = get_all_client_ids(cursor)
+            if options["since"] is not None:
+                client_ids = get_clients_changed_since(
+                    cursor, client_ids, options["since"]
+                )
+            cursor.close()
+        finally:
+            connection.close()
+
+        if options["dry_run"]:
+            for client_id in client_ids:
+                self.stdout.write(str(client_id))
+            self.stdout.write(f"{len(client_ids)} clients selected (dry run)")
+            return
+
+        started = time.monotonic()
+        # Watermarks of an incremental run, saved with the metrics.
+        collection_marks = {}
+        if options["batch"]:
+            client_metric_values, summary = collect_batch(
+                config, client_ids, options, collection_marks
+            )
+        else:
+            client_metric_values, summary = run_collector(
+                config,
+                client_ids,
+                workers=options["workers"],
+                engine=options["engine"],
+                incremental=options["incremental"],
+                vectorized=options["vectorized"],
+                profile_queries=options["profile"],
+                explain_queries=True,
+                examine_rows=True,
+                use_month_buckets=options["month_buckets"],
+                as_of=options["as_of"],
+                collection_marks=collection_marks,
+            )
+        connection = mysql.connector.connect(**config)
+        try:
+            rows = save_report_metrics(
+                connection, client_metric_values, collection_marks=collection_marks
+            )
+        finally:
+            connection.close()
+        bump_data_version(client_metric_values)
+        wall_seconds = time.monotonic() - started
+
+        self.stdout.write(
+            f"{summary['succeeded']} clients collected, {summary['skipped']} skipped, "
+            f"{summary['failed']} failed, {rows} metric rows saved in {wall_seconds:.1f}s"
+        )
+        queries = summary["queries"]
+        self.stdout.write(
+            f"{summary['clients'] / wall_seconds if wall_seconds else 0.0:.2f} clients/s, "
+            f"{queries / wall_seconds if wall_seconds else 0.0:.1f} queries/s "
+            f"({queries} queries), {summary['workers']} workers"
+        )
+        for client_id, error in summary["errors"].items():
+            self.stderr.write(f"client {client_id}: {error}")
+        if summary["failed"]:
+            raise CommandError(f"{summary['failed']} clients failed")
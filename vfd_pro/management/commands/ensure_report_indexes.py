@@ -0,0 +1,295 @@
+import logging
+import time
+
+import mysql.connector
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from vfd_pro.common.db import fetch_all_dicts, get_connector_config
+from vfd_pro.vfd_collect_report_data import (
+    ENGINE_PER_METRIC,
+    close_prepared_statements,
+    get_metrics_for_clients,
+)
+from vfd_pro.vfd_collect_report_profile import (
+    new_query_profile,
+    summarize_query_profile,
+)
+
+sp_logger = logging.getLogger("sp_logger")
+
+# client_transaction is not managed by Django, so the columns and indexes the
+# collector and the CAAM refresh rely on are kept here instead of in a
+# migration.
+TRANSACTION_TABLE = "client_transaction"
+# {index name: columns}; the first covers the per category and month sums
+# together with the account join, the others the contact and journal joins.
+TRANSACTION_INDEXES = {
+    "idx_transaction_client_category_offset": (
+        "client_id",
+        "category",
+        "offset",
+        "account_id",
+        "net_amount",
+    ),
+    "idx_transaction_client_account": ("client_id", "account_id"),
+    "idx_transaction_client_contact": ("client_id", "contact_id"),
+    "idx_transaction_journal": ("journal_id",),
+}
+# Only needed by the collector's use_month_buckets, so only checked with
+# --month-buckets. month_bucket is the absolute month offsets are resolved
+# from; MySQL keeps it up to date. A STORED column cannot be added in place:
+# adding it copies the whole table, blocking writes (not reads) meanwhile.
+MONTH_BUCKET_COLUMNS = {
+    "month_bucket": (
+        "INT GENERATED ALWAYS AS "
+        "(YEAR(`transaction_date`) * 12 + MONTH(`transaction_date`) - 1) STORED"
+    ),
+}
+MONTH_BUCKET_INDEXES = {
+    "idx_transaction_client_category_bucket": (
+        "client_id",
+        "category",
+        "month_bucket",
+        "account_id",
+        "net_amount",
+    ),
+}
+
+
+def get_table_indexes(table):
+    """{index name: columns in order} of a table in the current database."""
+    rows = fetch_all_dicts(
+        """
+            SELECT INDEX_NAME AS index_name, COLUMN_NAME AS column_name
+            FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE()
+              AND TABLE_NAME = %s
+            ORDER BY INDEX_NAME, SEQ_IN_INDEX
+        """,
+        [table],
+    )
+    indexes = {}
+    for row in rows:
+        indexes.setdefault(row["index_name"], []).append(row["column_name"])
+    return {name: tuple(columns) for name, columns in indexes.items()}
+
+
+def get_table_columns(table):
+    rows = fetch_all_dicts(
+        """
+            SELECT COLUMN_NAME AS column_name
+            FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE()
+              AND TABLE_NAME = %s
+        """,
+        [table],
+    )
+    return {row["column_name"] for row in rows}
+
+
+def get_index_status(indexes=TRANSACTION_INDEXES, table=TRANSACTION_TABLE):
+    """{index name: 'ok' | 'missing' | 'different'}. An index with other
+    columns under the same name is 'different'; one with the same columns
+    under another name counts as 'ok'."""
+    existing = get_table_indexes(table)
+    status = {}
+    for name, columns in indexes.items():
+        if existing.get(name) == columns or columns in existing.values():
+            status[name] = "ok"
+        elif name in existing:
+            status[name] = "different"
+        else:
+            status[name] = "missing"
+    return status
+
+
+def add_column(name, definition, table=TRANSACTION_TABLE):
+    # A stored generated column rebuilds the table; asked for explicitly so
+    # MySQL keeps the table readable throughout or refuses.
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"ALTER TABLE `{table}` ADD COLUMN `{name}` {definition}, "
+            "ALGORITHM=COPY, LOCK=SHARED"
+        )
+
+
+def drop_column(name, table=TRANSACTION_TABLE):
+    # Dropping a stored column rebuilds the table in place, writes allowed.
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"ALTER TABLE `{table}` DROP COLUMN `{name}`, "
+            "ALGORITHM=INPLACE, LOCK=NONE"
+        )
+
+
+def create_index(name, columns, table=TRANSACTION_TABLE):
+    column_list = ", ".join(f"`{column}`" for column in columns)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"ALTER TABLE `{table}` ADD INDEX `{name}` ({column_list}), "
+            "ALGORITHM=INPLACE, LOCK=NONE"
+        )
+
+
+def drop_index(name, table=TRANSACTION_TABLE):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"ALTER TABLE `{table}` DROP INDEX `{name}`, ALGORITHM=INPLACE, LOCK=NONE"
+        )
+
+
+def benchmark_metrics(client_id, repeat, use_month_buckets=False):
+    """{label: fastest seconds over repeat runs} of the per_metric engine,
+    whose statements are labelled by metric."""
+    config = get_connector_config()
+    collector_connection = mysql.connector.connect(**config)
+    fastest = {}
+    try:
+        for _ in range(repeat):
+            profile = new_query_profile(rows_examined=False)
+            get_metrics_for_clients(
+                config,
+                client_ids=[client_id],
+                engine=ENGINE_PER_METRIC,
+                refresh_aggregates=False,
+                connection=collector_connection,
+                profile=profile,
+                use_month_buckets=use_month_buckets,
+            )
+            for label, metric in summarize_query_profile(profile)["metrics"].items():
+                fastest[label] = min(
+                    fastest.get(label, metric["seconds"]), metric["seconds"]
+                )
+    finally:
+        close_prepared_statements(collector_connection)
+        collector_connection.close()
+    return fastest
+
+
+class Command(BaseCommand):
+    help = (
+        "Check the client_transaction indexes the report collector relies on. "
+        "--create adds the missing ones and --benchmark CLIENT times every "
+        "metric before and after. --month-buckets also covers the month_bucket "
+        "column; adding it copies the whole table, which stays readable but "
+        "blocks writes until done."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--create", action="store_true")
+        parser.add_argument("--drop", action="store_true", help="Remove them again.")
+        parser.add_argument(
+            "--benchmark",
+            type=int,
+            metavar="CLIENT",
+            help="Time every per_metric statement for this client.",
+        )
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument(
+            "--month-buckets",
+            action="store_true",
+            help=(
+                "Also check (and create or drop) the month_bucket column and "
+                "its index, and benchmark with offsets resolved from it. "
+                "Rebuilds the table."
+            ),
+        )
+
+    def handle(self, *args, **options):
+        if options["create"] and options["drop"]:
+            raise CommandError("--create and --drop are exclusive")
+        wanted_columns = MONTH_BUCKET_COLUMNS if options["month_buckets"] else {}
+        wanted_indexes = dict(TRANSACTION_INDEXES)
+        if options["month_buckets"]:
+            wanted_indexes.update(MONTH_BUCKET_INDEXES)
+        columns = get_table_columns(TRANSACTION_TABLE)
+        missing_columns = [name for name in wanted_columns if name not in columns]
+        for name in wanted_columns:
+            state = "missing" if name in missing_columns else "ok"
+            self.stdout.write(f"{state:>9}  {name} column")
+        status = get_index_status(wanted_indexes)
+        for name, state in status.items():
+            self.stdout.write(
+                f"{state:>9}  {name} ({', '.join(wanted_indexes[name])})"
+            )
+
+        before = None
+        if options["benchmark"] is not None and missing_columns:
+            raise CommandError(
+                "--benchmark with --month-buckets needs the month_bucket column; "
+                "add it with --create first"
+            )
+        if options["benchmark"] is not None:
+            before = benchmark_metrics(
+                options["benchmark"], options["repeat"], options["month_buckets"]
+            )
+
+        if options["create"]:
+            for name, state in status.items():
+                if state == "different":
+                    raise CommandError(
+                        f"{name} exists with other columns; drop it first"
+                    )
+            for name in missing_columns:
+                started = time.monotonic()
+                add_column(name, wanted_columns[name])
+                self.stdout.write(
+                    f"added {name} column in {time.monotonic() - started:.1f}s"
+                )
+                sp_logger.info("Added column %s to %s", name, TRANSACTION_TABLE)
+            for name, state in status.items():
+                if state != "missing":
+                    continue
+                started = time.monotonic()
+                create_index(name, wanted_indexes[name])
+                self.stdout.write(
+                    f"created {name} in {time.monotonic() - started:.1f}s"
+                )
+                sp_logger.info("Created index %s on %s", name, TRANSACTION_TABLE)
+        elif options["drop"]:
+            existing = get_table_indexes(TRANSACTION_TABLE)
+            for name in wanted_indexes:
+                if name in existing:
+                    drop_index(name)
+                    self.stdout.write(f"dropped {name}")
+                    sp_logger.info("Dropped index %s on %s", name, TRANSACTION_TABLE)
+            for name in wanted_columns:
+                if name not in missing_columns:
+                    drop_column(name)
+                    self.stdout.write(f"dropped {name} column")
+                    sp_logger.info("Dropped column %s from %s", name, TRANSACTION_TABLE)
+
+        if before is not None:
+            changed = options["create"] or options["drop"]
+            after = (
+                benchmark_metrics(
+                    options["benchmark"], options["repeat"], options["month_buckets"]
+                )
+                if changed
+                else before
+            )
+            self.stdout.write(f"{'before':>10} {'after':>10} {'speedup':>8}  metric")
+            for label in sorted(
+                after, key=lambda label: before.get(label, 0), reverse=True
+            ):
+                seconds = before.get(label)
+                speedup = (
+                    f"{seconds / after[label]:.1f}x"
+                    if seconds and after[label]
+                    else "-"
+                )
+                self.stdout.write(
+                    f"{seconds or 0:>10.4f} {after[label]:>10.4f} {speedup:>8}  {label}"
+                )
+            self.stdout.write(
+                f"{sum(before.values()):>10.4f} {sum(after.values()):>10.4f}"
+                f" {'':>8}  total"
+            )
+
+        if not (options["create"] or options["drop"]) and (
+            missing_columns or any(state != "ok" for state in status.values())
+        ):
+            raise CommandError(
+                "client_transaction columns or indexes are missing; run with --create"
+            )
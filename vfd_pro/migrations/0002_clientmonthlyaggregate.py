@@ -0,0 +1,53 @@
+# Generated by Django 4.2.26 on 2026-10-18 11:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("vfd_pro", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ClientMonthlyAggregate",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("client_id", models.IntegerField()),
+                ("offset", models.IntegerField()),
+                ("category", models.CharField(blank=True, max_length=255, null=True)),
+                ("nominal_excluded", models.BooleanField(default=False)),
+                ("type_excluded", models.BooleanField(default=False)),
+                (
+                    "net_amount",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=20),
+                ),
+                ("refreshed_at", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "db_table": "vfd_client_monthly_aggregate",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="clientmonthlyaggregate",
+            constraint=models.UniqueConstraint(
+                fields=(
+                    "client_id",
+                    "offset",
+                    "category",
+                    "nominal_excluded",
+                    "type_excluded",
+                ),
+                name="uq_monthly_aggregate_bucket",
+            ),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.26 on 2026-10-18 11:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("vfd_pro", "0002_clientmonthlyaggregate"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ClientAccountClassification",
+            fields=[
+                ("account_id", models.IntegerField(primary_key=True, serialize=False)),
+                ("client_id", models.IntegerField()),
+                (
+                    "account_name",
+                    models.CharField(blank=True, max_length=255, null=True),
+                ),
+                (
+                    "account_type",
+                    models.CharField(blank=True, max_length=255, null=True),
+                ),
+                ("excluded_nominal", models.BooleanField(blank=True, null=True)),
+                ("is_other_income", models.BooleanField(blank=True, null=True)),
+                ("is_receivable", models.BooleanField(default=False)),
+                ("is_payable", models.BooleanField(default=False)),
+                ("is_cash", models.BooleanField(default=False)),
+                ("classified_at", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "db_table": "vfd_client_account_class",
+                "indexes": [
+                    models.Index(fields=["client_id"], name="idx_account_class_client")
+                ],
+            },
+        ),
+    ]
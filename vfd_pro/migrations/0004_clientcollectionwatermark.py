@@ -0,0 +1,26 @@
+# Generated by Django 4.2.26 on 2026-10-18 11:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("vfd_pro", "0003_clientaccountclassification"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ClientCollectionWatermark",
+            fields=[
+                ("client_id", models.IntegerField(primary_key=True, serialize=False)),
+                ("last_sync_timestamp", models.DateTimeField(blank=True, null=True)),
+                ("last_modified_datetime", models.DateTimeField(blank=True, null=True)),
+                ("aggregates_refreshed", models.BooleanField(default=False)),
+                ("collected_at", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "db_table": "vfd_client_collection_watermark",
+            },
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.2.26 on 2026-10-18 12:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("vfd_pro", "0004_clientcollectionwatermark"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ClientReportMetric",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("client_id", models.IntegerField()),
+                ("reporting_date", models.DateField()),
+                ("metric_key", models.CharField(max_length=255)),
+                (
+                    "value",
+                    models.DecimalField(
+                        blank=True, decimal_places=6, max_digits=24, null=True
+                    ),
+                ),
+                ("collected_at", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "db_table": "vfd_client_report_metric",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="clientreportmetric",
+            constraint=models.UniqueConstraint(
+                fields=("client_id", "reporting_date", "metric_key"),
+                name="uq_report_metric",
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.26 on 2026-10-18 12:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("vfd_pro", "0005_clientreportmetric"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="clientcollectionwatermark",
+            name="last_transaction_id",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="clientcollectionwatermark",
+            name="transaction_count",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.26 on 2026-10-18 12:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("vfd_pro", "0006_clientcollectionwatermark_transaction_marks"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="clientcollectionwatermark",
+            name="reporting_month",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
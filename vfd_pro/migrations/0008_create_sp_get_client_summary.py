@@ -0,0 +1,55 @@
+from django.db import migrations
+
+# The client summary page's data in one round trip, read with
+# callproc_multi(): the report config (the client's own, else the client 0
+# default), the sales trend and the latest CAAM report row.
+CREATE_SP_GET_CLIENT_SUMMARY = """
+CREATE PROCEDURE sp_get_client_summary(IN p_company_id INT, IN p_client_id INT)
+BEGIN
+    SELECT *
+    FROM vw_caam_report_config
+    WHERE client_id IN (p_client_id, 0)
+    ORDER BY client_id = p_client_id DESC
+    LIMIT 1;
+
+    SELECT offset, sales_month, sales_rolling_12_months
+    FROM vfd_client_sales_trend
+    WHERE client_id = p_client_id
+    ORDER BY offset;
+
+    SELECT *
+    FROM tbl_process_caam_report
+    WHERE company_id = p_company_id
+      AND client_id = p_client_id
+    ORDER BY reporting_date DESC
+    LIMIT 1;
+END
+"""
+
+DROP_SP_GET_CLIENT_SUMMARY = "DROP PROCEDURE IF EXISTS sp_get_client_summary"
+
+
+def create_procedure(apps, schema_editor):
+    # Stored procedures are MySQL only; other backends (the SQLite test
+    # settings) do without the client summary page.
+    if schema_editor.connection.vendor != "mysql":
+        return
+    schema_editor.execute(DROP_SP_GET_CLIENT_SUMMARY)
+    schema_editor.execute(CREATE_SP_GET_CLIENT_SUMMARY)
+
+
+def drop_procedure(apps, schema_editor):
+    if schema_editor.connection.vendor != "mysql":
+        return
+    schema_editor.execute(DROP_SP_GET_CLIENT_SUMMARY)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("vfd_pro", "0007_clientcollectionwatermark_reporting_month"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_procedure, drop_procedure),
+    ]
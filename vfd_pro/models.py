@@ -48,6 +48,109 @@ class ClientTransaction(models.Model):
         return f"{self.id} - {self.description or ''}"
 
 
+class ClientMonthlyAggregate(models.Model):
+    """Per-client monthly totals of client_transaction, refreshed by the collector."""
+
+    client_id = models.IntegerField()
+    offset = models.IntegerField()
+    category = models.CharField(max_length=255, blank=True, null=True)
+    nominal_excluded = models.BooleanField(default=False)
+    type_excluded = models.BooleanField(default=False)
+    net_amount = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    refreshed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+
+        db_table = "vfd_client_monthly_aggregate"
+        constraints = [
+            models.UniqueConstraint(
+                fields=[
+                    "client_id",
+                    "offset",
+                    "category",
+                    "nominal_excluded",
+                    "type_excluded",
+                ],
+                name="uq_monthly_aggregate_bucket",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.client_id} - {self.offset} - {self.category or ''}"
+
+
+class ClientAccountClassification(models.Model):
+    """Precomputed account filter flags for the collector, keyed by account."""
+
+    account_id = models.IntegerField(primary_key=True)
+    client_id = models.IntegerField()
+    account_name = models.CharField(max_length=255, blank=True, null=True)
+    account_type = models.CharField(max_length=255, blank=True, null=True)
+    excluded_nominal = models.BooleanField(blank=True, null=True)
+    is_other_income = models.BooleanField(blank=True, null=True)
+    is_receivable = models.BooleanField(default=False)
+    is_payable = models.BooleanField(default=False)
+    is_cash = models.BooleanField(default=False)
+    classified_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+
+        db_table = "vfd_client_account_class"
+        indexes = [
+            models.Index(fields=["client_id"], name="idx_account_class_client"),
+        ]
+
+    def __str__(self):
+        return f"{self.client_id} - {self.account_name or self.account_id}"
+
+
+class ClientCollectionWatermark(models.Model):
+    """Last transaction sync/modify times seen by an incremental collector run."""
+
+    client_id = models.IntegerField(primary_key=True)
+    last_sync_timestamp = models.DateTimeField(blank=True, null=True)
+    last_modified_datetime = models.DateTimeField(blank=True, null=True)
+    # Highest transaction id and transaction count at the watermark: rows past
+    # the id were appended since, a lower count of the others means deletions.
+    last_transaction_id = models.IntegerField(blank=True, null=True)
+    transaction_count = models.IntegerField(blank=True, null=True)
+    # The client's accounting_date month (year * 12 + month - 1), which the
+    # offsets and the monthly aggregate are relative to.
+    reporting_month = models.IntegerField(blank=True, null=True)
+    aggregates_refreshed = models.BooleanField(default=False)
+    collected_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+
+        db_table = "vfd_client_collection_watermark"
+
+    def __str__(self):
+        return f"{self.client_id} - {self.last_sync_timestamp}"
+
+
+class ClientReportMetric(models.Model):
+    """One collected report metric of a client, as saved by the collector."""
+
+    client_id = models.IntegerField()
+    reporting_date = models.DateField()
+    metric_key = models.CharField(max_length=255)
+    value = models.DecimalField(max_digits=24, decimal_places=6, blank=True, null=True)
+    collected_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+
+        db_table = "vfd_client_report_metric"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["client_id", "reporting_date", "metric_key"],
+                name="uq_report_metric",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.client_id} - {self.reporting_date} - {self.metric_key}"
+
+
 # class OpportunityCriteria(models.Model):
 
 #     client_id = models.IntegerField()
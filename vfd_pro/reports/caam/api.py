@@ -14,6 +14,7 @@ import json
 
 import logging
 
+from vfd_pro.common.db import bump_data_version
 from vfd_pro.common.utils import _fmt_num, fmt_percent, format_month_year
 from .selectors import (
     _call_revenue_profitability_sp,
@@ -48,11 +49,24 @@ def ajax_login_required(view_func):
 @require_GET
 def ajax_caam_report(request, company_id: int):
     try:
-        rows = _get_caam_report(company_id)
-        for r in rows:
-            r["reporting_month_label"] = format_month_year(r.get("reporting_date"))
+        # Column names once and each row as an array, not a dict per row.
+        report = _get_caam_report(company_id, shape="tuple")
+        date_index = report.index.get("reporting_date")
+        rows = [
+            [
+                *r,
+                format_month_year(None if date_index is None else r[date_index]),
+            ]
+            for r in report.rows
+        ]
 
-        return JsonResponse({"ok": True, "rows": rows})
+        return JsonResponse(
+            {
+                "ok": True,
+                "columns": [*report.columns, "reporting_month_label"],
+                "rows": rows,
+            }
+        )
     except Exception as e:
         sp_logger.error(f"ajax_caam_report ERROR: {e}", exc_info=True)
         return JsonResponse({"ok": False, "error": str(e)}, status=500)
@@ -1091,6 +1105,10 @@ def ajax_save_config(request, client_id: int):
         result = dict(zip(cols, row)) if (row and cols) else None
         sp_logger.debug(f"SP RESULT dict => {result}")
 
+        # Saved criteria change what the cached CAAM procedures return;
+        # client 0's default config changes them for every client.
+        bump_data_version([client_id])
+
         data = {"ok": True, "row": result}
         sp_logger.debug(f"JSON RESPONSE DATA (ajax_save_config) => {data}")
         return JsonResponse(data)
@@ -5,10 +5,11 @@ from typing import List, Dict, Any, Optional
 
 from vfd_pro.common.db import (
     fetch_one_dict,
-    fetch_all_dicts,
+    fetch_all_rows,
     fetch_scalar,
-    callproc_one_dict,
-    callproc_all_dicts,
+    cached_callproc_one_dict,
+    cached_callproc_all_dicts,
+    callproc_multi,
 )
 
 import logging
@@ -20,13 +21,14 @@ from typing import Any, Dict, List, Optional
 
 
 def _get_caam_report(
-    company_id: int, client_id: Optional[int] = None
-) -> List[Dict[str, Any]]:
+    company_id: int, client_id: Optional[int] = None, shape: str = "dict"
+) -> Any:
 
     try:
         params = [company_id, None if client_id is None else int(client_id)]
-        rows = callproc_all_dicts("sp_get_caam_report", params)
-        return rows or []
+        return cached_callproc_all_dicts(
+            "sp_get_caam_report", params, client_id=client_id, shape=shape
+        )
 
     except Exception as exc:
         sp_logger.error(
@@ -78,7 +80,8 @@ def _get_caam_report_config_by_company(company_id: int) -> Optional[dict]:
 
 
 def _get_sales_trend(client_id: int):
-    return fetch_all_dicts(
+    """The sales trend as {column: [value per offset]}, the chart's series."""
+    return fetch_all_rows(
         """
             SELECT offset, sales_month, sales_rolling_12_months
             FROM vfd_client_sales_trend
@@ -86,101 +89,159 @@ def _get_sales_trend(client_id: int):
             ORDER BY offset
             """,
         [client_id],
+        shape="columns",
     )
 
 
+def _get_client_summary(company_id: int, client_id: int) -> dict:
+    """The client summary page's data from one sp_get_client_summary call:
+    "cfg" (the client's report config, else the client 0 default, or None),
+    "sales_trend" as _get_sales_trend() returns it and "caam_row" as
+    _get_caam_report_details() does."""
+    results = callproc_multi(
+        "sp_get_client_summary",
+        [company_id, client_id],
+        names=["cfg", "sales_trend", "caam_row"],
+        shape=["dict", "columns", "dict"],
+        json_safe=False,
+    )
+    return {
+        "cfg": next(iter(results["cfg"]), None),
+        "sales_trend": results["sales_trend"],
+        "caam_row": next(iter(results["caam_row"]), None),
+    }
+
+
 def _call_revenue_profitability_sp(
     client_id, period, sign_mode, min_months, threshold, flag_on
 ):
-    return callproc_one_dict(
+    return cached_callproc_one_dict(
         "sp_vfd_client_revenue_profitability",
         [client_id, period, sign_mode, min_months, threshold, flag_on],
+        client_id=client_id,
     )
 
 
 def _call_gm_profitability_sp(
     client_id, period, sign_mode, min_months, threshold, flag_on
 ):
-    return callproc_one_dict(
+    return cached_callproc_one_dict(
         "sp_vfd_client_gross_margin_profitability",
         [client_id, period, sign_mode, min_months, threshold, flag_on],
+        client_id=client_id,
     )
 
 
 def _call_overhead_profitability_sp(
     client_id, period, sign_mode, min_months, threshold, flag_on
 ):
-    return callproc_one_dict(
+    return cached_callproc_one_dict(
         "sp_vfd_client_overhead_profitability",
         [client_id, period, sign_mode, min_months, threshold, flag_on],
+        client_id=client_id,
     )
 
 
 def _call_overhead_pct_profitability_sp(
     client_id, period, sign_mode, min_months, threshold, flag_on
 ):
-    return callproc_one_dict(
+    return cached_callproc_one_dict(
         "sp_vfd_client_overhead_pct_profitability",
         [client_id, period, sign_mode, min_months, threshold, flag_on],
+        client_id=client_id,
     )
 
 
 def _call_ebitda_profitability_sp(client_id, sign_mode, min_months, threshold, flag_on):
-    return callproc_one_dict(
+    return cached_callproc_one_dict(
         "sp_vfd_client_ebitda_profitability",
         [client_id, sign_mode, min_months, threshold, flag_on],
+        client_id=client_id,
     )
 
 
 def _call_newcust_profitability_sp(
     client_id, sign_mode, min_months, threshold, flag_on
 ):
-    return callproc_one_dict(
+    return cached_callproc_one_dict(
         "sp_vfd_client_new_customers_profitability",
         [client_id, sign_mode, min_months, threshold, flag_on],
+        client_id=client_id,
     )
 
 
 def _call_retention_profitability_sp(
     client_id, sign_mode, min_months, threshold, flag_on
 ):
-    return callproc_one_dict(
+    return cached_callproc_one_dict(
         "sp_vfd_client_retention_profitability",
         [client_id, sign_mode, min_months, threshold, flag_on],
+        client_id=client_id,
     )
 
 
 def _call_cash_position_profitability_sp(
     client_id, sign_mode, min_months, threshold, flag_on
 ):
-    return callproc_one_dict(
+    return cached_callproc_one_dict(
         "sp_vfd_client_cash_position_profitability",
         [client_id, sign_mode, min_months, threshold, flag_on],
+        client_id=client_id,
     )
 
 
 def _call_debtor_days_profitability_sp(
     client_id, sign_mode, min_months, threshold, flag_on
 ):
-    return callproc_one_dict(
+    return cached_callproc_one_dict(
         "sp_vfd_client_debtor_days_profitability",
         [client_id, sign_mode, min_months, threshold, flag_on],
+        client_id=client_id,
     )
 
 
 def _call_creditor_days_profitability_sp(
     client_id, sign_mode, min_months, threshold, flag_on
 ):
-    return callproc_one_dict(
+    return cached_callproc_one_dict(
         "sp_vfd_client_creditor_days_profitability",
         [client_id, sign_mode, min_months, threshold, flag_on],
+        client_id=client_id,
     )
 
 
 def _call_stock_days_profitability_sp(
     client_id, sign_mode, min_months, threshold, flag_on
 ):
-    return callproc_one_dict(
+    return cached_callproc_one_dict(
         "sp_vfd_client_stock_days_profitability",
         [client_id, sign_mode, min_months, threshold, flag_on],
+        client_id=client_id,
     )
+
+
+def _get_client_report_metrics(
+    client_id: int, reporting_date: Optional[Any] = None
+) -> Dict[str, Any]:
+    """Collected metrics of a client as {metric_key: value}, latest date by default."""
+    if reporting_date is None:
+        sql = """
+            SELECT metric_key, value
+            FROM vfd_client_report_metric
+            WHERE client_id = %s
+              AND reporting_date = (
+                  SELECT MAX(reporting_date)
+                  FROM vfd_client_report_metric
+                  WHERE client_id = %s
+              )
+        """
+        params = [client_id, client_id]
+    else:
+        sql = """
+            SELECT metric_key, value
+            FROM vfd_client_report_metric
+            WHERE client_id = %s
+              AND reporting_date = %s
+        """
+        params = [client_id, reporting_date]
+    return dict(fetch_all_rows(sql, params, shape="tuple").rows)
@@ -3,11 +3,7 @@ from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
 
 
-from vfd_pro.reports.caam.selectors import (
-    _get_caam_report_details,
-    _get_caam_report_config,
-    _get_sales_trend,
-)
+from vfd_pro.reports.caam.selectors import _get_client_summary
 
 from vfd_pro.reports.caam.services import (
     get_suitability,
@@ -45,17 +41,16 @@ def client_summary(request, client_id: int):
     if not company_id:
         return render(request, "caam/client_summary.html", context)
 
-    cfg = (
-        _get_caam_report_config(client_id=client_id)
-        or _get_caam_report_config(client_id=0)
-        or {}
-    )
+    # Config, sales trend and CAAM row in one procedure round trip.
+    summary = _get_client_summary(company_id=company_id, client_id=client_id)
+
+    cfg = summary["cfg"] or {}
     context["cfg"] = cfg
     context["p_period_str"] = str(cfg.get("p_period") or "")
 
-    context["sales_trend"] = _get_sales_trend(client_id)
+    context["sales_trend"] = summary["sales_trend"]
 
-    caam_row = _get_caam_report_details(company_id=company_id, client_id=client_id)
+    caam_row = summary["caam_row"]
     if caam_row:
         context.update(caam_row)
         context["caam_row"] = caam_row
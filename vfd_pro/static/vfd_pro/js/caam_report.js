@@ -749,11 +749,12 @@
         if (typeof window.Chart !== "function" && typeof window.Chart !== "object") return;
 
         const salesDataElement = document.getElementById("sales-data");
-        const salesData = salesDataElement ? JSON.parse(salesDataElement.textContent) : [];
+        // One list per column: {offset: [...], sales_month: [...], ...}
+        const salesData = (salesDataElement && JSON.parse(salesDataElement.textContent)) || {};
 
-        const labels = salesData.map((x) => x.offset);
-        const monthly = salesData.map((x) => x.sales_month);
-        const rolling = salesData.map((x) => x.rolling_12 || x.sales_rolling_12_months);
+        const labels = salesData.offset || [];
+        const monthly = salesData.sales_month || [];
+        const rolling = salesData.sales_rolling_12_months || [];
 
         const ctx = canvas.getContext("2d");
         if (!ctx) return;
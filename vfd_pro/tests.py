@@ -1,3 +1,914 @@
-from django.test import TestCase
+import contextlib
+import copy
+import io
+import math
+import random
+import shutil
+import tempfile
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from uuid import UUID
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import mysql.connector
+from django.db import connection
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from vfd_pro.common.cursors import iter_batches
+from vfd_pro.common.db import (
+    _cached_callproc,
+    _json_conversion_plan,
+    _json_safe_rows,
+    _json_safe_value,
+    _normalize_param,
+    _proc_cache_key,
+    bump_data_version,
+    cached_callproc_all_dicts,
+    callproc_multi,
+    get_connector_config,
+    iter_dicts,
+    record_class,
+    shape_rows,
+)
+from vfd_pro.common.db_metrics import (
+    get_call_metrics,
+    multi_row_count,
+    record_call,
+    render_prometheus,
+    reset_call_metrics,
+    timed,
+)
+from vfd_pro.vfd_collect_report_data import (
+    ENGINE_PER_METRIC,
+    ENGINE_PREFIX_SUM,
+    ENGINE_SINGLE_PASS,
+    METRIC_AGGREGATIONS,
+    METRICS,
+    get_derived_metrics,
+    get_derived_metrics_vectorized,
+    get_metrics_for_clients,
+    get_metrics_from_database,
+    get_revenue_driver_values,
+    report_metric_value,
+    save_report_metrics,
+)
+
+# The tables the collector reads that Django does not manage, reduced to the
+# columns it uses. month_bucket is a plain column here, filled by the fixture.
+COLLECTOR_TABLES = {
+    "client_transaction": """
+        id INT PRIMARY KEY,
+        client_id INT,
+        account_id INT,
+        contact_id INT,
+        journal_id INT,
+        category VARCHAR(255),
+        `offset` INT,
+        net_amount DECIMAL(20, 2),
+        source VARCHAR(255),
+        api_source_type_name VARCHAR(255),
+        transaction_date DATE,
+        sync_timestamp DATETIME,
+        modified_datetime DATETIME,
+        month_bucket INT
+    """,
+    "vfd_client": "id INT PRIMARY KEY, company_id INT, accounting_date DATE",
+    "vfd_client_account": (
+        "id INT PRIMARY KEY, client_id INT, name VARCHAR(255), type VARCHAR(255)"
+    ),
+    "vfd_client_contact": """
+        id INT PRIMARY KEY,
+        client_id INT,
+        name VARCHAR(255),
+        customer_ty INT,
+        customer_ly INT,
+        customer_py INT,
+        supplier_ty INT,
+        supplier_ly INT,
+        supplier_py INT
+    """,
+    "vfd_client_journal": (
+        "id INT PRIMARY KEY, client_id INT, source_id INT, reference VARCHAR(255)"
+    ),
+    "vfd_client_invoice": "id INT PRIMARY KEY, client_id INT, number VARCHAR(255)",
+}
+
+ACCOUNTS = [
+    ("Sales", "REVENUE"),
+    ("Bank Interest", "OTHERINCOME"),
+    ("Rent", "EXPENSE"),
+    ("Wages", "EXPENSE"),
+    ("Depreciation", "EXPENSE"),
+    ("Corp Tax", "EXPENSE"),
+    ("Main Current Account", "BANK"),
+    ("Petty Cash", "Cash"),
+    ("Debtors Control", "Accounts Receivable"),
+    ("Creditors Control", "Accounts Payable"),
+    ("Stock", "CURRENT"),
+    ("Loan", None),
+]
+CATEGORIES = [
+    "Sales",
+    "Cost of Sales",
+    "Overheads",
+    "Fixed assets",
+    "Current assets",
+    "Current liabilities",
+    "Long term liabilities",
+    "Equity",
+]
+SOURCES = ["invoice", "invoice", "credit-note", "payment", "manual-journal", None]
+API_SOURCES = ["INV", "INV", "CN", "PAY", "MJ", None]
+ACCOUNTING_DATE = "2025-06-30"
+SYNC_TIMESTAMP = "2025-07-01 00:00:00"
+# Client 3 has no transactions.
+FIXTURE_CLIENT_IDS = [1, 2, 3]
+
+
+def month_of_offset(offset):
+    """(year, month) of an offset from the fixture's June 2025."""
+    months = 2025 * 12 + 5 + offset
+    return months // 12, months % 12 + 1
+
+
+def transaction_row(
+    transaction_id, client_id, account_id, category, offset, amount, **columns
+):
+    year, month = month_of_offset(offset)
+    row = {
+        "id": transaction_id,
+        "client_id": client_id,
+        "account_id": account_id,
+        "contact_id": None,
+        "journal_id": None,
+        "category": category,
+        "offset": offset,
+        "net_amount": Decimal(amount),
+        "source": "invoice",
+        "api_source_type_name": "INV",
+        "transaction_date": f"{year:04d}-{month:02d}-15",
+        "sync_timestamp": SYNC_TIMESTAMP,
+        "modified_datetime": SYNC_TIMESTAMP,
+        "month_bucket": year * 12 + month - 1,
+    }
+    row.update(columns)
+    return row
+
+
+def insert_rows(cursor, table, rows):
+    columns = list(rows[0])
+    cursor.executemany(
+        f"INSERT INTO {table} ({', '.join(f'`{c}`' for c in columns)}) "
+        f"VALUES ({', '.join(['%s'] * len(columns))})",
+        [tuple(row[c] for c in columns) for row in rows],
+    )
+
+
+def build_collector_fixture(collector_connection, seed=1, transactions=400):
+    """Recreates the collector's unmanaged tables with a small random book
+    of transactions per client."""
+    rnd = random.Random(seed)
+    cursor = collector_connection.cursor()
+    for table, columns in COLLECTOR_TABLES.items():
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        cursor.execute(f"CREATE TABLE {table} ({columns})")
+
+    rows = {table: [] for table in COLLECTOR_TABLES}
+    for client_id in FIXTURE_CLIENT_IDS:
+        rows["vfd_client"].append(
+            {"id": client_id, "company_id": 1, "accounting_date": ACCOUNTING_DATE}
+        )
+        accounts = []
+        for i, (name, type_) in enumerate(ACCOUNTS):
+            account_id = client_id * 100 + i
+            accounts.append(account_id)
+            rows["vfd_client_account"].append(
+                {"id": account_id, "client_id": client_id, "name": name, "type": type_}
+            )
+        contacts = []
+        for i in range(10):
+            contact_id = client_id * 100 + i
+            contacts.append(contact_id)
+            flags = {
+                column: rnd.choice([0, 1, 2, None])
+                for column in (
+                    "customer_ty",
+                    "customer_ly",
+                    "customer_py",
+                    "supplier_ty",
+                    "supplier_ly",
+                    "supplier_py",
+                )
+            }
+            rows["vfd_client_contact"].append(
+                dict(id=contact_id, client_id=client_id, name=f"C{i % 7}", **flags)
+            )
+        journals = []
+        for i in range(20):
+            journal_id = client_id * 100 + i
+            journals.append(journal_id)
+            rows["vfd_client_invoice"].append(
+                {
+                    "id": journal_id,
+                    "client_id": client_id,
+                    "number": rnd.choice([f"INV{rnd.randint(1, 15)}", None]),
+                }
+            )
+            rows["vfd_client_journal"].append(
+                {
+                    "id": journal_id,
+                    "client_id": client_id,
+                    "source_id": rnd.choice([journal_id, None]),
+                    "reference": rnd.choice([f"REF{rnd.randint(1, 15)}", None]),
+                }
+            )
+        if client_id == FIXTURE_CLIENT_IDS[-1]:
+            continue
+        for i in range(transactions):
+            rows["client_transaction"].append(
+                transaction_row(
+                    client_id * 10000 + i,
+                    client_id,
+                    rnd.choice(accounts + [999999]),
+                    rnd.choice(CATEGORIES),
+                    rnd.randint(-40, 2),
+                    f"{rnd.uniform(-1000, 1000):.2f}",
+                    contact_id=rnd.choice(contacts + [None]),
+                    journal_id=rnd.choice(journals + [None]),
+                    source=rnd.choice(SOURCES),
+                    api_source_type_name=rnd.choice(API_SOURCES),
+                )
+            )
+    for table, table_rows in rows.items():
+        insert_rows(cursor, table, table_rows)
+    collector_connection.commit()
+    cursor.close()
+
+
+def drop_collector_fixture(collector_connection):
+    cursor = collector_connection.cursor()
+    for table in COLLECTOR_TABLES:
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    collector_connection.commit()
+    cursor.close()
+
+
+@skipUnless(connection.vendor == "mysql", "the collector's SQL is MySQL only")
+class CollectorTestCase(TransactionTestCase):
+    """Runs the collector over build_collector_fixture() on its own
+    mysql.connector connection to the test database."""
+
+    def setUp(self):
+        self.config = get_connector_config()
+        self.collector_connection = mysql.connector.connect(**self.config)
+        build_collector_fixture(self.collector_connection)
+
+    def tearDown(self):
+        drop_collector_fixture(self.collector_connection)
+        self.collector_connection.close()
+
+    def execute(self, sql, params=None):
+        cursor = self.collector_connection.cursor()
+        cursor.execute(sql, params)
+        self.collector_connection.commit()
+        cursor.close()
+
+    def collect(self, **options):
+        # The collector prints its progress.
+        with contextlib.redirect_stdout(io.StringIO()):
+            return get_metrics_for_clients(
+                self.config,
+                client_ids=options.pop("client_ids", FIXTURE_CLIENT_IDS),
+                connection=self.collector_connection,
+                **options,
+            )
+
+    def collect_per_metric(self, client_ids=FIXTURE_CLIENT_IDS):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return {
+                client_id: get_metrics_from_database(
+                    self.config,
+                    client_id,
+                    engine=ENGINE_PER_METRIC,
+                    connection=self.collector_connection,
+                )
+                for client_id in client_ids
+            }
+
+    def assertMetricsEqual(self, first, second, places=2):
+        self.assertEqual(sorted(first), sorted(second))
+        for client_id, metric_values in first.items():
+            other_values = second[client_id]
+            self.assertEqual(sorted(metric_values), sorted(other_values))
+            for key, value in metric_values.items():
+                other = other_values[key]
+                if isinstance(value, (int, float, Decimal)) and not isinstance(
+                    value, bool
+                ):
+                    self.assertAlmostEqual(
+                        float(value),
+                        float(other),
+                        places=places,
+                        msg=f"client {client_id} {key}",
+                    )
+                else:
+                    self.assertEqual(value, other, f"client {client_id} {key}")
+
+
+class CollectorEngineTests(CollectorTestCase):
+    def test_engines_agree(self):
+        expected = self.collect_per_metric()
+        for engine in (ENGINE_SINGLE_PASS, ENGINE_PREFIX_SUM):
+            with self.subTest(engine=engine):
+                self.assertMetricsEqual(expected, self.collect(engine=engine))
+
+    def test_engines_agree_with_month_buckets(self):
+        expected = self.collect_per_metric()
+        self.assertMetricsEqual(
+            expected, self.collect(engine=ENGINE_SINGLE_PASS, use_month_buckets=True)
+        )
+
+
+class IncrementalCollectionTests(CollectorTestCase):
+    # An Overheads row below every other id of client 1, so deleting it
+    # leaves the client's highest transaction id as it was.
+    TRANSACTION_ID = 9999
+
+    def setUp(self):
+        super().setUp()
+        cursor = self.collector_connection.cursor()
+        insert_rows(
+            cursor,
+            "client_transaction",
+            [transaction_row(self.TRANSACTION_ID, 1, 102, "Overheads", -10, "500")],
+        )
+        self.collector_connection.commit()
+        cursor.close()
+
+    def collect_incremental(self, save=True, **options):
+        # As collect_report_data does: the watermarks are stored with the
+        # metrics.
+        collection_marks = {}
+        metrics = self.collect(
+            engine=ENGINE_PREFIX_SUM,
+            incremental=True,
+            collection_marks=collection_marks,
+            **options,
+        )
+        if save:
+            save_report_metrics(
+                self.collector_connection, metrics, collection_marks=collection_marks
+            )
+        return metrics
+
+    def assertCollectedInFull(self, metrics):
+        self.assertEqual(list(metrics), [1])
+        self.assertMetricsEqual(self.collect_per_metric([1]), metrics)
+
+    def test_unchanged_clients_are_skipped(self):
+        self.collect_incremental()
+        self.assertEqual(self.collect_incremental(), {})
+
+    def test_unsaved_clients_are_collected_again(self):
+        self.collect_incremental(save=False)
+        self.assertEqual(sorted(self.collect_incremental()), FIXTURE_CLIENT_IDS)
+        self.assertEqual(self.collect_incremental(), {})
+
+    def test_appended_transaction(self):
+        self.collect_incremental()
+        cursor = self.collector_connection.cursor()
+        insert_rows(
+            cursor,
+            "client_transaction",
+            [
+                transaction_row(
+                    10999,
+                    1,
+                    102,
+                    "Overheads",
+                    -3,
+                    "250",
+                    sync_timestamp="2025-07-02 00:00:00",
+                )
+            ],
+        )
+        self.collector_connection.commit()
+        cursor.close()
+        self.assertCollectedInFull(self.collect_incremental())
+
+    def test_moved_transaction(self):
+        self.collect_incremental()
+        year, month = month_of_offset(-5)
+        self.execute(
+            "UPDATE client_transaction SET `offset`=%s, transaction_date=%s, "
+            "month_bucket=%s, modified_datetime=%s WHERE id=%s",
+            (
+                -5,
+                f"{year:04d}-{month:02d}-15",
+                year * 12 + month - 1,
+                "2025-07-02 00:00:00",
+                self.TRANSACTION_ID,
+            ),
+        )
+        self.assertCollectedInFull(self.collect_incremental())
+
+    def test_deleted_transaction(self):
+        self.collect_incremental()
+        self.execute(
+            "DELETE FROM client_transaction WHERE id=%s", (self.TRANSACTION_ID,)
+        )
+        self.assertCollectedInFull(self.collect_incremental())
+
+    def test_reporting_month_moved_on(self):
+        options = {"use_month_buckets": True, "client_ids": [1]}
+        self.collect_incremental(**options)
+        self.execute(
+            "UPDATE vfd_client SET accounting_date=%s WHERE id=1", ("2025-07-31",)
+        )
+        metrics = self.collect_incremental(**options)
+        self.assertEqual(list(metrics), [1])
+        self.assertMetricsEqual(
+            self.collect(engine=ENGINE_SINGLE_PASS, **options), metrics
+        )
+
+
+class DerivedMetricsTests(SimpleTestCase):
+    """get_derived_metrics_vectorized() against get_derived_metrics() on the
+    raw metrics the collector returns."""
+
+    def base_metrics(self, value):
+        # value(definition) gives each registry metric; the revenue driver
+        # counts are those of a client without Sales transactions.
+        metric_values = {"accounting_date": date(2025, 6, 30)}
+        for definition in METRICS:
+            metric_values[definition.name] = value(definition)
+        metric_values.update(get_revenue_driver_values(None))
+        return metric_values
+
+    def random_metrics(self, rnd, zero_share=0.0):
+        def value(definition):
+            if rnd.random() < zero_share:
+                return METRIC_AGGREGATIONS[definition.aggregation][2]
+            if definition.aggregation == "count_contacts":
+                return rnd.randint(0, 40)
+            return Decimal(rnd.randint(-500000, 500000)) / 100
+
+        metric_values = self.base_metrics(value)
+        for key in metric_values:
+            if key.startswith("chart_total_sales_"):
+                metric_values[key] = rnd.randint(0, 300)
+        return metric_values
+
+    def client_metrics(self):
+        rnd = random.Random(7)
+        return {
+            # No transactions at all: every total is its empty value.
+            1: self.base_metrics(
+                lambda definition: METRIC_AGGREGATIONS[definition.aggregation][2]
+            ),
+            2: self.random_metrics(rnd),
+            3: self.random_metrics(rnd, zero_share=0.5),
+            4: self.random_metrics(rnd, zero_share=0.9),
+        }
+
+    def assertDerivedEqual(self, client_metric_values):
+        expected = {
+            client_id: get_derived_metrics(dict(metric_values))
+            for client_id, metric_values in client_metric_values.items()
+        }
+        derived = get_derived_metrics_vectorized(copy.deepcopy(client_metric_values))
+        for client_id, metric_values in expected.items():
+            other_values = derived[client_id]
+            self.assertEqual(sorted(metric_values), sorted(other_values))
+            for key, value in metric_values.items():
+                other = other_values[key]
+                with self.subTest(client_id=client_id, key=key):
+                    if isinstance(value, (Decimal, float)):
+                        self.assertTrue(
+                            math.isclose(
+                                float(value), float(other), rel_tol=1e-9, abs_tol=1e-6
+                            ),
+                            f"{value} != {other}",
+                        )
+                    else:
+                        self.assertEqual(value, other)
+                        self.assertIs(type(value), type(other))
+                    # Stored the same way: Decimal both, or NULL both.
+                    stored = report_metric_value(value)
+                    other_stored = report_metric_value(other)
+                    self.assertIs(type(stored), type(other_stored))
+
+    def test_agrees_with_get_derived_metrics(self):
+        self.assertDerivedEqual(self.client_metrics())
+
+    def test_single_client(self):
+        self.assertDerivedEqual({2: self.client_metrics()[2]})
+
+    def test_missing_metric(self):
+        for key in (
+            "Sales_Month_TY",
+            "Net_Worth_Current_Month_-11_LY",
+            "chart_profit_month-23",
+            "Customer_Segmentation_TY_New",
+            "chart_total_sales_invoices-12",
+        ):
+            metric_values = self.client_metrics()[2]
+            del metric_values[key]
+            with self.subTest(key=key):
+                with self.assertRaises(KeyError):
+                    get_derived_metrics(dict(metric_values))
+                with self.assertRaises(KeyError):
+                    get_derived_metrics_vectorized({2: metric_values})
+
+
+class ReportMetricValueTests(SimpleTestCase):
+    def test_numbers_are_kept(self):
+        self.assertEqual(report_metric_value(12), 12)
+        self.assertEqual(report_metric_value(Decimal("-1.5")), Decimal("-1.5"))
+        self.assertEqual(report_metric_value(0.1), Decimal("0.1"))
+
+    def test_non_numbers_are_null(self):
+        for value in (None, True, "2025-06-30", [1]):
+            with self.subTest(value=value):
+                self.assertIsNone(report_metric_value(value))
+
+    def test_non_finite_values_are_null(self):
+        for value in (
+            float("nan"),
+            float("inf"),
+            float("-inf"),
+            Decimal("NaN"),
+            Decimal("Infinity"),
+        ):
+            with self.subTest(value=value):
+                self.assertIsNone(report_metric_value(value))
+
+    def test_values_beyond_the_column_are_null(self):
+        self.assertEqual(
+            report_metric_value(Decimal("999999999999999999.999999")),
+            Decimal("999999999999999999.999999"),
+        )
+        for value in (10**18, -(10**18), 1e300, Decimal("1E+30")):
+            with self.subTest(value=value):
+                self.assertIsNone(report_metric_value(value))
+
+
+class SaveReportMetricsTests(CollectorTestCase):
+    def test_unstorable_values_do_not_fail_the_batch(self):
+        metric_values = {
+            "accounting_date": ACCOUNTING_DATE,
+            "revenue": Decimal("1250.50"),
+            "ratio": float("inf"),
+            "margin": float("nan"),
+            "huge": 1e300,
+        }
+        with self.assertLogs("sp_logger", "WARNING"):
+            written = save_report_metrics(
+                self.collector_connection, {1: metric_values, 2: {"revenue": 3}}
+            )
+        self.assertEqual(written, 5)
+        cursor = self.collector_connection.cursor()
+        cursor.execute(
+            "SELECT client_id, metric_key, value FROM vfd_client_report_metric "
+            "ORDER BY client_id, metric_key"
+        )
+        rows = [(client_id, key, value) for client_id, key, value in cursor.fetchall()]
+        cursor.close()
+        self.assertEqual(
+            rows,
+            [
+                (1, "huge", None),
+                (1, "margin", None),
+                (1, "ratio", None),
+                (1, "revenue", Decimal("1250.50")),
+                (2, "revenue", Decimal("3")),
+            ],
+        )
+
+
+class ShapeRowsTests(SimpleTestCase):
+    cols = ["id", "GM%_Month_TY", "as_dict", "_asdict"]
+    rows = [(1, Decimal("0.25"), "a", "x"), (2, None, "b", "y")]
+
+    def test_dict(self):
+        self.assertEqual(
+            shape_rows(self.cols, self.rows),
+            [
+                {
+                    "id": 1,
+                    "GM%_Month_TY": Decimal("0.25"),
+                    "as_dict": "a",
+                    "_asdict": "x",
+                },
+                {"id": 2, "GM%_Month_TY": None, "as_dict": "b", "_asdict": "y"},
+            ],
+        )
+
+    def test_tuple(self):
+        result = shape_rows(self.cols, self.rows, "tuple")
+        self.assertEqual(result.columns, self.cols)
+        self.assertEqual(result.rows, self.rows)
+        self.assertEqual(result.value(result.rows[1], "as_dict"), "b")
+
+    def test_record(self):
+        first, second = shape_rows(self.cols, self.rows, "record")
+        self.assertEqual(first.id, 1)
+        self.assertEqual(first["GM%_Month_TY"], Decimal("0.25"))
+        self.assertEqual(first.as_dict, "a")
+        self.assertEqual(second["_asdict"], "y")
+        self.assertEqual(
+            second._asdict(),
+            {"id": 2, "GM%_Month_TY": None, "as_dict": "b", "_asdict": "y"},
+        )
+        self.assertIs(type(first), record_class(tuple(self.cols)))
+
+    def test_record_repeated_column(self):
+        (record,) = shape_rows(["id", "id"], [(1, 2)], "record")
+        self.assertEqual(record.id, 2)
+        self.assertEqual(record._asdict(), {"id": 2})
+
+    def test_columns(self):
+        self.assertEqual(
+            shape_rows(self.cols, self.rows, "columns"),
+            {
+                "id": [1, 2],
+                "GM%_Month_TY": [Decimal("0.25"), None],
+                "as_dict": ["a", "b"],
+                "_asdict": ["x", "y"],
+            },
+        )
+        self.assertEqual(shape_rows(["id"], [], "columns"), {"id": []})
+
+    def test_unknown_shape(self):
+        with self.assertRaises(ValueError):
+            shape_rows(self.cols, self.rows, "frame")
+
+
+class IterDictsTests(TransactionTestCase):
+    def test_iter_batches(self):
+        class Cursor:
+            def __init__(self, rows):
+                self.rows = rows
+                self.fetches = 0
+
+            def fetchmany(self, size):
+                self.fetches += 1
+                batch, self.rows = self.rows[:size], self.rows[size:]
+                return batch
+
+        cursor = Cursor([(i,) for i in range(5)])
+        self.assertEqual(
+            list(iter_batches(cursor, 2)), [[(0,), (1,)], [(2,), (3,)], [(4,)]]
+        )
+        self.assertEqual(cursor.fetches, 4)
+
+    def test_iter_dicts(self):
+        sql = " UNION ALL ".join(["SELECT %s AS id, %s AS name"] * 3)
+        params = [1, "a", 2, "b", 3, "c"]
+        rows = iter_dicts(sql, params, batch_size=2)
+        self.assertEqual(next(rows), {"id": 1, "name": "a"})
+        self.assertEqual(list(rows), [{"id": 2, "name": "b"}, {"id": 3, "name": "c"}])
+
+
+class JsonSafeRowsTests(SimpleTestCase):
+    # (name, type_code) as in cursor.description, with values of that type.
+    columns = [
+        ("id", 3, [1, None]),
+        ("amount", 246, [Decimal("12.50"), Decimal("-0.01")]),
+        ("ratio", 5, [0.5, None]),
+        ("reporting_date", 10, [date(2025, 6, 30), None]),
+        ("synced", 12, [datetime(2025, 6, 30, 12, 5), datetime(2025, 7, 1)]),
+        ("elapsed", 11, [timedelta(hours=1), None]),
+        ("name", 253, ["Acme", None]),
+        ("hash", 254, [b"\x01\xff", bytearray(b"\x00")]),
+        ("token", 255, [UUID(int=1), b"\xab"]),
+        ("mystery", None, [Decimal("1.5"), date(2025, 1, 1)]),
+    ]
+
+    def description(self):
+        return [(name, type_code) for name, type_code, values in self.columns]
+
+    def rows(self):
+        return list(zip(*(values for name, type_code, values in self.columns)))
+
+    def test_rows_match_json_safe_value(self):
+        rows = self.rows()
+        expected = [tuple(_json_safe_value(v) for v in row) for row in rows]
+        self.assertEqual(_json_safe_rows(self.description(), rows), expected)
+
+    def test_plan_leaves_identity_columns_alone(self):
+        plan = _json_conversion_plan(self.description())
+        names = [name for name, type_code, values in self.columns]
+        unchanged = [name for name, convert in zip(names, plan) if convert is None]
+        self.assertEqual(unchanged, ["id", "ratio", "elapsed"])
+        self.assertIs(plan[names.index("mystery")], _json_safe_value)
+
+    def test_no_rows(self):
+        self.assertEqual(_json_safe_rows(self.description(), []), [])
+
+
+class CallprocMultiTests(SimpleTestCase):
+    # The result sets of a fake procedure: (description, rows), None for the
+    # status result MySQL ends a CALL with.
+    result_sets = [
+        ([("p_period", 3), ("threshold", 246)], [(12, Decimal("15.00"))]),
+        ([("offset", 3), ("sales_month", 246)], [(-1, Decimal("2.5")), (0, None)]),
+        ([("client_id", 3)], []),
+        None,
+    ]
+
+    def call(self, *args, **kwargs):
+        result_sets = iter(self.result_sets)
+
+        class Cursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def callproc(self, proc_name, params):
+                self.nextset()
+
+            def nextset(self):
+                self.result = next(result_sets, None)
+                self.description = self.result and self.result[0]
+                return self.result is not None
+
+            def fetchall(self):
+                return list(self.result[1])
+
+        with mock.patch("vfd_pro.common.db.connection") as connection:
+            connection.cursor = Cursor
+            return callproc_multi("sp_multi", [1], *args, **kwargs)
+
+    def test_every_result_set_is_returned(self):
+        self.assertEqual(
+            self.call(["cfg"]),
+            {
+                "cfg": [{"p_period": 12, "threshold": 15.0}],
+                "result_1": [
+                    {"offset": -1, "sales_month": 2.5},
+                    {"offset": 0, "sales_month": None},
+                ],
+                "result_2": [],
+            },
+        )
+
+    def test_shape_per_result_set(self):
+        results = self.call(
+            ["cfg", "trend", "row"], shape=["record", "columns"], json_safe=False
+        )
+        self.assertEqual(results["cfg"][0].threshold, Decimal("15.00"))
+        self.assertEqual(
+            results["trend"], {"offset": [-1, 0], "sales_month": [Decimal("2.5"), None]}
+        )
+        self.assertEqual(results["row"], {"client_id": []})
+        self.assertEqual(multi_row_count(results, ["record", "columns"]), 3)
+
+
+class DbMetricsTests(SimpleTestCase):
+    def setUp(self):
+        reset_call_metrics()
+        self.addCleanup(reset_call_metrics)
+
+    def test_timed_counts_rows_of_a_positional_shape(self):
+        @timed("sql")
+        def fetch(sql, params=None, shape="dict"):
+            return shape_rows(["id"], [(1,), (2,), (3,)], shape)
+
+        fetch("SELECT id FROM t WHERE a = 1", [], "columns")
+        fetch("SELECT id FROM t WHERE a = 2", shape="columns")
+        fetch("SELECT id FROM t WHERE a = 3")
+        call = get_call_metrics()[("sql", "SELECT id FROM t WHERE a = ?")]
+        self.assertEqual(call["count"], 3)
+        self.assertEqual(call["rows"], 9)
+
+    def test_render_prometheus(self):
+        record_call("procedure", "sp_get_caam_report", 0.02, rows=4)
+        record_call("procedure", "sp_get_caam_report", 0.3, error="OperationalError")
+        record_call("sql", 'SELECT "x"', 0.001, rows=1)
+        lines = render_prometheus().splitlines()
+
+        caam = 'kind="procedure",name="sp_get_caam_report"'
+        self.assertEqual(lines[1], "# TYPE vfd_db_call_seconds histogram")
+        self.assertIn(f'vfd_db_call_seconds_bucket{{{caam},le="0.01"}} 0', lines)
+        self.assertIn(f'vfd_db_call_seconds_bucket{{{caam},le="0.025"}} 1', lines)
+        self.assertIn(f'vfd_db_call_seconds_bucket{{{caam},le="0.5"}} 2', lines)
+        self.assertIn(f'vfd_db_call_seconds_bucket{{{caam},le="+Inf"}} 2', lines)
+        self.assertIn(f"vfd_db_call_seconds_sum{{{caam}}} 0.320000", lines)
+        self.assertIn(f"vfd_db_call_seconds_count{{{caam}}} 2", lines)
+        self.assertIn(f"vfd_db_call_rows_total{{{caam}}} 4", lines)
+        self.assertIn(f"vfd_db_call_errors_total{{{caam}}} 1", lines)
+        self.assertIn("# TYPE vfd_db_call_errors_total counter", lines)
+        self.assertIn(
+            'vfd_db_call_rows_total{kind="sql",name="SELECT \\"x\\""} 1', lines
+        )
+
+
+SHARED_PROC_CACHE = {
+    "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+    "LOCATION": tempfile.mkdtemp(prefix="vfd_proc_cache_"),
+}
+
+
+@override_settings(CACHES={"default": SHARED_PROC_CACHE}, PROC_CACHE_ALIAS="default")
+class ProcCacheTests(SimpleTestCase):
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(SHARED_PROC_CACHE["LOCATION"], ignore_errors=True)
+
+    def test_normalize_param(self):
+        for value in (1, 1.0, True, Decimal("1"), Decimal("1.00")):
+            self.assertEqual(_normalize_param(value), 1)
+        self.assertEqual(_normalize_param(Decimal("2.50")), 2.5)
+        self.assertEqual(_normalize_param(0.25), 0.25)
+        self.assertEqual(_normalize_param(date(2025, 6, 30)), "2025-06-30")
+        self.assertEqual(
+            _normalize_param(datetime(2025, 6, 30, 8, 15)), "2025-06-30T08:15:00"
+        )
+        self.assertEqual(_normalize_param("+/-"), "+/-")
+        self.assertIsNone(_normalize_param(None))
+
+    def test_cache_key_is_stable(self):
+        key = _proc_cache_key("sp_x", [7, Decimal("15.00"), True, None], 7)
+        self.assertEqual(key, _proc_cache_key("sp_x", [7.0, 15, 1, None], 7))
+        self.assertEqual(
+            key, _proc_cache_key("sp_x", [7, Decimal("15.00"), True, None], 7)
+        )
+        self.assertNotEqual(key, _proc_cache_key("sp_x", [7, 16, 1, None], 7))
+        self.assertNotEqual(key, _proc_cache_key("sp_y", [7, 15, 1, None], 7))
+        self.assertNotEqual(key, _proc_cache_key("sp_x", [7, 15, 1, None], 8))
+        self.assertNotEqual(key, _proc_cache_key("sp_x", [7, 15, 1, None], None))
+
+    def test_bump_data_version_changes_the_key(self):
+        key = _proc_cache_key("sp_x", [7], 7)
+        other_key = _proc_cache_key("sp_x", [8], 8)
+        company_key = _proc_cache_key("sp_x", [], None)
+        bump_data_version([7])
+        self.assertNotEqual(key, _proc_cache_key("sp_x", [7], 7))
+        self.assertEqual(other_key, _proc_cache_key("sp_x", [8], 8))
+        self.assertNotEqual(company_key, _proc_cache_key("sp_x", [], None))
+
+    def test_default_config_bumps_every_key(self):
+        keys = [
+            _proc_cache_key("sp_x", [7], 7),
+            _proc_cache_key("sp_x", [8], 8),
+            _proc_cache_key("sp_x", [], None),
+        ]
+        bump_data_version([0])
+        for key, (params, client_id) in zip(keys, [([7], 7), ([8], 8), ([], None)]):
+            self.assertNotEqual(key, _proc_cache_key("sp_x", params, client_id))
+
+    def test_results_are_cached_until_bumped(self):
+        calls = []
+
+        def helper(proc_name, params):
+            calls.append(params)
+            return {"calls": len(calls)}
+
+        for _ in range(2):
+            result = _cached_callproc(helper, "sp_cached", [3, 1.0], 3, 60)
+        self.assertEqual(result, {"calls": 1})
+        bump_data_version([3])
+        result = _cached_callproc(helper, "sp_cached", [3, 1.0], 3, 60)
+        self.assertEqual(result, {"calls": 2})
+
+    def test_all_dicts_shapes_share_one_entry(self):
+        calls = []
+
+        def callproc_all_dicts(proc_name, params, shape):
+            calls.append(shape)
+            return shape_rows(["id", "name"], [(1, "a"), (2, "b")], shape)
+
+        with mock.patch("vfd_pro.common.db.callproc_all_dicts", callproc_all_dicts):
+            rows = cached_callproc_all_dicts("sp_shapes", [4], 4, 60)
+            columns = cached_callproc_all_dicts("sp_shapes", [4], 4, 60, "columns")
+            tuples = cached_callproc_all_dicts("sp_shapes", [4], 4, 60, "tuple")
+        self.assertEqual(calls, ["tuple"])
+        self.assertEqual(rows, [{"id": 1, "name": "a"}, {"id": 2, "name": "b"}])
+        self.assertEqual(columns, {"id": [1, 2], "name": ["a", "b"]})
+        self.assertEqual(tuples.value(tuples.rows[1], "name"), "b")
+        self.assertNotEqual(
+            _proc_cache_key("sp_shapes", [4], 4),
+            _proc_cache_key("sp_shapes", [4], 4, "tuple"),
+        )
+
+    @override_settings(
+        CACHES={
+            "default": SHARED_PROC_CACHE,
+            "local": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        },
+        PROC_CACHE_ALIAS="local",
+    )
+    def test_process_local_cache_is_not_used(self):
+        calls = []
+
+        def helper(proc_name, params):
+            calls.append(params)
+            return len(calls)
+
+        for _ in range(2):
+            result = _cached_callproc(helper, "sp_local", [3], 3, 60)
+        self.assertEqual(result, 2)
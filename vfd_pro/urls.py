@@ -1,10 +1,14 @@
 from django.contrib import admin
 from django.urls import path, include
 
+from vfd_pro.views import db_metrics, db_slow_calls
+
 
 urlpatterns = [
     path("", include("core.urls")),
     path("admin/", admin.site.urls),
     path("accounts/", include("django.contrib.auth.urls")),
     path("", include(("vfd_pro.reports.caam.urls", "caam"), namespace="caam")),
+    path("metrics/db/", db_metrics, name="db_metrics"),
+    path("metrics/db/slow/", db_slow_calls, name="db_slow_calls"),
 ]
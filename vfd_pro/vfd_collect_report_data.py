@@ -1,7 +1,354 @@
 import mysql.connector
 from statistics import mean 
 from decimal import Decimal
+from functools import lru_cache
+from collections import namedtuple
+from datetime import date
+from itertools import accumulate
 import html
+import logging
+import math
+import re
+import time
+import unicodedata
+import weakref
+
+import numpy as np
+
+from vfd_pro.common.cursors import STREAM_BATCH_SIZE, iter_batches
+from vfd_pro.vfd_collect_report_profile import needs_buffering, record_query, run_profiled_query
+
+sp_logger = logging.getLogger("sp_logger")
+
+# Collector engines: 'per_metric' runs one query per metric definition,
+# 'single_pass' computes them from one query per metric base (see
+# plan_metric_queries()) and 'prefix_sum' derives the windowed sums from the
+# vfd_client_monthly_aggregate table.
+ENGINE_PER_METRIC='per_metric'
+ENGINE_SINGLE_PASS='single_pass'
+ENGINE_PREFIX_SUM='prefix_sum'
+ENGINES=(ENGINE_PER_METRIC, ENGINE_SINGLE_PASS, ENGINE_PREFIX_SUM)
+
+# Clients per batch query in get_metrics_for_clients().
+BATCH_CHUNK_SIZE=500
+
+# Clients per vfd_client_report_metric write transaction; each has several
+# hundred metric rows.
+REPORT_METRIC_CHUNK_SIZE=50
+# vfd_client_report_metric.value is DECIMAL(24,6): values at or beyond this
+# magnitude do not fit and are stored as NULL.
+REPORT_METRIC_LIMIT=Decimal(10)**18
+# vfd_client_monthly_aggregate keeps one bucket per month for offsets -35..0;
+# older offsets are folded into a single opening bucket at offset -36 so that
+# cumulative ("everything up to") balances still add up.
+AGGREGATE_MONTHS=36
+AGGREGATE_OPENING_OFFSET=-AGGREGATE_MONTHS
+
+# client_transaction.month_bucket is the absolute month of the transaction,
+# year*12+month-1 of its transaction_date (see the ensure_report_indexes
+# command). A transaction's offset is its month_bucket less the bucket of the
+# reporting month, the client's accounting_date unless as_of is given.
+CLIENT_MONTH_BUCKET="(YEAR(report_client.accounting_date)*12+MONTH(report_client.accounting_date)-1)"
+CLIENT_MONTH_BUCKET_JOIN="JOIN vfd_client report_client ON (report_client.id=transaction.client_id)"
+
+# Nominal accounts left out of Cost of Sales and Overheads (tax, interest,
+# depreciation, dividends), as LIKE patterns on the account name.
+NOMINAL_NAME_EXCLUDE_PATTERNS=[html.unescape(pattern) for pattern in [
+    '%Corp Tax%',
+    '%Corporation Tax%',
+    '%Dividend%',
+    '%Taxes%',
+    '%Interest%',
+    '%Int.%',
+    '%Depreciation%',
+    '%Depn%',
+    '%Amortisation%',
+    '%Amortization%',
+    '%Corporate Tax%',
+    '%Business Tax%',
+    '%Amortissement%',
+    '%Imp&ocirc;t sur les Soci&eacute;t&eacute;s%',
+    '%D&eacute;pr&eacute;ciation%',
+    '%Dividende%',
+    '%Int&eacute;r&ecirc;t%',
+    '%Taxation%',
+]]
+NOMINAL_NAME_EXCLUDE_CATEGORIES=['Cost of Sales', 'Overheads']
+NOMINAL_TYPE_EXCLUDE_PATTERN='%OTHERINCOME%'
+
+ACCOUNT_TYPES={
+    'accounts_receivable': 'Accounts Receivable',
+    'accounts_payable': 'Accounts Payable',
+}
+ACCOUNT_NAMES={
+    'accounts_receivable': [
+        '%A/R%',
+        '%Accounts Receivable%',
+        '%Debtor Control%',
+        '%Debtors%',
+        '%Sales ledger%',
+        '%Recouvrables%',
+        html.unescape('%Contr&ocirc;le du d&eacute;biteur%'),
+        '%Grand livre des ventes%',
+    ],
+    'accounts_payable': [
+        #'%Payables Identification%',
+        '%A/P%',
+        '%Accounts Payable%',
+        #'%AMEX%',
+        #'%C.I.S.%',
+        #'%CIS%',
+        #'%Corporation Tax Liability%',
+        #'%Corporation tax payable%',
+        '%Creditors%',
+        '%Creditors Control%',
+        #'%Creditors Control Account%',
+        #'%Earnings Orders Payable%',
+        #'%Inland Revenue - PAYEE%',
+        #'%Mastercard%',
+        #'%National Insurance%',
+        #'%Nest%',
+        #'%Net Wages%',
+        #'%NIC Payable%',
+        #'%P.A.Y.E.%',
+        #'%PAYE & NIC%',
+        #'%PAYE and National Insurance%',
+        #'%PAYE and NI%',
+        #'%PAYE Control Account%',
+        #'%PAYE Payable%',
+        #'%PAYE/NI%',
+        #'%PAYEE NIC & TAX%',
+        #'%Payroll Liabilities%',
+        #'%Pension control%',
+        #'%Pension Liability%',
+        #'%Pension Payable%',
+        #'%Pensions Payable%',
+        #'%Pensions unpaid%',
+        '%Purchase ledger',
+        #'%Purchase ledger control%',
+        #'%Unpaid Expense Claims%',
+        #'%VISA%',
+        #'%Wages Control Account%',
+        #'%Wages Payable - Payroll%',
+        '%Dettes Exigibles%',
+        html.unescape('%Contr&ocirc;le des cr&eacute;anciers%'),
+        '%Registre des achats%',
+    ]
+}
+ACCOUNT_NAME_EXCLUDE_PATTERN='%Other%'
+
+CASH_ACCOUNT_TYPE_PATTERNS=['%Bank%', '%Cash%']
+CASH_ACCOUNT_NAME_PATTERNS=[
+    '%Bank%',
+    '%Cash%',
+    '%Current Account%',
+    '%Deposit Account%',
+    '%Money Market Account%',
+]
+
+# Revenue Drivers.
+# ptype NOT IN ('MJ', 'CN', 'OVERPAYMENTS')
+PTYPE_NUM_TRANS_EXCLUDE=" \
+    transaction.source NOT IN ('manual-journal', 'credit-note', 'overpayment') AND \
+    transaction.api_source_type_name NOT IN ('MJ', 'CN', 'OVERPAYMENTS')"
+
+# (metric suffix, first offset, last offset) of the revenue driver counts.
+REVENUE_DRIVER_WINDOWS=[('-0', -11, 0), ('-12', -23, -12)]
+
+# Metric registry. Every collected metric is declared once as a
+# MetricDefinition and plan_metric_queries() compiles all metrics sharing a
+# base into a single query:
+#   base          key of METRIC_BASES: joins and filter common to the query
+#   categories    transaction categories summed, None for any
+#   first_offset  first offset of the window, None for everything before
+#   last_offset   last offset of the window, None for no upper bound
+#   aggregation   key of METRIC_AGGREGATIONS
+#   exclusions    get_account_clauses() fragments the transactions must pass
+#   condition     any further SQL condition on the transaction or contact
+#   contact_flags ((column, nonzero), ...) the vfd_client_contact flags must
+#                 match: column!=0 when nonzero, column=0 otherwise
+#   negate        report the total with its sign flipped
+MetricDefinition=namedtuple(
+    'MetricDefinition',
+    ['name', 'base', 'categories', 'first_offset', 'last_offset', 'aggregation', 'exclusions', 'condition', 'contact_flags', 'negate'],
+    defaults=('transactions', None, None, 0, 'sum', (), None, (), False))
+
+# Base filters are formatted with the account clauses plus 'ptype'. The plan
+# says how a base's query is compiled:
+#   'buckets'  pre-aggregated by category and offset before each metric sums
+#              the buckets in its window in SQL
+#   'running'  grouped by category and offset, every metric then read off a
+#              running balance in Python; cumulative windows only
+#   'contacts' one row per distinct contact, flag combination and set of
+#              metric windows matched, counted per metric in Python
+#   'rows'     each metric aggregates the joined rows through its own CASE
+# Metrics on 'buckets', 'running' and 'contacts' bases may not use condition.
+METRIC_BASES={
+    'transactions': {
+        'joins': ['account'],
+        'filter': None,
+        'plan': 'buckets',
+    },
+    'balances': {
+        'joins': ['account'],
+        'filter': None,
+        'plan': 'running',
+    },
+    'sales_contacts': {
+        'joins': ['account', 'contact'],
+        'filter': "transaction.category='Sales' AND {nominal_type_exclude} AND {ptype}",
+        'plan': 'contacts',
+    },
+}
+
+METRIC_JOINS={
+    'contact': "LEFT JOIN vfd_client_contact contact ON (contact.id=transaction.contact_id)",
+}
+
+# SQL template over the metric's CASE condition, and the value of an empty
+# result.
+METRIC_AGGREGATIONS={
+    'sum': ("SUM({value})", 'transaction.net_amount', Decimal(0.0)),
+    'count_contacts': ("COUNT(DISTINCT {value})", 'contact.name', 0),
+}
+
+PL_EXCLUSIONS=('nominal_name_exclude', 'nominal_type_exclude')
+INCOME_EXCLUSIONS=('nominal_name_exclude',)
+# vfd_client_monthly_aggregate totals for each exclusion set it can answer.
+AGGREGATE_EXCLUSION_COLUMNS={
+    PL_EXCLUSIONS: 'amount',
+    INCOME_EXCLUSIONS: 'income_amount',
+}
+BALANCE_SHEET_CATEGORIES=('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities')
+PROFIT_CATEGORIES=('Sales', 'Cost of Sales', 'Overheads')
+WORKING_CAPITAL_CATEGORIES=('Current assets', 'Current liabilities')
+
+# Period columns of the P&L metrics ('Sales_Last_3_Months_TY', ...) with their
+# length in months, and the offset of each year's last month.
+PERIOD_WINDOWS={
+    'Month': 1,
+    'Last_3_Months': 3,
+    'Last_6_Months': 6,
+    'Last_9_Months': 9,
+    'Last_12_Months': 12,
+}
+PERIODS=list(PERIOD_WINDOWS)
+PERIOD_YEARS={
+    'TY': 0,
+    'LY': -12,
+}
+
+def rolling_year_metrics(prefix, categories, count, **options):
+    # Rolling 12 month totals for the previous count months.
+    return [
+        MetricDefinition(f'{prefix}{i}', categories=categories, first_offset=-11-i, last_offset=-i, **options)
+        for i in range(count)
+    ]
+
+def period_metrics(prefix, category, **options):
+    # '{prefix}_Month_TY', '{prefix}_Month_LY', ... '{prefix}_Last_12_Months_LY'.
+    return [
+        MetricDefinition(
+            f'{prefix}_{period}_{year}',
+            categories=(category,),
+            first_offset=last_offset-months+1,
+            last_offset=last_offset,
+            **options)
+        for period, months in PERIOD_WINDOWS.items()
+        for year, last_offset in PERIOD_YEARS.items()
+    ]
+
+def segmentation_metric(name, first_offset=None, last_offset=None, **contact_flags):
+    # Distinct Sales contacts in the window whose flags match, e.g.
+    # customer_ty=True, customer_ly=False for customers new this year.
+    return MetricDefinition(
+        name,
+        base='sales_contacts',
+        first_offset=first_offset,
+        last_offset=last_offset,
+        aggregation='count_contacts',
+        contact_flags=tuple(contact_flags.items()))
+
+METRICS=[
+    MetricDefinition('chart_assets_month-0', base='balances', categories=('Fixed assets', 'Current assets'), exclusions=PL_EXCLUSIONS, negate=True),
+    MetricDefinition('chart_assets_month-12', base='balances', categories=('Fixed assets', 'Current assets'), last_offset=-12, exclusions=PL_EXCLUSIONS, negate=True),
+    MetricDefinition('chart_liabilities_month-0', base='balances', categories=('Current liabilities', 'Long term liabilities'), exclusions=PL_EXCLUSIONS, negate=True),
+    MetricDefinition('chart_liabilities_month-12', base='balances', categories=('Current liabilities', 'Long term liabilities'), last_offset=-12, exclusions=PL_EXCLUSIONS, negate=True),
+
+    MetricDefinition('chart_current_assets_month-0', base='balances', categories=('Current assets',), exclusions=PL_EXCLUSIONS),
+    MetricDefinition('chart_current_assets_month-12', base='balances', categories=('Current assets',), last_offset=-12, exclusions=PL_EXCLUSIONS),
+    MetricDefinition('chart_current_liabilities_month-0', base='balances', categories=('Current liabilities',), exclusions=PL_EXCLUSIONS),
+    MetricDefinition('chart_current_liabilities_month-12', base='balances', categories=('Current liabilities',), last_offset=-12, exclusions=PL_EXCLUSIONS),
+
+    # Rolling 12 month Overheads and Cost of Sales for the previous 13 months.
+    *rolling_year_metrics('chart_overheads_month-', ('Overheads',), 13, exclusions=PL_EXCLUSIONS, negate=True),
+    *rolling_year_metrics('chart_cost_of_sales_month-', ('Cost of Sales',), 13, exclusions=PL_EXCLUSIONS, negate=True),
+
+    *period_metrics('COS', 'Cost of Sales', exclusions=PL_EXCLUSIONS, negate=True),
+    *period_metrics('Overheads', 'Overheads', exclusions=PL_EXCLUSIONS, negate=True),
+
+    # Net Worth at each of the last 24 month ends.
+    *[
+        MetricDefinition(
+            f'Net_Worth_Current_Month_{"" if i==0 else f"-{i}_"}{year}',
+            base='balances',
+            categories=BALANCE_SHEET_CATEGORIES,
+            last_offset=last_offset-i,
+            exclusions=PL_EXCLUSIONS,
+            negate=True)
+        for year, last_offset in PERIOD_YEARS.items()
+        for i in range(12)
+    ],
+
+    # Profit for each of the previous 24 months.
+    *[
+        MetricDefinition(f'chart_profit_month-{i}', categories=PROFIT_CATEGORIES, first_offset=-i, last_offset=-i, exclusions=PL_EXCLUSIONS)
+        for i in range(24)
+    ],
+
+    # Income (not just sales). Rolling 12 month Revenue and Income for the
+    # previous 13 months, and the Sales and Income periods.
+    *rolling_year_metrics('chart_revenue_month-', ('Sales',), 13, exclusions=INCOME_EXCLUSIONS),
+    *period_metrics('Sales', 'Sales', exclusions=INCOME_EXCLUSIONS),
+    *rolling_year_metrics('chart_income_month-', ('Sales',), 13, exclusions=INCOME_EXCLUSIONS),
+    *period_metrics('Income', 'Sales', exclusions=INCOME_EXCLUSIONS),
+
+    # Customer Segmentation.
+    segmentation_metric('Customer_Segmentation_TY_Existing', -11, 0, customer_ty=True, customer_ly=True),
+    segmentation_metric('Customer_Segmentation_TY_New', -11, 0, customer_ty=True, customer_ly=False),
+    segmentation_metric('Customer_Segmentation_LY_vs_TY_Retained', -23, 12, customer_ly=True, customer_ty=True),
+    segmentation_metric('Customer_Segmentation_LY_vs_TY_Lost', -23, 12, customer_ly=True, customer_ty=False),
+    segmentation_metric('Customer_Segmentation_LY_vs_PY_Existing', -23, 12, customer_ly=True, customer_py=True),
+    segmentation_metric('Customer_Segmentation_LY_vs_PY_New', -23, 12, customer_ly=True, customer_py=False),
+    segmentation_metric('Customer_Segmentation_PY_vs_LY_Retained', -35, 24, customer_py=True, customer_ly=True),
+    segmentation_metric('Customer_Segmentation_PY_vs_LY_Lost', -35, 24, customer_py=True, customer_ly=False),
+    segmentation_metric('Customer_Count_TY', -11, 0, customer_ty=True),
+    segmentation_metric('Customer_Count_LY', -23, 12, customer_ly=True),
+    segmentation_metric('Customer_Count_PY', -35, 24, customer_py=True),
+
+    # Supplier Segmentation.
+    segmentation_metric('Supplier_Segmentation_TY_Existing', supplier_ty=True, supplier_ly=True),
+    segmentation_metric('Supplier_Segmentation_TY_New', supplier_ty=True, supplier_ly=False),
+    segmentation_metric('Supplier_Segmentation_LY_vs_TY_Retained', supplier_ly=True, supplier_ty=True),
+    segmentation_metric('Supplier_Segmentation_LY_vs_TY_Lost', supplier_ly=True, supplier_ty=False),
+    segmentation_metric('Supplier_Segmentation_LY_vs_PY_Existing', supplier_ly=True, supplier_py=True),
+    segmentation_metric('Supplier_Segmentation_LY_vs_PY_New', supplier_ly=True, supplier_py=False),
+    segmentation_metric('Supplier_Segmentation_PY_vs_LY_Retained', supplier_py=True, supplier_ly=True),
+    segmentation_metric('Supplier_Segmentation_PY_vs_LY_Lost', supplier_py=True, supplier_ly=False),
+
+    # Accounts receivable and payable, now and a year ago.
+    *[
+        MetricDefinition(f'chart_{pr}{offset}', base='balances', categories=WORKING_CAPITAL_CATEGORIES, last_offset=int(offset), exclusions=(pr,))
+        for offset in ['-0', '-12']
+        for pr in ACCOUNT_TYPES
+    ],
+
+    # Cash at each of the last 24 month ends.
+    *[
+        MetricDefinition(f'chart_cash_balance_month-{i}', base='balances', categories=WORKING_CAPITAL_CATEGORIES, last_offset=-i, exclusions=('cash',), negate=True)
+        for i in range(24)
+    ],
+]
 
 def special_divide(numerator, denominator):
     if denominator!=0:
@@ -10,622 +357,1421 @@ def special_divide(numerator, denominator):
         result=Decimal(0.0)
     return result
 
-def get_metrics_from_database(
-    config,
-    client_id):
-    # A handy query:
-    # SELECT client_id, COUNT(DISTINCT `offset`) FROM client_transaction WHERE `offset` <=0 GROUP BY client_id;
-    # nominal_name_exclude="account.name NOT IN ('Corp Tax', 'Corporation Tax', 'Dividend', 'Taxes', 'Interest', 'Depreciation', 'Depn', 'Amortisation', 'Amortization', 'Corporate Tax', 'Business Tax')"
-    # nominal_name_exclude="account.name NOT LIKE '%Corp Tax%' AND account.name NOT LIKE '%Corporation Tax%' AND account.name NOT LIKE '%Dividend%' AND account.name NOT LIKE '%Taxes%' AND account.name NOT LIKE '%Interest%' AND account.name NOT LIKE '%Depreciation%' AND account.name NOT LIKE '%Depn%' AND account.name NOT LIKE '%Amortisation%' AND account.name NOT LIKE '%Amortization%' AND account.name NOT LIKE '%Corporate Tax%' AND account.name NOT LIKE '%Business Tax%'"
-    #nominal_name_exclude="((account.name NOT LIKE '%Corp Tax%' AND account.name NOT LIKE '%Corporation Tax%' AND account.name NOT LIKE '%Dividend%' AND account.name NOT LIKE '%Taxes%' AND account.name NOT LIKE '%Interest%' AND account.name NOT LIKE '%Int.%' AND account.name NOT LIKE '%Depreciation%' AND account.name NOT LIKE '%Depn%' AND account.name NOT LIKE '%Amortisation%' AND account.name NOT LIKE '%Amortization%' AND account.name NOT LIKE '%Corporate Tax%' AND account.name NOT LIKE '%Business Tax%') OR (category NOT IN ('Cost of Sales', 'Overheads')))"
-    nominal_name_exclude=html.unescape(" \
-        ( \
-         (account.name NOT LIKE '%Corp Tax%' AND \
-          account.name NOT LIKE '%Corporation Tax%' AND \
-          account.name NOT LIKE '%Dividend%' AND \
-          account.name NOT LIKE '%Taxes%' AND \
-          account.name NOT LIKE '%Interest%' AND \
-          account.name NOT LIKE '%Int.%' AND \
-          account.name NOT LIKE '%Depreciation%' AND \
-          account.name NOT LIKE '%Depn%' AND \
-          account.name NOT LIKE '%Amortisation%' AND \
-          account.name NOT LIKE '%Amortization%' AND \
-          account.name NOT LIKE '%Corporate Tax%' AND \
-          account.name NOT LIKE '%Business Tax%' AND \
-          account.name NOT LIKE '%Amortissement%' AND \
-          account.name NOT LIKE '%Imp&ocirc;t sur les Soci&eacute;t&eacute;s%' AND \
-          account.name NOT LIKE '%D&eacute;pr&eacute;ciation%' AND \
-          account.name NOT LIKE '%Dividende%' AND \
-          account.name NOT LIKE '%Int&eacute;r&ecirc;t%' AND \
-          account.name NOT LIKE '%Taxation%') OR \
-         (category NOT IN ('Cost of Sales', 'Overheads') \
-         ) \
-        )")
-    nominal_type_exclude="account.type NOT LIKE '%OTHERINCOME%'"
-
-    metric_definitions={
-        'chart_assets_month-0': "category IN ('Fixed assets', 'Current assets') AND `offset`<=0",
-        'chart_assets_month-12': "category IN ('Fixed assets', 'Current assets') AND `offset`<=-12",
-        'chart_liabilities_month-0': "category IN ('Current liabilities', 'Long term liabilities') AND `offset`<=0",
-        'chart_liabilities_month-12': "category IN ('Current liabilities', 'Long term liabilities') AND `offset`<=-12",
-
-        'chart_current_assets_month-0': "category='Current assets' AND `offset`<=0",
-        'chart_current_assets_month-12': "category='Current assets' AND `offset`<=-12",
-        'chart_current_liabilities_month-0': "category='Current liabilities' AND `offset`<=0",
-        'chart_current_liabilities_month-12': "category='Current liabilities' AND `offset`<=-12",
-
-        # Rolling 12 month Overheads for the previous 13 months.
-        'chart_overheads_month-0': "category='Overheads' AND `offset`>=-11 AND `offset`<=0",
-        'chart_overheads_month-1': "category='Overheads' AND `offset`>=-12 AND `offset`<=-1",
-        'chart_overheads_month-2': "category='Overheads' AND `offset`>=-13 AND `offset`<=-2",
-        'chart_overheads_month-3': "category='Overheads' AND `offset`>=-14 AND `offset`<=-3",
-        'chart_overheads_month-4': "category='Overheads' AND `offset`>=-15 AND `offset`<=-4",
-        'chart_overheads_month-5': "category='Overheads' AND `offset`>=-16 AND `offset`<=-5",
-        'chart_overheads_month-6': "category='Overheads' AND `offset`>=-17 AND `offset`<=-6",
-        'chart_overheads_month-7': "category='Overheads' AND `offset`>=-18 AND `offset`<=-7",
-        'chart_overheads_month-8': "category='Overheads' AND `offset`>=-19 AND `offset`<=-8",
-        'chart_overheads_month-9': "category='Overheads' AND `offset`>=-20 AND `offset`<=-9",
-        'chart_overheads_month-10': "category='Overheads' AND `offset`>=-21 AND `offset`<=-10",
-        'chart_overheads_month-11': "category='Overheads' AND `offset`>=-22 AND `offset`<=-11",
-        'chart_overheads_month-12': "category='Overheads' AND `offset`>=-23 AND `offset`<=-12",
-
-        # Rolling 12 month Cost of Sales for the previous 13 months.
-        'chart_cost_of_sales_month-0': "category='Cost of Sales' AND `offset`>=-11 AND `offset`<=0",
-        'chart_cost_of_sales_month-1': "category='Cost of Sales' AND `offset`>=-12 AND `offset`<=-1",
-        'chart_cost_of_sales_month-2': "category='Cost of Sales' AND `offset`>=-13 AND `offset`<=-2",
-        'chart_cost_of_sales_month-3': "category='Cost of Sales' AND `offset`>=-14 AND `offset`<=-3",
-        'chart_cost_of_sales_month-4': "category='Cost of Sales' AND `offset`>=-15 AND `offset`<=-4",
-        'chart_cost_of_sales_month-5': "category='Cost of Sales' AND `offset`>=-16 AND `offset`<=-5",
-        'chart_cost_of_sales_month-6': "category='Cost of Sales' AND `offset`>=-17 AND `offset`<=-6",
-        'chart_cost_of_sales_month-7': "category='Cost of Sales' AND `offset`>=-18 AND `offset`<=-7",
-        'chart_cost_of_sales_month-8': "category='Cost of Sales' AND `offset`>=-19 AND `offset`<=-8",
-        'chart_cost_of_sales_month-9': "category='Cost of Sales' AND `offset`>=-20 AND `offset`<=-9",
-        'chart_cost_of_sales_month-10': "category='Cost of Sales' AND `offset`>=-21 AND `offset`<=-10",
-        'chart_cost_of_sales_month-11': "category='Cost of Sales' AND `offset`>=-22 AND `offset`<=-11",
-        'chart_cost_of_sales_month-12': "category='Cost of Sales' AND `offset`>=-23 AND `offset`<=-12",
-
-        'COS_Month_TY': "category='Cost of Sales' AND `offset`=0",
-        'COS_Month_LY': "category='Cost of Sales' AND `offset`=-12",
-        'COS_Last_3_Months_TY': "category='Cost of Sales' AND `offset`>=-2 AND `offset`<=0",
-        'COS_Last_3_Months_LY': "category='Cost of Sales' AND `offset`>=-14 AND `offset`<=-12",
-        'COS_Last_6_Months_TY': "category='Cost of Sales' AND `offset`>=-5 AND `offset`<=0",
-        'COS_Last_6_Months_LY': "category='Cost of Sales' AND `offset`>=-17 AND `offset`<=-12", 
-        'COS_Last_9_Months_TY': "category='Cost of Sales' AND `offset`>=-8 AND `offset`<=0",
-        'COS_Last_9_Months_LY': "category='Cost of Sales' AND `offset`>=-20 AND `offset`<=-12",
-        'COS_Last_12_Months_TY': "category='Cost of Sales' AND `offset`>=-11 AND `offset`<=0",
-        'COS_Last_12_Months_LY': "category='Cost of Sales' AND `offset`>=-23 AND `offset`<=-12",
-
-        'Overheads_Month_TY': "category='Overheads' AND `offset`=0",
-        'Overheads_Month_LY': "category='Overheads' AND `offset`=-12",
-        'Overheads_Last_3_Months_TY': "category='Overheads' AND `offset`>=-2 AND `offset`<=0",
-        'Overheads_Last_3_Months_LY': "category='Overheads' AND `offset`>=-14 AND `offset`<=-12",
-        'Overheads_Last_6_Months_TY': "category='Overheads' AND `offset`>=-5 AND `offset`<=0",
-        'Overheads_Last_6_Months_LY': "category='Overheads' AND `offset`>=-17 AND `offset`<=-12",
-        'Overheads_Last_9_Months_TY': "category='Overheads' AND `offset`>=-8 AND `offset`<=0",
-        'Overheads_Last_9_Months_LY': "category='Overheads' AND `offset`>=-20 AND `offset`<=-12",
-        'Overheads_Last_12_Months_TY': "category='Overheads' AND `offset`>=-11 AND `offset`<=0",
-        'Overheads_Last_12_Months_LY': "category='Overheads' AND `offset`>=-23 AND `offset`<=-12",
-
-        'Net_Worth_Current_Month_TY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=0",
-        'Net_Worth_Current_Month_-1_TY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-1",
-        'Net_Worth_Current_Month_-2_TY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-2",
-        'Net_Worth_Current_Month_-3_TY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-3",
-        'Net_Worth_Current_Month_-4_TY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-4",
-        'Net_Worth_Current_Month_-5_TY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-5",
-        'Net_Worth_Current_Month_-6_TY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-6",
-        'Net_Worth_Current_Month_-7_TY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-7",
-        'Net_Worth_Current_Month_-8_TY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-8",
-        'Net_Worth_Current_Month_-9_TY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-9",
-        'Net_Worth_Current_Month_-10_TY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-10",
-        'Net_Worth_Current_Month_-11_TY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-11",
-
-        'Net_Worth_Current_Month_LY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-12",
-        'Net_Worth_Current_Month_-1_LY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-13",
-        'Net_Worth_Current_Month_-2_LY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-14",
-        'Net_Worth_Current_Month_-3_LY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-15",
-        'Net_Worth_Current_Month_-4_LY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-16",
-        'Net_Worth_Current_Month_-5_LY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-17",
-        'Net_Worth_Current_Month_-6_LY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-18",
-        'Net_Worth_Current_Month_-7_LY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-19",
-        'Net_Worth_Current_Month_-8_LY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-20",
-        'Net_Worth_Current_Month_-9_LY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-21",
-        'Net_Worth_Current_Month_-10_LY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-22",
-        'Net_Worth_Current_Month_-11_LY': "category IN ('Fixed assets', 'Current assets', 'Current liabilities', 'Long term liabilities') AND `offset`<=-23",
-
-        # Rolling 12 month Profit for the previous 13 months.
-        'chart_profit_month-0': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-1 AND `offset`<=0",
-        'chart_profit_month-1': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-2 AND `offset`<=-1",
-        'chart_profit_month-2': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-3 AND `offset`<=-2",
-        'chart_profit_month-3': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-4 AND `offset`<=-3",
-        'chart_profit_month-4': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-5 AND `offset`<=-4",
-        'chart_profit_month-5': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-6 AND `offset`<=-5",
-        'chart_profit_month-6': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-7 AND `offset`<=-6",
-        'chart_profit_month-7': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-8 AND `offset`<=-7",
-        'chart_profit_month-8': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-9 AND `offset`<=-8",
-        'chart_profit_month-9': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-10 AND `offset`<=-9",
-        'chart_profit_month-10': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-11 AND `offset`<=-10",
-        'chart_profit_month-11': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-12 AND `offset`<=-11",
-        'chart_profit_month-12': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-13 AND `offset`<=-12",
-        'chart_profit_month-13': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-14 AND `offset`<=-13",
-        'chart_profit_month-14': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-15 AND `offset`<=-14",
-        'chart_profit_month-15': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-16 AND `offset`<=-15",
-        'chart_profit_month-16': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-17 AND `offset`<=-16",
-        'chart_profit_month-17': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-18 AND `offset`<=-17",
-        'chart_profit_month-18': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-19 AND `offset`<=-18",
-        'chart_profit_month-19': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-20 AND `offset`<=-19",
-        'chart_profit_month-20': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-21 AND `offset`<=-20",
-        'chart_profit_month-21': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-22 AND `offset`<=-21",
-        'chart_profit_month-22': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-23 AND `offset`<=-22",
-        'chart_profit_month-23': "category IN ('Sales', 'Cost of Sales', 'Overheads') AND `offset`>-24 AND `offset`<=-23",
+def get_offset_clauses(use_month_buckets=False, as_of=None):
+    # SQL fragments for a transaction's offset: 'offset' to select or group
+    # on, 'offset_join' for what it needs, and 'offset_origin', the month
+    # bucket offset 0 falls in, or None when the stored transaction.offset is
+    # read. An as_of date reports as if it were every client's accounting
+    # date, which needs month buckets.
+    if as_of is not None:
+        origin=str(as_of.year*12+as_of.month-1)
+        return {'offset': f"(transaction.month_bucket-{origin})", 'offset_join': '', 'offset_origin': origin}
+    if use_month_buckets:
+        return {
+            'offset': f"(transaction.month_bucket-{CLIENT_MONTH_BUCKET})",
+            'offset_join': CLIENT_MONTH_BUCKET_JOIN,
+            'offset_origin': CLIENT_MONTH_BUCKET,
+        }
+    return {'offset': 'transaction.offset', 'offset_join': '', 'offset_origin': None}
+
+def get_account_clauses(use_account_flags=False, use_month_buckets=False, as_of=None):
+    # SQL fragments for the account join and the account based filters. By
+    # default they are the LIKE chains on vfd_client_account; with
+    # use_account_flags they test the vfd_client_account_class flags kept up
+    # to date by classify_accounts() instead. The get_offset_clauses()
+    # fragments travel with them.
+    categories=', '.join(f"'{category}'" for category in NOMINAL_NAME_EXCLUDE_CATEGORIES)
+    offset_clauses=get_offset_clauses(use_month_buckets, as_of)
+    if use_account_flags:
+        return {
+            'account_join': "LEFT JOIN vfd_client_account_class account_class ON (account_class.account_id=transaction.account_id)",
+            'nominal_name_exclude': f"(account_class.excluded_nominal=0 OR category NOT IN ({categories}))",
+            'nominal_type_exclude': "account_class.is_other_income=0",
+            'accounts_receivable': "account_class.is_receivable=1",
+            'accounts_payable': "account_class.is_payable=1",
+            'cash': "account_class.is_cash=1",
+            **offset_clauses,
+        }
+
+    name_clause=' AND '.join(f"account.name NOT LIKE '{pattern}'" for pattern in NOMINAL_NAME_EXCLUDE_PATTERNS)
+    cash_clause=' OR '.join(
+        [f"account.type LIKE '{pattern}'" for pattern in CASH_ACCOUNT_TYPE_PATTERNS]+
+        [f"account.name LIKE '{pattern}'" for pattern in CASH_ACCOUNT_NAME_PATTERNS])
+    account_clauses={
+        'account_join': "LEFT JOIN vfd_client_account account ON (account.id=transaction.account_id)",
+        'nominal_name_exclude': f"(({name_clause}) OR (category NOT IN ({categories})))",
+        'nominal_type_exclude': f"account.type NOT LIKE '{NOMINAL_TYPE_EXCLUDE_PATTERN}'",
+        'cash': f"({cash_clause})",
+        **offset_clauses,
     }
+    for pr, account_type in ACCOUNT_TYPES.items():
+        account_name_clause=''
+        for account_name in ACCOUNT_NAMES[pr]:
+            account_name_clause+=f" OR account.name LIKE '{account_name}'"
+        account_clauses[pr]=f"account.name NOT LIKE '{ACCOUNT_NAME_EXCLUDE_PATTERN}' AND (account.type='{account_type}'{account_name_clause})"
+    return account_clauses
+
+def fold_account_text(value):
+    # Case and accent folding, to compare the way MySQL's _ai_ci collations do.
+    decomposed=unicodedata.normalize('NFKD', value)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+@lru_cache(maxsize=None)
+def like_pattern_regex(pattern):
+    regex=''
+    for c in fold_account_text(pattern):
+        if c=='%':
+            regex+='.*'
+        elif c=='_':
+            regex+='.'
+        else:
+            regex+=re.escape(c)
+    return re.compile(regex, re.DOTALL)
+
+def like_any(value, patterns):
+    # account.name LIKE p1 OR account.name LIKE p2 ...; NULL never matches.
+    if value is None:
+        return False
+    folded=fold_account_text(value)
+    return any(like_pattern_regex(pattern).fullmatch(folded) for pattern in patterns)
+
+def classify_account(account_name, account_type):
+    # The flags mirror the LIKE chains in get_account_clauses(), including
+    # their NULL behaviour: excluded_nominal and is_other_income stay NULL when
+    # the name or type is NULL, so "flag=0" drops the row just as "NOT LIKE"
+    # did.
+    flags={
+        'excluded_nominal': None if account_name is None else like_any(account_name, NOMINAL_NAME_EXCLUDE_PATTERNS),
+        'is_other_income': None if account_type is None else like_any(account_type, [NOMINAL_TYPE_EXCLUDE_PATTERN]),
+        'is_cash': like_any(account_type, CASH_ACCOUNT_TYPE_PATTERNS) or like_any(account_name, CASH_ACCOUNT_NAME_PATTERNS),
+    }
+    for pr, pr_type in ACCOUNT_TYPES.items():
+        flags[f'is_{pr[len("accounts_"):]}']= \
+            account_name is not None and \
+            not like_any(account_name, [ACCOUNT_NAME_EXCLUDE_PATTERN]) and \
+            ((account_type is not None and fold_account_text(account_type)==fold_account_text(pr_type)) or \
+             like_any(account_name, ACCOUNT_NAMES[pr]))
+    return flags
+
+def classify_accounts(
+    connection,
+    client_id):
+    # Tag the client's vfd_client_account rows in vfd_client_account_class.
+    # Only accounts that are new, or whose name or type changed since they were
+    # last classified, are evaluated; returns how many rows were (re)tagged.
+    cursor=connection.cursor(dictionary=True)
+    sql=f" \
+        SELECT \
+            account.id AS account_id, \
+            account.name AS account_name, \
+            account.type AS account_type \
+        FROM \
+            vfd_client_account account \
+            LEFT JOIN vfd_client_account_class account_class ON (account_class.account_id=account.id) \
+        WHERE \
+            account.client_id={client_id} AND ( \
+                account_class.account_id IS NULL OR \
+                NOT (account_class.account_name <=> account.name) OR \
+                NOT (account_class.account_type <=> account.type) \
+            )"
+    cursor.execute(sql)
+    rows=[]
+    for account in cursor.fetchall():
+        flags=classify_account(account['account_name'], account['account_type'])
+        rows.append((
+            account['account_id'],
+            client_id,
+            account['account_name'],
+            account['account_type'],
+            flags['excluded_nominal'],
+            flags['is_other_income'],
+            flags['is_receivable'],
+            flags['is_payable'],
+            flags['is_cash']))
+    if rows:
+        cursor.executemany(" \
+            INSERT INTO vfd_client_account_class \
+                (account_id, client_id, account_name, account_type, excluded_nominal, is_other_income, is_receivable, is_payable, is_cash, classified_at) \
+            VALUES \
+                (%s, %s, %s, %s, %s, %s, %s, %s, %s, UTC_TIMESTAMP()) \
+            ON DUPLICATE KEY UPDATE \
+                client_id=VALUES(client_id), \
+                account_name=VALUES(account_name), \
+                account_type=VALUES(account_type), \
+                excluded_nominal=VALUES(excluded_nominal), \
+                is_other_income=VALUES(is_other_income), \
+                is_receivable=VALUES(is_receivable), \
+                is_payable=VALUES(is_payable), \
+                is_cash=VALUES(is_cash), \
+                classified_at=VALUES(classified_at)", rows)
+        connection.commit()
+    cursor.close()
+    return len(rows)
+
+def sql_id_list(ids):
+    # "1, 2, 3" for an IN (...) list; ids are forced to int before they reach
+    # the SQL text.
+    return ', '.join(str(int(value)) for value in ids)
+
+def iter_chunks(ids, chunk_size):
+    for i in range(0, len(ids), chunk_size):
+        yield ids[i:i+chunk_size]
+
+# Server side prepared statements, {connection: {sql: prepared cursor}}. The
+# per_metric engine sends the same statement texts for every client, so each
+# is parsed and planned once per connection and then only executed.
+prepared_statements=weakref.WeakKeyDictionary()
+
+def fetch_all(
+    cursor,
+    sql,
+    params=None,
+    profile=None,
+    label=None,
+    client_ids=()):
+    # cursor.execute() and fetchall(), recorded in profile (see
+    # vfd_collect_report_profile) under label when one is given.
+    if profile is None:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+    def run():
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+    return run_profiled_query(profile, cursor, label, client_ids, sql, params, run)
+
+def fetch_iter(
+    cursor,
+    sql,
+    params=None,
+    profile=None,
+    label=None,
+    client_ids=(),
+    batch_size=STREAM_BATCH_SIZE):
+    # Rows of sql, fetched batch_size at a time from the connection's
+    # unbuffered cursor so large results are never held in full. The cursor
+    # cannot run anything else until the rows are exhausted. A profile that
+    # counts rows examined or keeps EXPLAIN plans needs the connection free,
+    # so its queries are buffered by fetch_all() instead; any other profile
+    # records the time spent executing and fetching, not consuming, the rows.
+    if needs_buffering(profile):
+        yield from fetch_all(cursor, sql, params, profile, label, client_ids)
+        return
+    seconds=0.0
+    count=0
+    try:
+        started=time.perf_counter()
+        cursor.execute(sql, params)
+        for rows in iter_batches(cursor, batch_size):
+            seconds+=time.perf_counter()-started
+            count+=len(rows)
+            yield from rows
+            started=time.perf_counter()
+        seconds+=time.perf_counter()-started
+    finally:
+        if profile is not None:
+            record_query(profile, label, client_ids, seconds, count)
+
+def fetch_prepared_all(
+    connection,
+    sql,
+    params,
+    profile=None,
+    label=None):
+    statements=prepared_statements.setdefault(connection, {})
+    cursor=statements.get(sql)
+    if cursor is None:
+        cursor=connection.cursor(prepared=True, dictionary=True)
+        statements[sql]=cursor
+    if profile is None:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+    def run():
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+    status_cursor=connection.cursor(dictionary=True)
+    try:
+        return run_profiled_query(profile, status_cursor, label, params[:1], sql, params, run)
+    finally:
+        status_cursor.close()
+
+def fetch_prepared_one(
+    connection,
+    sql,
+    params,
+    profile=None,
+    label=None):
+    rows=fetch_prepared_all(connection, sql, params, profile, label)
+    return rows[0] if rows else None
+
+def close_prepared_statements(connection):
+    # Deallocate the connection's statements; call before closing it.
+    for cursor in prepared_statements.pop(connection, {}).values():
+        try:
+            cursor.close()
+        except Exception:
+            pass
+
+def sql_string_list(values):
+    return ', '.join(f"'{value}'" for value in values)
+
+def metric_joins(base, account_clauses):
+    joins=[
+        account_clauses['account_join'] if join=='account' else METRIC_JOINS[join]
+        for join in METRIC_BASES[base]['joins']
+    ]
+    if account_clauses['offset_join']:
+        joins.append(account_clauses['offset_join'])
+    return ' '.join(joins)
+
+def metric_base_filter(base, account_clauses):
+    base_filter=METRIC_BASES[base]['filter']
+    if base_filter is None:
+        return None
+    return base_filter.format(ptype=PTYPE_NUM_TRANS_EXCLUDE, **account_clauses)
+
+def metric_exclusion_clause(exclusions, account_clauses):
+    return ' AND '.join(account_clauses[exclusion] for exclusion in exclusions)
+
+def offset_range_terms(table, first_offset, last_offset, account_clauses):
+    # Bounds on a row's offset. Transactions read by month bucket compare
+    # month_bucket itself against the shifted origin, so that the bounds stay
+    # an index range.
+    if table=='transaction' and account_clauses['offset_origin'] is not None:
+        column='transaction.month_bucket'
+        origin=account_clauses['offset_origin']
+        bound=lambda offset: f"{origin}{offset:+d}"
+    else:
+        column=f"{table}.offset"
+        bound=str
+    terms=[]
+    if first_offset is not None:
+        terms.append(f"{column}>={bound(first_offset)}")
+    if last_offset is not None:
+        terms.append(f"{column}<={bound(last_offset)}")
+    return terms
+
+def metric_window_terms(definition, table, account_clauses):
+    terms=[]
+    if definition.categories is not None:
+        terms.append(f"{table}.category IN ({sql_string_list(definition.categories)})")
+    terms+=offset_range_terms(table, definition.first_offset, definition.last_offset, account_clauses)
+    return terms
+
+def metric_contact_terms(definition):
+    return [
+        f"contact.{column}!=0" if nonzero else f"contact.{column}=0"
+        for column, nonzero in definition.contact_flags
+    ]
+
+def metric_value(definition, value):
+    # The fetched total as reported: NULL becomes the aggregation's empty
+    # value, and negated metrics have their sign flipped.
+    if value is None:
+        return METRIC_AGGREGATIONS[definition.aggregation][2]
+    if definition.negate:
+        return -1*value
+    return value
+
+def get_metric_sql(
+    definition,
+    account_clauses):
+    # The stand-alone query for one metric, as run by the per_metric engine
+    # with the client id as its one parameter.
+    template, value, _=METRIC_AGGREGATIONS[definition.aggregation]
+    terms=["transaction.client_id=%s"]
+    base_filter=metric_base_filter(definition.base, account_clauses)
+    if base_filter is not None:
+        terms.append(base_filter)
+    terms+=metric_window_terms(definition, 'transaction', account_clauses)
+    if definition.exclusions:
+        terms.append(metric_exclusion_clause(definition.exclusions, account_clauses))
+    terms+=metric_contact_terms(definition)
+    if definition.condition is not None:
+        terms.append(definition.condition)
+    return f" \
+        SELECT \
+            {template.format(value=value)} AS metric_value \
+        FROM \
+            client_transaction transaction \
+            {metric_joins(definition.base, account_clauses)} \
+        WHERE \
+            {' AND '.join(terms)}"
+
+@lru_cache(maxsize=None)
+def get_metric_statements(use_account_flags=False, use_month_buckets=False, as_of=None):
+    # ((definition, sql), ...) for every metric, built once per process.
+    # Running balances and contact counts keep their own stand-alone queries
+    # too, so that per_metric stays an independent reference for the planned
+    # queries of the set based engines.
+    account_clauses=get_account_clauses(use_account_flags, use_month_buckets, as_of)
+    return tuple(
+        (definition, get_metric_sql(definition, account_clauses))
+        for definition in METRICS
+    )
 
-    metric_values={}
-    
-    connection = mysql.connector.connect(**config)
-    cursor = connection.cursor(dictionary=True)
-
-    for metric_name, where_clause in metric_definitions.items():
-        #sql=f'SELECT SUM(net_amount) AS metric_value FROM `client_transaction` WHERE client_id={client_id} AND {where_clause}'
-        sql=f" \
+def plan_metric_queries(definitions=METRICS):
+    # [(base, definitions)]: one compiled query per base, in the order the
+    # bases are first used.
+    plan={}
+    for definition in definitions:
+        if definition.base not in METRIC_BASES:
+            raise ValueError(f"Unknown metric base for {definition.name}: {definition.base}")
+        if definition.aggregation not in METRIC_AGGREGATIONS:
+            raise ValueError(f"Unknown metric aggregation for {definition.name}: {definition.aggregation}")
+        metric_plan=METRIC_BASES[definition.base]['plan']
+        if metric_plan in ('buckets', 'running') and (definition.aggregation!='sum' or definition.condition is not None or definition.contact_flags):
+            raise ValueError(f"Metric {definition.name} cannot be answered from {metric_plan} base {definition.base}")
+        if metric_plan=='contacts' and (definition.aggregation!='count_contacts' or definition.condition is not None):
+            raise ValueError(f"Metric {definition.name} cannot be answered from {metric_plan} base {definition.base}")
+        if metric_plan=='running' and (definition.first_offset is not None or definition.last_offset is None):
+            raise ValueError(f"Metric {definition.name} is not a running balance")
+        plan.setdefault(definition.base, []).append(definition)
+    return list(plan.items())
+
+def get_shared_window_terms(definitions, table, account_clauses):
+    # Filter terms every metric in the query satisfies: the union of their
+    # categories and the widest offset bounds, where all of them have one.
+    terms=[]
+    if all(definition.categories is not None for definition in definitions):
+        categories=list(dict.fromkeys(category for definition in definitions for category in definition.categories))
+        terms.append(f"{table}.category IN ({sql_string_list(categories)})")
+    first_offset=None
+    last_offset=None
+    if all(definition.first_offset is not None for definition in definitions):
+        first_offset=min(definition.first_offset for definition in definitions)
+    if all(definition.last_offset is not None for definition in definitions):
+        last_offset=max(definition.last_offset for definition in definitions)
+    terms+=offset_range_terms(table, first_offset, last_offset, account_clauses)
+    return terms
+
+def get_exclusion_sets(definitions):
+    return list(dict.fromkeys(definition.exclusions for definition in definitions))
+
+def get_bucket_columns(exclusion_sets, account_clauses):
+    # One net_amount total per exclusion set, x{j} for exclusion_sets[j].
+    bucket_columns=[]
+    for j, exclusions in enumerate(exclusion_sets):
+        if exclusions:
+            bucket_columns.append(f"SUM(CASE WHEN {metric_exclusion_clause(exclusions, account_clauses)} THEN transaction.net_amount END) AS x{j}")
+        else:
+            bucket_columns.append(f"SUM(transaction.net_amount) AS x{j}")
+    return bucket_columns
+
+def compile_metric_query(
+    base,
+    definitions,
+    client_ids,
+    account_clauses):
+    # One query returning a row per client with column m{i} holding
+    # definitions[i]. A 'buckets' base first totals the transactions by
+    # client, category and offset, one column per distinct exclusion set, and
+    # every metric then sums the buckets in its window. A 'rows' base
+    # aggregates the transactions directly, each metric through its own CASE.
+    terms=[f"transaction.client_id IN ({sql_id_list(client_ids)})"]
+    base_filter=metric_base_filter(base, account_clauses)
+    if base_filter is not None:
+        terms.append(base_filter)
+    terms+=get_shared_window_terms(definitions, 'transaction', account_clauses)
+
+    if METRIC_BASES[base]['plan']=='rows':
+        columns=[]
+        for i, definition in enumerate(definitions):
+            template, value, _=METRIC_AGGREGATIONS[definition.aggregation]
+            condition=metric_window_terms(definition, 'transaction', account_clauses)
+            if definition.exclusions:
+                condition.append(metric_exclusion_clause(definition.exclusions, account_clauses))
+            condition+=metric_contact_terms(definition)
+            if definition.condition is not None:
+                condition.append(definition.condition)
+            if condition:
+                value=f"CASE WHEN {' AND '.join(condition)} THEN {value} END"
+            columns.append(f"{template.format(value=value)} AS m{i}")
+        return f" \
             SELECT \
-                SUM(transaction.net_amount) AS metric_value \
+                transaction.client_id AS client_id, \
+                {', '.join(columns)} \
             FROM \
                 client_transaction transaction \
-                LEFT JOIN vfd_client_account account ON (account.id=transaction.account_id) \
+                {metric_joins(base, account_clauses)} \
             WHERE \
-                transaction.client_id={client_id} AND \
-                {where_clause} AND \
-                {nominal_name_exclude} AND \
-                {nominal_type_exclude}"
-        # //Faezeh
-        print("RUNNING QUERY FOR:", metric_name)
-        print("CLIENT ID =", client_id)
-        print("SQL =", sql)
-
-        cursor.execute(sql)
-        row=cursor.fetchone()
-        if 'COS' in metric_name or \
-           'Overheads' in metric_name or \
-           'Net_Worth' in metric_name or \
-           'chart_overheads' in metric_name or \
-           'chart_cost_of_sales_month' in metric_name or \
-           'chart_assets' in metric_name or \
-           'chart_liabilities' in metric_name:
-            if row['metric_value'] is not None:
-                metric_values[metric_name]=-1*row['metric_value']
-            else:
-                metric_values[metric_name]=Decimal(0.0)
-        else:
-            if row['metric_value'] is not None:
-                metric_values[metric_name]=row['metric_value']
-            else:
-                metric_values[metric_name]=Decimal(0.0)
-
-    #sql=f" \
-    #    SELECT \
-    #        MIN(transaction.offset) AS metric_value \
-    #    FROM \
-    #        client_transaction transaction \
-    #        LEFT JOIN vfd_client_account account ON (account.id=transaction.account_id) \
-    #    WHERE \
-    #        transaction.client_id={client_id} AND \
-    #        transaction.category='Sales' AND \
-    #        {nominal_name_exclude} AND \
-    #        {nominal_type_exclude}"
-    #cursor.execute(sql)
-    #row=cursor.fetchone()
-    #metric_values['chart_minimum_rolling_offset_sales']=row['metric_value']
-
-    # Income (not just sales).
-
-    metric_definitions={
-        # Rolling 12 month Revenue for the previous 13 months. Grr!
-        'chart_revenue_month-0': "category='Sales' AND `offset`>=-11 AND `offset`<=0",
-        'chart_revenue_month-1': "category='Sales' AND `offset`>=-12 AND `offset`<=-1",
-        'chart_revenue_month-2': "category='Sales' AND `offset`>=-13 AND `offset`<=-2",
-        'chart_revenue_month-3': "category='Sales' AND `offset`>=-14 AND `offset`<=-3",
-        'chart_revenue_month-4': "category='Sales' AND `offset`>=-15 AND `offset`<=-4",
-        'chart_revenue_month-5': "category='Sales' AND `offset`>=-16 AND `offset`<=-5",
-        'chart_revenue_month-6': "category='Sales' AND `offset`>=-17 AND `offset`<=-6",
-        'chart_revenue_month-7': "category='Sales' AND `offset`>=-18 AND `offset`<=-7",
-        'chart_revenue_month-8': "category='Sales' AND `offset`>=-19 AND `offset`<=-8",
-        'chart_revenue_month-9': "category='Sales' AND `offset`>=-20 AND `offset`<=-9",
-        'chart_revenue_month-10': "category='Sales' AND `offset`>=-21 AND `offset`<=-10",
-        'chart_revenue_month-11': "category='Sales' AND `offset`>=-22 AND `offset`<=-11",
-        'chart_revenue_month-12': "category='Sales' AND `offset`>=-23 AND `offset`<=-12",
-
-        # Moved this lot to here. Grr!
-        'Sales_Month_TY': "category='Sales' AND `offset`=0",
-        'Sales_Month_LY': "category='Sales' AND `offset`=-12",
-        'Sales_Last_3_Months_TY': "category='Sales' AND `offset`>=-2 AND `offset`<=0",
-        'Sales_Last_3_Months_LY': "category='Sales' AND `offset`>=-14 AND `offset`<=-12",
-        'Sales_Last_6_Months_TY': "category='Sales' AND `offset`>=-5 AND `offset`<=0",
-        'Sales_Last_6_Months_LY': "category='Sales' AND `offset`>=-17 AND `offset`<=-12",
-        'Sales_Last_9_Months_TY': "category='Sales' AND `offset`>=-8 AND `offset`<=0",
-        'Sales_Last_9_Months_LY': "category='Sales' AND `offset`>=-20 AND `offset`<=-12",
-        'Sales_Last_12_Months_TY': "category='Sales' AND `offset`>=-11 AND `offset`<=0",
-        'Sales_Last_12_Months_LY': "category='Sales' AND `offset`>=-23 AND `offset`<=-12",
-
-        # Rolling 12 month Income for the previous 13 months (to ultimately calculate Net Profit).
-        'chart_income_month-0': "category='Sales' AND `offset`>=-11 AND `offset`<=0",
-        'chart_income_month-1': "category='Sales' AND `offset`>=-12 AND `offset`<=-1",
-        'chart_income_month-2': "category='Sales' AND `offset`>=-13 AND `offset`<=-2",
-        'chart_income_month-3': "category='Sales' AND `offset`>=-14 AND `offset`<=-3",
-        'chart_income_month-4': "category='Sales' AND `offset`>=-15 AND `offset`<=-4",
-        'chart_income_month-5': "category='Sales' AND `offset`>=-16 AND `offset`<=-5",
-        'chart_income_month-6': "category='Sales' AND `offset`>=-17 AND `offset`<=-6",
-        'chart_income_month-7': "category='Sales' AND `offset`>=-18 AND `offset`<=-7",
-        'chart_income_month-8': "category='Sales' AND `offset`>=-19 AND `offset`<=-8",
-        'chart_income_month-9': "category='Sales' AND `offset`>=-20 AND `offset`<=-9",
-        'chart_income_month-10': "category='Sales' AND `offset`>=-21 AND `offset`<=-10",
-        'chart_income_month-11': "category='Sales' AND `offset`>=-22 AND `offset`<=-11",
-        'chart_income_month-12': "category='Sales' AND `offset`>=-23 AND `offset`<=-12",
-
-        # Use this in preference to Revenue for EBITDA section used to be Revenue section()
-        'Income_Month_TY': "category='Sales' AND `offset`=0",
-        'Income_Month_LY': "category='Sales' AND `offset`=-12",
-        'Income_Last_3_Months_TY': "category='Sales' AND `offset`>=-2 AND `offset`<=0",
-        'Income_Last_3_Months_LY': "category='Sales' AND `offset`>=-14 AND `offset`<=-12",
-        'Income_Last_6_Months_TY': "category='Sales' AND `offset`>=-5 AND `offset`<=0",
-        'Income_Last_6_Months_LY': "category='Sales' AND `offset`>=-17 AND `offset`<=-12",
-        'Income_Last_9_Months_TY': "category='Sales' AND `offset`>=-8 AND `offset`<=0",
-        'Income_Last_9_Months_LY': "category='Sales' AND `offset`>=-20 AND `offset`<=-12",
-        'Income_Last_12_Months_TY': "category='Sales' AND `offset`>=-11 AND `offset`<=0",
-        'Income_Last_12_Months_LY': "category='Sales' AND `offset`>=-23 AND `offset`<=-12",
-    }
-
-    for metric_name, where_clause in metric_definitions.items():
-        sql=f" \
+                {' AND '.join(terms)} \
+            GROUP BY \
+                transaction.client_id"
+
+    exclusion_sets=get_exclusion_sets(definitions)
+    bucket_columns=get_bucket_columns(exclusion_sets, account_clauses)
+    columns=[]
+    for i, definition in enumerate(definitions):
+        j=exclusion_sets.index(definition.exclusions)
+        condition=metric_window_terms(definition, 'bucket', account_clauses)
+        value=f"CASE WHEN {' AND '.join(condition)} THEN bucket.x{j} END" if condition else f"bucket.x{j}"
+        columns.append(f"SUM({value}) AS m{i}")
+    return f" \
+        SELECT \
+            bucket.client_id AS client_id, \
+            {', '.join(columns)} \
+        FROM ( \
             SELECT \
-                SUM(transaction.net_amount) AS metric_value \
+                transaction.client_id AS client_id, \
+                transaction.category AS category, \
+                {account_clauses['offset']} AS `offset`, \
+                {', '.join(bucket_columns)} \
             FROM \
                 client_transaction transaction \
-                LEFT JOIN vfd_client_account account ON (account.id=transaction.account_id) \
+                {metric_joins(base, account_clauses)} \
             WHERE \
-                transaction.client_id={client_id} AND \
-                {where_clause} AND \
-                {nominal_name_exclude}"
-        # //Faezeh
-        print("📌 CHECKING vfd_client FOR ID:", client_id)
-        print("SQL =", sql)
- 
-        cursor.execute(sql)
-        row=cursor.fetchone()
-
-        if row['metric_value'] is not None:
-            metric_values[metric_name]=row['metric_value']
-        else:
-            metric_values[metric_name]=Decimal(0.0)
-
-
-    # Rolling offset sales
-    sql=f" \
+                {' AND '.join(terms)} \
+            GROUP BY \
+                transaction.client_id, \
+                transaction.category, \
+                {account_clauses['offset']} \
+        ) bucket \
+        GROUP BY \
+            bucket.client_id"
+
+def compile_running_balance_query(
+    base,
+    definitions,
+    client_ids,
+    account_clauses):
+    # Movements by client, category and offset, one column per exclusion set.
+    # Offsets before the earliest balance asked for are folded into one
+    # opening row, so a long history still returns few rows.
+    terms=[f"transaction.client_id IN ({sql_id_list(client_ids)})"]
+    base_filter=metric_base_filter(base, account_clauses)
+    if base_filter is not None:
+        terms.append(base_filter)
+    terms+=get_shared_window_terms(definitions, 'transaction', account_clauses)
+    opening_offset=min(definition.last_offset for definition in definitions)
+    return f" \
         SELECT \
-            MIN(transaction.offset) AS metric_value \
+            transaction.client_id AS client_id, \
+            transaction.category AS category, \
+            GREATEST({account_clauses['offset']}, {opening_offset}) AS bucket_offset, \
+            {', '.join(get_bucket_columns(get_exclusion_sets(definitions), account_clauses))} \
         FROM \
             client_transaction transaction \
-            LEFT JOIN vfd_client_account account ON (account.id=transaction.account_id) \
+            {metric_joins(base, account_clauses)} \
         WHERE \
-            transaction.client_id={client_id} AND \
-            transaction.category='Sales'"
-            # AND \
-            #{nominal_name_exclude} AND \
-            #{nominal_type_exclude}"
-    cursor.execute(sql)
-    row=cursor.fetchone()
-    metric_values['chart_minimum_rolling_offset_sales']=row['metric_value']
-
-
-
-
+            {' AND '.join(terms)} \
+        GROUP BY \
+            transaction.client_id, \
+            transaction.category, \
+            bucket_offset"
+
+def get_running_balance_metrics(
+    rows,
+    client_ids,
+    definitions):
+    # Fan compile_running_balance_query() rows out to the definitions: each
+    # balance is the running total of its categories' movements up to its
+    # last offset.
+    exclusion_sets=get_exclusion_sets(definitions)
+    opening_offset=min(definition.last_offset for definition in definitions)
+    months=max(definition.last_offset for definition in definitions)-opening_offset+1
+    movements={client_id: {} for client_id in client_ids}
+    for row in rows:
+        for j, exclusions in enumerate(exclusion_sets):
+            if row[f'x{j}'] is None:
+                continue
+            series=movements[row['client_id']].setdefault((exclusions, row['category']), [Decimal(0)]*months)
+            series[row['bucket_offset']-opening_offset]+=row[f'x{j}']
+
+    client_metric_values={}
+    for client_id, client_movements in movements.items():
+        balances={key: list(accumulate(series)) for key, series in client_movements.items()}
+        metric_values={}
+        for definition in definitions:
+            value=None
+            for category in definition.categories:
+                balance=balances.get((definition.exclusions, category))
+                if balance is not None:
+                    value=(value or Decimal(0))+balance[definition.last_offset-opening_offset]
+            metric_values[definition.name]=metric_value(definition, value)
+        client_metric_values[client_id]=metric_values
+    return client_metric_values
+
+def get_contact_windows(definitions, account_clauses):
+    # The distinct transaction conditions of the definitions; bit k of a
+    # contact row's windows says it has a transaction passing windows[k].
+    windows=[]
+    for definition in definitions:
+        terms=metric_window_terms(definition, 'transaction', account_clauses)
+        if definition.exclusions:
+            terms.append(metric_exclusion_clause(definition.exclusions, account_clauses))
+        if terms not in windows:
+            windows.append(terms)
+    return windows
+
+def get_contact_flag_columns(definitions):
+    return list(dict.fromkeys(column for definition in definitions for column, _ in definition.contact_flags))
+
+def compile_contact_query(
+    base,
+    definitions,
+    client_ids,
+    account_clauses):
+    # Each distinct contact name with its flags and windows as bitmasks. Flag
+    # column i sets bit 2i when non-zero and bit 2i+1 when zero, so a NULL
+    # flag matches neither, as in SQL.
+    terms=[f"transaction.client_id IN ({sql_id_list(client_ids)})"]
+    base_filter=metric_base_filter(base, account_clauses)
+    if base_filter is not None:
+        terms.append(base_filter)
+    terms+=get_shared_window_terms(definitions, 'transaction', account_clauses)
+    flags=[
+        f"CASE WHEN contact.{column}!=0 THEN {1<<2*i} WHEN contact.{column}=0 THEN {1<<2*i+1} ELSE 0 END"
+        for i, column in enumerate(get_contact_flag_columns(definitions))
+    ]
+    windows=[
+        f"CASE WHEN {' AND '.join(window)} THEN {1<<k} ELSE 0 END" if window else str(1<<k)
+        for k, window in enumerate(get_contact_windows(definitions, account_clauses))
+    ]
+    return f" \
+        SELECT DISTINCT \
+            transaction.client_id AS client_id, \
+            {METRIC_AGGREGATIONS['count_contacts'][1]} AS contact_name, \
+            {' + '.join(flags) or '0'} AS contact_flags, \
+            {' + '.join(windows)} AS contact_windows \
+        FROM \
+            client_transaction transaction \
+            {metric_joins(base, account_clauses)} \
+        WHERE \
+            {' AND '.join(terms)}"
+
+def get_contact_metrics(
+    rows,
+    client_ids,
+    definitions,
+    account_clauses):
+    # Count compile_contact_query() rows per definition: a contact name counts
+    # once when any of its rows has the definition's flags and window. Names
+    # are folded the way COUNT(DISTINCT contact.name) compares them.
+    flag_bits={column: 2*i for i, column in enumerate(get_contact_flag_columns(definitions))}
+    windows=get_contact_windows(definitions, account_clauses)
+    masks=[]
+    for definition in definitions:
+        flag_mask=sum(1<<(flag_bits[column]+(0 if nonzero else 1)) for column, nonzero in definition.contact_flags)
+        window_bit=1<<windows.index(get_contact_windows([definition], account_clauses)[0])
+        masks.append((definition, flag_mask, window_bit))
+
+    contacts={client_id: {} for client_id in client_ids}
+    for row in rows:
+        if row['contact_name'] is None:
+            continue
+        contact=contacts[row['client_id']].setdefault(fold_account_text(row['contact_name']), {})
+        contact[row['contact_flags']]=contact.get(row['contact_flags'], 0) | row['contact_windows']
+
+    client_metric_values={}
+    for client_id, client_contacts in contacts.items():
+        client_metric_values[client_id]={
+            definition.name: sum(
+                1
+                for contact in client_contacts.values()
+                if any(flags & flag_mask==flag_mask and contact_windows & window_bit for flags, contact_windows in contact.items())
+            )
+            for definition, flag_mask, window_bit in masks
+        }
+    return client_metric_values
+
+def get_planned_metrics(
+    cursor,
+    client_ids,
+    account_clauses,
+    definitions=METRICS,
+    profile=None):
+    # Run the planned queries and fan their columns back out to
+    # {client_id: {metric_name: value}}, in definition order.
+    fetched={client_id: {} for client_id in client_ids}
+    for base, base_definitions in plan_metric_queries(definitions):
+        if METRIC_BASES[base]['plan']=='running':
+            sql=compile_running_balance_query(base, base_definitions, client_ids, account_clauses)
+            rows=fetch_iter(cursor, sql, profile=profile, label=f'metric_base:{base}', client_ids=client_ids)
+            for client_id, metric_values in get_running_balance_metrics(rows, client_ids, base_definitions).items():
+                fetched[client_id].update(metric_values)
+            continue
+        if METRIC_BASES[base]['plan']=='contacts':
+            sql=compile_contact_query(base, base_definitions, client_ids, account_clauses)
+            rows=fetch_iter(cursor, sql, profile=profile, label=f'metric_base:{base}', client_ids=client_ids)
+            for client_id, metric_values in get_contact_metrics(rows, client_ids, base_definitions, account_clauses).items():
+                fetched[client_id].update(metric_values)
+            continue
+        sql=compile_metric_query(base, base_definitions, client_ids, account_clauses)
+        rows={row['client_id']: row for row in fetch_all(cursor, sql, profile=profile, label=f'metric_base:{base}', client_ids=client_ids)}
+        for client_id in client_ids:
+            row=rows.get(client_id)
+            for i, definition in enumerate(base_definitions):
+                fetched[client_id][definition.name]=metric_value(definition, row[f'm{i}'] if row is not None else None)
+    return {
+        client_id: {definition.name: metric_values[definition.name] for definition in definitions}
+        for client_id, metric_values in fetched.items()
+    }
 
-    # Revenue Drivers.
-    # ptype NOT IN ('MJ', 'CN', 'OVERPAYMENTS')
-    ptype_num_trans_exclude=" \
-        transaction.source NOT IN ('manual-journal', 'credit-note', 'overpayment') AND \
-        transaction.api_source_type_name NOT IN ('MJ', 'CN', 'OVERPAYMENTS')"
-    sql=f" \
+def is_aggregate_metric(definition):
+    # Whether the monthly aggregate can answer the metric: a plain sum over one
+    # of its exclusion variants, within the offsets it holds.
+    return METRIC_BASES[definition.base]['plan']!='rows' and \
+           METRIC_BASES[definition.base]['filter'] is None and \
+           definition.aggregation=='sum' and \
+           definition.condition is None and \
+           definition.exclusions in AGGREGATE_EXCLUSION_COLUMNS and \
+           definition.categories is not None and \
+           definition.last_offset is not None and \
+           definition.last_offset<=0 and \
+           (definition.first_offset is None or definition.first_offset>AGGREGATE_OPENING_OFFSET)
+
+def offset_bucket_clause(bucket_offsets, account_clauses):
+    # Transactions feeding the given aggregate buckets; the opening bucket
+    # holds every offset at or before AGGREGATE_OPENING_OFFSET.
+    clauses=[]
+    offsets=sorted(offset for offset in bucket_offsets if AGGREGATE_OPENING_OFFSET<offset<=0)
+    if offsets:
+        clauses.append(f"{account_clauses['offset']} IN ({sql_id_list(offsets)})")
+    if any(offset<=AGGREGATE_OPENING_OFFSET for offset in bucket_offsets):
+        clauses+=offset_range_terms('transaction', None, AGGREGATE_OPENING_OFFSET, account_clauses)
+    return f"({' OR '.join(clauses)})" if clauses else "FALSE"
+
+def refresh_monthly_aggregates(
+    connection,
+    client_ids,
+    account_clauses,
+    offsets=None):
+    # Rebuild the clients' vfd_client_monthly_aggregate rows, one per offset,
+    # category and exclusion flags. A row that fails an exclusion fragment (or
+    # evaluates it to NULL) is flagged as excluded, exactly as the fragment
+    # would drop it from a WHERE clause. With offsets, only the buckets those
+    # transaction offsets fall into are rebuilt.
+    bucket_filter=''
+    transaction_filter=''
+    if offsets is not None:
+        bucket_offsets=sorted({max(offset, AGGREGATE_OPENING_OFFSET) for offset in offsets if offset<=0})
+        if not bucket_offsets:
+            return
+        bucket_filter=f"AND `offset` IN ({sql_id_list(bucket_offsets)})"
+        transaction_filter=f"AND {offset_bucket_clause(bucket_offsets, account_clauses)}"
+
+    cursor=connection.cursor()
+    cursor.execute(f" \
+        DELETE FROM \
+            vfd_client_monthly_aggregate \
+        WHERE \
+            client_id IN ({sql_id_list(client_ids)}) \
+            {bucket_filter}")
+    cursor.execute(f" \
+        INSERT INTO vfd_client_monthly_aggregate \
+            (client_id, `offset`, category, nominal_excluded, type_excluded, net_amount, refreshed_at) \
         SELECT \
-            COUNT(*) AS metric_value \
+            transaction.client_id, \
+            GREATEST({account_clauses['offset']}, {AGGREGATE_OPENING_OFFSET}) AS bucket_offset, \
+            transaction.category AS bucket_category, \
+            CASE WHEN {account_clauses['nominal_name_exclude']} THEN 0 ELSE 1 END AS bucket_nominal_excluded, \
+            CASE WHEN {account_clauses['nominal_type_exclude']} THEN 0 ELSE 1 END AS bucket_type_excluded, \
+            COALESCE(SUM(transaction.net_amount), 0), \
+            UTC_TIMESTAMP() \
         FROM \
             client_transaction transaction \
-            LEFT JOIN vfd_client_account account ON (account.id=transaction.account_id) \
+            {account_clauses['account_join']} \
+            {account_clauses['offset_join']} \
         WHERE \
-            transaction.client_id={client_id} AND \
-            transaction.category='Sales' AND \
-            transaction.offset<=0 AND \
-            transaction.offset>=-11 AND \
-            {ptype_num_trans_exclude} AND \
-            {nominal_name_exclude} AND \
-            {nominal_type_exclude}"
-    cursor.execute(sql)
-    row=cursor.fetchone()
-    metric_values['chart_total_sales_transactions-0']=row['metric_value']
+            transaction.client_id IN ({sql_id_list(client_ids)}) AND \
+            {offset_range_terms('transaction', None, 0, account_clauses)[0]} \
+            {transaction_filter} \
+        GROUP BY \
+            transaction.client_id, \
+            bucket_offset, \
+            bucket_category, \
+            bucket_nominal_excluded, \
+            bucket_type_excluded")
+    connection.commit()
+    cursor.close()
+
+def get_monthly_aggregate_prefix_sums(
+    cursor,
+    client_ids,
+    profile=None):
+    # {client_id: {(bucket_column, category): prefix}} where prefix[i] is the
+    # running total up to and including offset i+AGGREGATE_OPENING_OFFSET.
+    sql=f" \
+        SELECT \
+            client_id, \
+            `offset`, \
+            category, \
+            nominal_excluded, \
+            type_excluded, \
+            net_amount \
+        FROM \
+            vfd_client_monthly_aggregate \
+        WHERE \
+            client_id IN ({sql_id_list(client_ids)})"
+    monthly={client_id: {} for client_id in client_ids}
+    for row in fetch_iter(cursor, sql, profile=profile, label='monthly_aggregate', client_ids=client_ids):
+        if row['nominal_excluded']:
+            continue
+        bucket_columns=('income_amount',) if row['type_excluded'] else ('amount', 'income_amount')
+        for bucket_column in bucket_columns:
+            series=monthly[row['client_id']].setdefault((bucket_column, row['category']), [Decimal(0)]*(AGGREGATE_MONTHS+1))
+            series[row['offset']-AGGREGATE_OPENING_OFFSET]+=row['net_amount']
+    return {
+        client_id: {key: list(accumulate(series)) for key, series in client_monthly.items()}
+        for client_id, client_monthly in monthly.items()
+    }
 
+def get_window_metrics_prefix_sum(
+    cursor,
+    client_ids,
+    definitions,
+    profile=None):
+    # Every window is the difference of two prefix sums, so one small fetch of
+    # the monthly aggregate answers all of the definitions, which must pass
+    # is_aggregate_metric().
+    client_metric_values={}
+    for client_id, prefix_sums in get_monthly_aggregate_prefix_sums(cursor, client_ids, profile).items():
+        metric_values={}
+        for definition in definitions:
+            bucket_column=AGGREGATE_EXCLUSION_COLUMNS[definition.exclusions]
+            value=Decimal(0.0)
+            for category in definition.categories:
+                prefix=prefix_sums.get((bucket_column, category))
+                if prefix is None:
+                    continue
+                value+=prefix[definition.last_offset-AGGREGATE_OPENING_OFFSET]
+                if definition.first_offset is not None:
+                    value-=prefix[definition.first_offset-AGGREGATE_OPENING_OFFSET-1]
+            if definition.negate and value:
+                value=-1*value
+            metric_values[definition.name]=value
+        client_metric_values[client_id]=metric_values
+    return client_metric_values
+
+def get_minimum_sales_offsets(
+    cursor,
+    client_ids,
+    account_clauses,
+    profile=None):
+    # Rolling offset sales.
     sql=f" \
         SELECT \
-            COUNT(DISTINCT(invoice.number)) AS metric_value \
+            transaction.client_id AS client_id, \
+            MIN({account_clauses['offset']}) AS metric_value \
+        FROM \
+            client_transaction transaction \
+            {account_clauses['account_join']} \
+            {account_clauses['offset_join']} \
+        WHERE \
+            transaction.client_id IN ({sql_id_list(client_ids)}) AND \
+            transaction.category='Sales' \
+        GROUP BY \
+            transaction.client_id"
+    rows={
+        row['client_id']: row['metric_value']
+        for row in fetch_all(cursor, sql, profile=profile, label='chart_minimum_rolling_offset_sales', client_ids=client_ids)
+    }
+    return {client_id: {'chart_minimum_rolling_offset_sales': rows.get(client_id)} for client_id in client_ids}
+
+def compile_revenue_driver_query(client_clause, account_clauses):
+    # Sales transaction count, distinct invoice numbers and distinct journal
+    # references for each REVENUE_DRIVER_WINDOWS window, per client.
+    invoice_clause="(transaction.source='invoice' OR (transaction.source='data' AND transaction.api_source_type_name='INV'))"
+    columns=[]
+    for offset, first_offset, last_offset in REVENUE_DRIVER_WINDOWS:
+        window_clause=' AND '.join(offset_range_terms('transaction', first_offset, last_offset, account_clauses))
+        columns+=[
+            f"COUNT(CASE WHEN {window_clause} THEN 1 END) AS `transactions{offset}`",
+            f"COUNT(DISTINCT CASE WHEN {window_clause} AND {invoice_clause} THEN invoice.number END) AS `invoices{offset}`",
+            f"COUNT(DISTINCT CASE WHEN {window_clause} AND {invoice_clause} THEN journal.reference END) AS `references{offset}`",
+        ]
+    return f" \
+        SELECT \
+            transaction.client_id AS client_id, \
+            {', '.join(columns)} \
         FROM \
             client_transaction AS transaction \
-            LEFT JOIN vfd_client_account AS account ON (account.id=transaction.account_id) \
+            {account_clauses['account_join']} \
             LEFT JOIN vfd_client_journal AS journal ON (journal.id=transaction.journal_id) \
             LEFT JOIN vfd_client_invoice AS invoice ON (invoice.id=journal.source_id) \
+            {account_clauses['offset_join']} \
         WHERE \
-            transaction.client_id={client_id} AND \
+            {client_clause} AND \
             transaction.category='Sales' AND \
-            transaction.offset<=0 AND \
-            transaction.offset>=-11 AND \
-            {ptype_num_trans_exclude} AND \
-            (transaction.source='invoice' OR (transaction.source='data' AND transaction.api_source_type_name='INV')) AND \
-            {nominal_name_exclude} AND \
-            {nominal_type_exclude}"
-    cursor.execute(sql)
-    row=cursor.fetchone()
-    if row['metric_value']>0:
-        metric_values['chart_total_sales_invoices-0']=row['metric_value']
-    else:
-        sql=f" \
-            SELECT \
-                COUNT(DISTINCT(journal.reference)) AS metric_value \
-            FROM \
-                client_transaction AS transaction \
-                LEFT JOIN vfd_client_account AS account ON (account.id=transaction.account_id) \
-                LEFT JOIN vfd_client_journal AS journal ON (journal.id=transaction.journal_id) \
-            WHERE \
-                transaction.client_id={client_id} AND \
-                transaction.category='Sales' AND \
-                transaction.offset<=0 AND \
-                transaction.offset>=-11 AND \
-                {ptype_num_trans_exclude} AND \
-                (transaction.source='invoice' OR (transaction.source='data' AND transaction.api_source_type_name='INV')) AND \
-                {nominal_name_exclude} AND \
-                {nominal_type_exclude}"
-        cursor.execute(sql)
-        row=cursor.fetchone()
-        metric_values['chart_total_sales_invoices-0']=row['metric_value']
+            {' AND '.join(offset_range_terms('transaction', min(first_offset for _, first_offset, _ in REVENUE_DRIVER_WINDOWS), max(last_offset for _, _, last_offset in REVENUE_DRIVER_WINDOWS), account_clauses))} AND \
+            {PTYPE_NUM_TRANS_EXCLUDE} AND \
+            {account_clauses['nominal_name_exclude']} AND \
+            {account_clauses['nominal_type_exclude']} \
+        GROUP BY \
+            transaction.client_id"
+
+def get_revenue_driver_values(row):
+    # Clients without invoice numbers fall back to distinct journal
+    # references. row is None for a client without Sales transactions.
+    metric_values={}
+    for offset, _, _ in REVENUE_DRIVER_WINDOWS:
+        if row is None:
+            metric_values[f'chart_total_sales_transactions{offset}']=0
+            metric_values[f'chart_total_sales_invoices{offset}']=0
+            continue
+        metric_values[f'chart_total_sales_transactions{offset}']=row[f'transactions{offset}']
+        if row[f'invoices{offset}']>0:
+            metric_values[f'chart_total_sales_invoices{offset}']=row[f'invoices{offset}']
+        else:
+            metric_values[f'chart_total_sales_invoices{offset}']=row[f'references{offset}']
+    return metric_values
 
+def get_revenue_driver_metrics(
+    cursor,
+    client_ids,
+    account_clauses,
+    profile=None):
+    # Sales transaction and invoice counts for this year and last.
+    sql=compile_revenue_driver_query(f"transaction.client_id IN ({sql_id_list(client_ids)})", account_clauses)
+    rows={
+        row['client_id']: row
+        for row in fetch_all(cursor, sql, profile=profile, label='revenue_drivers', client_ids=client_ids)
+    }
+    return {client_id: get_revenue_driver_values(rows.get(client_id)) for client_id in client_ids}
+
+def get_accounting_dates(
+    cursor,
+    client_ids,
+    profile=None,
+    as_of=None):
+    if as_of is not None:
+        return {client_id: {'accounting_date': as_of} for client_id in client_ids}
     sql=f" \
         SELECT \
-            COUNT(*) AS metric_value \
+            id, \
+            accounting_date \
         FROM \
-            client_transaction transaction \
-            LEFT JOIN vfd_client_account account ON (account.id=transaction.account_id) \
+            vfd_client \
         WHERE \
-            transaction.client_id={client_id} AND \
-            transaction.category='Sales' AND \
-            transaction.offset<=-12 AND \
-            transaction.offset>=-23 AND \
-            {ptype_num_trans_exclude} AND \
-            {nominal_name_exclude} AND \
-            {nominal_type_exclude}"
+            id IN ({sql_id_list(client_ids)})"
+    rows={
+        row['id']: row['accounting_date']
+        for row in fetch_all(cursor, sql, profile=profile, label='accounting_date', client_ids=client_ids)
+    }
+    return {client_id: {'accounting_date': rows.get(client_id)} for client_id in client_ids}
+
+def get_company_client_ids(
+    cursor,
+    company_id):
+    sql=f" \
+        SELECT \
+            id \
+        FROM \
+            vfd_client \
+        WHERE \
+            company_id={int(company_id)} \
+        ORDER BY \
+            id"
     cursor.execute(sql)
-    row=cursor.fetchone()
-    metric_values['chart_total_sales_transactions-12']=row['metric_value']
+    return [row['id'] for row in cursor.fetchall()]
 
+def get_all_client_ids(cursor):
+    sql=" \
+        SELECT \
+            id \
+        FROM \
+            vfd_client \
+        ORDER BY \
+            id"
+    cursor.execute(sql)
+    return [row['id'] for row in cursor.fetchall()]
+
+def get_clients_changed_since(
+    cursor,
+    client_ids,
+    since):
+    # The clients with transactions synced or modified at or after since.
+    if not client_ids:
+        return []
+    sql=f" \
+        SELECT DISTINCT \
+            transaction.client_id AS client_id \
+        FROM \
+            client_transaction transaction \
+        WHERE \
+            transaction.client_id IN ({sql_id_list(client_ids)}) AND ( \
+                transaction.sync_timestamp>=%s OR \
+                transaction.modified_datetime>=%s \
+            )"
+    cursor.execute(sql, (since, since))
+    changed={row['client_id'] for row in cursor.fetchall()}
+    return [client_id for client_id in client_ids if client_id in changed]
+
+# The watermark columns get_transaction_marks() reads, in order.
+TRANSACTION_MARK_COLUMNS=('last_sync_timestamp', 'last_modified_datetime', 'last_transaction_id', 'transaction_count', 'reporting_month')
+
+def get_transaction_marks(
+    cursor,
+    client_ids):
+    # {client_id: (last sync_timestamp, last modified_datetime, highest id,
+    # transaction count, reporting month)} as the client's transactions and
+    # accounting_date stand now.
     sql=f" \
         SELECT \
-            COUNT(DISTINCT(invoice.number)) AS metric_value \
+            report_client.id AS client_id, \
+            MAX(transaction.sync_timestamp) AS last_sync_timestamp, \
+            MAX(transaction.modified_datetime) AS last_modified_datetime, \
+            MAX(transaction.id) AS last_transaction_id, \
+            COUNT(transaction.id) AS transaction_count, \
+            {CLIENT_MONTH_BUCKET} AS reporting_month \
         FROM \
-            client_transaction AS transaction \
-            LEFT JOIN vfd_client_account AS account ON (account.id=transaction.account_id) \
-            LEFT JOIN vfd_client_journal AS journal ON (journal.id=transaction.journal_id) \
-            LEFT JOIN vfd_client_invoice AS invoice ON (invoice.id=journal.source_id) \
+            vfd_client report_client \
+            LEFT JOIN client_transaction transaction ON (transaction.client_id=report_client.id) \
         WHERE \
-            transaction.client_id={client_id} AND \
-            transaction.category='Sales' AND \
-            transaction.offset<=-12 AND \
-            transaction.offset>=-23 AND \
-            {ptype_num_trans_exclude} AND \
-            (transaction.source='invoice' OR (transaction.source='data' AND transaction.api_source_type_name='INV')) AND \
-            {nominal_name_exclude} AND \
-            {nominal_type_exclude}"
+            report_client.id IN ({sql_id_list(client_ids)}) \
+        GROUP BY \
+            report_client.id, \
+            report_client.accounting_date"
     cursor.execute(sql)
-    row=cursor.fetchone()
-    if row['metric_value']>0:
-        metric_values['chart_total_sales_invoices-12']=row['metric_value']
-    else:
-        sql=f" \
-            SELECT \
-                COUNT(DISTINCT(journal.reference)) AS metric_value \
-            FROM \
-                client_transaction AS transaction \
-                LEFT JOIN vfd_client_account AS account ON (account.id=transaction.account_id) \
-                LEFT JOIN vfd_client_journal AS journal ON (journal.id=transaction.journal_id) \
-            WHERE \
-                transaction.client_id={client_id} AND \
-                transaction.category='Sales' AND \
-                transaction.offset<=-12 AND \
-                transaction.offset>=-23 AND \
-                {ptype_num_trans_exclude} AND \
-                (transaction.source='invoice' OR (transaction.source='data' AND transaction.api_source_type_name='INV')) AND \
-                {nominal_name_exclude} AND \
-                {nominal_type_exclude}"
-        cursor.execute(sql)
-        row=cursor.fetchone()
-        metric_values['chart_total_sales_invoices-12']=row['metric_value']
-
-
-    # ptype NOT IN ('MJ', 'Unknown', 'Ukn')
-    #ptype_num_client_exclude="source NOT IN ('bank-transaction', 'credit-note', 'invoice', 'manual-journal', 'overpayment', 'payment', 'data', 'starting-balance')"
-    #    transaction.source NOT IN ('bank-transaction', 'credit-note', 'invoice', 'manual-journal', 'overpayment', 'payment', 'starting-balance') AND \
-    #    transaction.source NOT IN ('bank-transaction', 'credit-note', 'manual-journal', 'overpayment', 'payment', 'starting-balance') AND \
-    #    transaction.source!='Other Income' AND \
-    #    transaction.api_source_type_name NOT IN ('MJ', 'Unknown', 'Ukn')"
-    ptype_num_client_exclude=" \
-        account.type NOT LIKE '%OTHERINCOME%' AND \
-        transaction.source NOT IN ('manual-journal', 'credit-note', 'overpayment') AND \
-        transaction.api_source_type_name NOT IN ('MJ', 'CN', 'OVERPAYMENTS')"
-
-    segmentation_definitions={
-        # Customer Segmentation.
-        'Customer_Segmentation_TY_Existing': "contact.customer_ty!=0 AND contact.customer_ly!=0 AND transaction.offset>=-11 AND transaction.offset<=0",
-        'Customer_Segmentation_TY_New': "contact.customer_ty!=0 AND contact.customer_ly=0 AND transaction.offset>=-11 AND transaction.offset<=0",
-        'Customer_Segmentation_LY_vs_TY_Retained': "contact.customer_ly!=0 AND contact.customer_ty!=0 AND transaction.offset>=-23 AND transaction.offset<=12",
-        'Customer_Segmentation_LY_vs_TY_Lost': "contact.customer_ly!=0 AND contact.customer_ty=0 AND transaction.offset>=-23 AND transaction.offset<=12",
-        'Customer_Segmentation_LY_vs_PY_Existing': "contact.customer_ly!=0 AND contact.customer_py!=0 AND transaction.offset>=-23 AND transaction.offset<=12",
-        'Customer_Segmentation_LY_vs_PY_New': "contact.customer_ly!=0 AND contact.customer_py=0 AND transaction.offset>=-23 AND transaction.offset<=12",
-        'Customer_Segmentation_PY_vs_LY_Retained': "contact.customer_py!=0 AND contact.customer_ly!=0 AND transaction.offset>=-35 AND transaction.offset<=24",
-        'Customer_Segmentation_PY_vs_LY_Lost': "contact.customer_py!=0 AND contact.customer_ly=0 AND transaction.offset>=-35 AND transaction.offset<=24",
-        'Customer_Count_TY': "contact.customer_ty!=0 AND transaction.offset>=-11 AND transaction.offset<=0",
-        'Customer_Count_LY': "contact.customer_ly!=0 AND transaction.offset>=-23 AND transaction.offset<=12",
-        'Customer_Count_PY': "contact.customer_py!=0 AND transaction.offset>=-35 AND transaction.offset<=24",
-
-        # Supplier Segmentation.
-        'Supplier_Segmentation_TY_Existing': "contact.supplier_ty!=0 AND contact.supplier_ly!=0",
-        'Supplier_Segmentation_TY_New': "contact.supplier_ty!=0 AND contact.supplier_ly=0",
-        'Supplier_Segmentation_LY_vs_TY_Retained': "contact.supplier_ly!=0 AND contact.supplier_ty!=0",
-        'Supplier_Segmentation_LY_vs_TY_Lost': "contact.supplier_ly!=0 AND contact.supplier_ty=0",
-        'Supplier_Segmentation_LY_vs_PY_Existing': "contact.supplier_ly!=0 AND contact.supplier_py!=0",
-        'Supplier_Segmentation_LY_vs_PY_New': "contact.supplier_ly!=0 AND contact.supplier_py=0",
-        'Supplier_Segmentation_PY_vs_LY_Retained': "contact.supplier_py!=0 AND contact.supplier_ly!=0",
-        'Supplier_Segmentation_PY_vs_LY_Lost': "contact.supplier_py!=0 AND contact.supplier_ly=0",
+    rows={row['client_id']: tuple(row[column] for column in TRANSACTION_MARK_COLUMNS) for row in cursor.fetchall()}
+    return {client_id: rows.get(client_id, (None, None, None, 0, None)) for client_id in client_ids}
+
+def get_collection_watermarks(
+    cursor,
+    client_ids):
+    # {client_id: watermark row} as of the last incremental collection;
+    # clients never collected incrementally are missing.
+    sql=f" \
+        SELECT \
+            client_id, \
+            last_sync_timestamp, \
+            last_modified_datetime, \
+            last_transaction_id, \
+            transaction_count, \
+            reporting_month, \
+            aggregates_refreshed \
+        FROM \
+            vfd_client_collection_watermark \
+        WHERE \
+            client_id IN ({sql_id_list(client_ids)})"
+    cursor.execute(sql)
+    return {row['client_id']: row for row in cursor.fetchall()}
+
+def get_changed_client_ids(
+    transaction_marks,
+    watermarks):
+    # Clients with new, modified or deleted transactions, or a new reporting
+    # month, since their watermark. Other edits to accounts, contacts or
+    # vfd_client are not tracked here.
+    return [
+        client_id
+        for client_id, marks in transaction_marks.items()
+        if client_id not in watermarks or
+           marks!=tuple(watermarks[client_id][column] for column in TRANSACTION_MARK_COLUMNS)
+    ]
+
+def get_changed_offsets(
+    cursor,
+    client_ids,
+    account_clauses,
+    transaction_marks,
+    watermarks):
+    # {client_id: {offset, ...}} of the transactions appended since the
+    # client's watermark (past its last_transaction_id), or None when the
+    # buckets to rebuild are not known: a transaction that existed at the
+    # watermark was synced or modified since (it may have left another
+    # bucket), some were deleted (fewer of them than transaction_count), or
+    # the reporting month moved on and with it every offset.
+    if not client_ids:
+        return {}
+    appended="transaction.id>watermark.last_transaction_id"
+    sql=f" \
+        SELECT \
+            transaction.client_id AS client_id, \
+            {account_clauses['offset']} AS `offset`, \
+            {appended} AS appended, \
+            COUNT(*) AS transactions \
+        FROM \
+            client_transaction transaction \
+            JOIN vfd_client_collection_watermark watermark ON (watermark.client_id=transaction.client_id) \
+            {account_clauses['offset_join']} \
+        WHERE \
+            transaction.client_id IN ({sql_id_list(client_ids)}) AND ( \
+                {appended} OR \
+                transaction.sync_timestamp>watermark.last_sync_timestamp OR \
+                transaction.modified_datetime>watermark.last_modified_datetime \
+            ) \
+        GROUP BY \
+            transaction.client_id, \
+            {account_clauses['offset']}, \
+            {appended}"
+    cursor.execute(sql)
+    changed_offsets={client_id: set() for client_id in client_ids}
+    appended_counts={client_id: 0 for client_id in client_ids}
+    for row in cursor.fetchall():
+        client_id=row['client_id']
+        if not row['appended']:
+            changed_offsets[client_id]=None
+        elif changed_offsets[client_id] is not None:
+            changed_offsets[client_id].add(row['offset'])
+        appended_counts[client_id]+=row['transactions']
+    for client_id in client_ids:
+        watermark=watermarks[client_id]
+        marks=dict(zip(TRANSACTION_MARK_COLUMNS, transaction_marks[client_id]))
+        if watermark['last_transaction_id'] is None or \
+           marks['transaction_count']-appended_counts[client_id]!=watermark['transaction_count'] or \
+           watermark['reporting_month'] is None or \
+           marks['reporting_month']!=watermark['reporting_month']:
+            changed_offsets[client_id]=None
+    return changed_offsets
+
+def get_collection_marks(
+    transaction_marks,
+    aggregates_refreshed):
+    # {client_id: watermark row} for collected clients: the transaction
+    # marks followed by aggregates_refreshed.
+    # aggregates_refreshed records whether vfd_client_monthly_aggregate was
+    # brought up to these marks, so the next run may rebuild it partially.
+    return {
+        client_id: (*marks, aggregates_refreshed)
+        for client_id, marks in transaction_marks.items()
     }
 
-    #for metric_name, where_clause in segmentation_definitions.items():
-    #    sql=f" \
-    #        SELECT DISTINCT \
-    #            contact.name AS contact_name \
-    #        FROM \
-    #            client_transaction transaction \
-    #            LEFT JOIN vfd_client_contact contact ON (contact.id = transaction.contact_id) \
-    #        WHERE \
-    #            transaction.client_id={client_id} AND \
-    #            {where_clause} \
-    #    "
-    #    cursor.execute(sql)
-    #    results = cursor.fetchall()
-    #    metric_values[metric_name]=cursor.rowcount
-    for metric_name, where_clause in segmentation_definitions.items():
-        sql=f" \
-            SELECT \
-                COUNT(DISTINCT contact.name) AS metric_value \
-            FROM \
-                client_transaction transaction \
-                LEFT JOIN vfd_client_account account ON (account.id=transaction.account_id) \
-                LEFT JOIN vfd_client_contact contact ON (contact.id=transaction.contact_id) \
-            WHERE \
-                transaction.client_id={client_id} AND \
-                transaction.category='Sales' AND \
-                {ptype_num_client_exclude} AND \
-                {where_clause} \
-        "
-        # {nominal_name_exclude} AND \
-        # {nominal_type_exclude} AND \
-        cursor.execute(sql)
-        row=cursor.fetchone()
-        metric_values[metric_name]=row['metric_value']
-
-    account_types={
-        'accounts_receivable': 'Accounts Receivable',
-        'accounts_payable': 'Accounts Payable',
-    }
-    account_names={
-        'accounts_receivable': [
-            '%A/R%',
-            '%Accounts Receivable%',
-            '%Debtor Control%',
-            '%Debtors%',
-            '%Sales ledger%',
-            '%Recouvrables%',
-            html.unescape('%Contr&ocirc;le du d&eacute;biteur%'),
-            '%Grand livre des ventes%',
-        ],
-        'accounts_payable': [
-            #'%Payables Identification%',
-            '%A/P%',
-            '%Accounts Payable%',
-            #'%AMEX%',
-            #'%C.I.S.%',
-            #'%CIS%',
-            #'%Corporation Tax Liability%',
-            #'%Corporation tax payable%',
-            '%Creditors%',
-            '%Creditors Control%',
-            #'%Creditors Control Account%',
-            #'%Earnings Orders Payable%',
-            #'%Inland Revenue - PAYEE%',
-            #'%Mastercard%',
-            #'%National Insurance%',
-            #'%Nest%',
-            #'%Net Wages%',
-            #'%NIC Payable%',
-            #'%P.A.Y.E.%',
-            #'%PAYE & NIC%',
-            #'%PAYE and National Insurance%',
-            #'%PAYE and NI%',
-            #'%PAYE Control Account%',
-            #'%PAYE Payable%',
-            #'%PAYE/NI%',
-            #'%PAYEE NIC & TAX%',
-            #'%Payroll Liabilities%',
-            #'%Pension control%',
-            #'%Pension Liability%',
-            #'%Pension Payable%',
-            #'%Pensions Payable%',
-            #'%Pensions unpaid%',
-            '%Purchase ledger',
-            #'%Purchase ledger control%',
-            #'%Unpaid Expense Claims%',
-            #'%VISA%',
-            #'%Wages Control Account%',
-            #'%Wages Payable - Payroll%',
-            '%Dettes Exigibles%',
-            html.unescape('%Contr&ocirc;le des cr&eacute;anciers%'),
-            '%Registre des achats%',
+def write_collection_watermarks(
+    cursor,
+    collection_marks):
+    # Upsert get_collection_marks() rows; the caller commits, with
+    # the client's metrics (see save_report_metrics()).
+    if not collection_marks:
+        return
+    cursor.executemany(" \
+        INSERT INTO vfd_client_collection_watermark \
+            (client_id, last_sync_timestamp, last_modified_datetime, last_transaction_id, transaction_count, reporting_month, aggregates_refreshed, collected_at) \
+        VALUES \
+            (%s, %s, %s, %s, %s, %s, %s, UTC_TIMESTAMP()) \
+        ON DUPLICATE KEY UPDATE \
+            last_sync_timestamp=VALUES(last_sync_timestamp), \
+            last_modified_datetime=VALUES(last_modified_datetime), \
+            last_transaction_id=VALUES(last_transaction_id), \
+            transaction_count=VALUES(transaction_count), \
+            reporting_month=VALUES(reporting_month), \
+            aggregates_refreshed=VALUES(aggregates_refreshed), \
+            collected_at=VALUES(collected_at)",
+        [
+            (client_id, *marks)
+            for client_id, marks in collection_marks.items()
+        ])
+
+def report_metric_value(value):
+    # Numeric metrics as stored in vfd_client_report_metric.value; None for
+    # anything else, such as accounting_date, a NaN or an infinite ratio, and
+    # for values too large for the column, which would fail the whole batch.
+    if isinstance(value, bool) or not isinstance(value, (int, float, Decimal)):
+        return None
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            return None
+        value=Decimal(repr(value))
+    if isinstance(value, Decimal) and not value.is_finite():
+        return None
+    if abs(value)>=REPORT_METRIC_LIMIT:
+        return None
+    return value
+
+def save_report_metrics(
+    connection,
+    client_metric_values,
+    reporting_date=None,
+    chunk_size=REPORT_METRIC_CHUNK_SIZE,
+    collection_marks=None):
+    # Upsert {client_id: metric_values} into vfd_client_report_metric, one
+    # executemany and commit per chunk of clients. Rows are keyed by the
+    # client's accounting_date unless reporting_date is given (today when
+    # neither is known). Returns the number of rows written.
+    #
+    # collection_marks, as filled in by an incremental get_metrics_for_clients()
+    # or run_collector(), are the watermarks of these clients. Each chunk's
+    # are written in the same commit as its metrics, so a client is only
+    # marked collected once its metrics are stored.
+    cursor=connection.cursor()
+    client_ids=list(client_metric_values)
+    written=0
+    for chunk in iter_chunks(client_ids, chunk_size):
+        if collection_marks:
+            write_collection_watermarks(cursor, {
+                client_id: collection_marks[client_id]
+                for client_id in chunk
+                if client_id in collection_marks
+            })
+        rows=[]
+        for client_id in chunk:
+            metric_values=client_metric_values[client_id]
+            client_reporting_date=reporting_date or metric_values.get('accounting_date') or date.today()
+            for metric_key, value in metric_values.items():
+                if metric_key=='accounting_date':
+                    continue
+                stored=report_metric_value(value)
+                if stored is None and isinstance(value, (int, float, Decimal)) and not isinstance(value, bool) and math.isfinite(value):
+                    sp_logger.warning("Report metric %s of client %s is out of range (%s); saved as NULL", metric_key, client_id, value)
+                rows.append((client_id, client_reporting_date, metric_key, stored))
+        if rows:
+            cursor.executemany(" \
+                INSERT INTO vfd_client_report_metric \
+                    (client_id, reporting_date, metric_key, value, collected_at) \
+                VALUES \
+                    (%s, %s, %s, %s, UTC_TIMESTAMP()) \
+                ON DUPLICATE KEY UPDATE \
+                    value=VALUES(value), \
+                    collected_at=VALUES(collected_at)", rows)
+            written+=len(rows)
+        connection.commit()
+    cursor.close()
+    return written
+
+def get_metrics_for_clients(
+    config,
+    client_ids=None,
+    company_id=None,
+    engine=ENGINE_SINGLE_PASS,
+    refresh_aggregates=True,
+    use_account_flags=False,
+    chunk_size=BATCH_CHUNK_SIZE,
+    connection=None,
+    incremental=False,
+    profile=None,
+    use_month_buckets=False,
+    as_of=None,
+    collection_marks=None):
+    # Batch counterpart of get_metrics_from_database(): every block runs once
+    # per chunk of clients with GROUP BY transaction.client_id, and the result
+    # is {client_id: metric_values}. Pass client_ids, or a company_id to take
+    # all of that company's clients. An open connection can be passed in to be
+    # reused; it is then left open.
+    #
+    # With incremental, clients whose transactions have not been synced or
+    # modified since their last incremental run are skipped (and left out of
+    # the result). When a client's transactions were only appended to, the
+    # prefix_sum engine rebuilds just the aggregate buckets they fall into;
+    # after updates or deletions it rebuilds the client's aggregate in full.
+    # The collected clients' new watermarks are put in collection_marks, a
+    # dict, for save_report_metrics() to store with their metrics; until then
+    # the clients count as changed. Without collection_marks an incremental
+    # run collects every client again next time.
+    #
+    # profile, from vfd_collect_report_profile.new_query_profile(), records
+    # every metric query; it is left to the caller to summarize.
+    #
+    # use_month_buckets resolves offsets from client_transaction.month_bucket
+    # and vfd_client.accounting_date at query time instead of reading the
+    # stored offsets. as_of (a date) reports every client as of that month,
+    # with as_of as its accounting_date; the monthly aggregate and the
+    # watermarks only hold the current month, so it cannot be combined with
+    # prefix_sum or incremental.
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown collector engine: {engine}")
+    if (client_ids is None)==(company_id is None):
+        raise ValueError("Pass exactly one of client_ids or company_id")
+    if as_of is not None and (engine==ENGINE_PREFIX_SUM or incremental):
+        raise ValueError("as_of cannot be combined with prefix_sum or incremental")
+
+    own_connection=connection is None
+    if own_connection:
+        connection=mysql.connector.connect(**config)
+    cursor=connection.cursor(dictionary=True)
+
+    if client_ids is None:
+        client_ids=get_company_client_ids(cursor, company_id)
+    client_ids=[int(client_id) for client_id in client_ids]
+
+    transaction_marks={}
+    watermarks={}
+    if incremental and client_ids:
+        transaction_marks=get_transaction_marks(cursor, client_ids)
+        watermarks=get_collection_watermarks(cursor, client_ids)
+        client_ids=get_changed_client_ids(transaction_marks, watermarks)
+        transaction_marks={client_id: transaction_marks[client_id] for client_id in client_ids}
+
+    if engine==ENGINE_PER_METRIC:
+        client_metric_values={
+            client_id: get_metrics_from_database(
+                config,
+                client_id,
+                engine=engine,
+                use_account_flags=use_account_flags,
+                connection=connection,
+                profile=profile,
+                use_month_buckets=use_month_buckets,
+                as_of=as_of)
+            for client_id in client_ids
+        }
+        if collection_marks is not None:
+            collection_marks.update(get_collection_marks(transaction_marks, False))
+        if own_connection:
+            close_prepared_statements(connection)
+            connection.close()
+        return client_metric_values
+
+    account_clauses=get_account_clauses(use_account_flags, use_month_buckets, as_of)
+
+    client_metric_values={client_id: {} for client_id in client_ids}
+    for chunk in iter_chunks(client_ids, chunk_size):
+        if use_account_flags:
+            for client_id in chunk:
+                classify_accounts(connection, client_id)
+
+        if engine==ENGINE_PREFIX_SUM:
+            if refresh_aggregates:
+                # Clients whose aggregate was current at their watermark and
+                # that only had transactions appended since need just the
+                # buckets under those rebuilt; the others are rebuilt in full.
+                changed_offsets=get_changed_offsets(
+                    cursor,
+                    [
+                        client_id
+                        for client_id in chunk
+                        if client_id in watermarks and watermarks[client_id]['aggregates_refreshed']
+                    ],
+                    account_clauses,
+                    transaction_marks,
+                    watermarks)
+                full_refresh_ids=[client_id for client_id in chunk if changed_offsets.get(client_id) is None]
+                if full_refresh_ids:
+                    refresh_monthly_aggregates(connection, full_refresh_ids, account_clauses)
+                for client_id, offsets in changed_offsets.items():
+                    if offsets is not None:
+                        refresh_monthly_aggregates(connection, [client_id], account_clauses, offsets=offsets)
+            blocks=[
+                get_window_metrics_prefix_sum(cursor, chunk, [definition for definition in METRICS if is_aggregate_metric(definition)], profile),
+                get_planned_metrics(cursor, chunk, account_clauses, [definition for definition in METRICS if not is_aggregate_metric(definition)], profile),
+            ]
+        else:
+            blocks=[get_planned_metrics(cursor, chunk, account_clauses, profile=profile)]
+        blocks+=[
+            get_minimum_sales_offsets(cursor, chunk, account_clauses, profile),
+            get_revenue_driver_metrics(cursor, chunk, account_clauses, profile),
+            get_accounting_dates(cursor, chunk, profile, as_of),
         ]
-    }
+        for block in blocks:
+            for client_id, metric_values in block.items():
+                client_metric_values[client_id].update(metric_values)
+
+    if collection_marks is not None:
+        collection_marks.update(get_collection_marks(transaction_marks, engine==ENGINE_PREFIX_SUM and refresh_aggregates))
+    cursor.close()
+    if own_connection:
+        connection.close()
+    return client_metric_values
+
+def collect_report_data(
+    config,
+    client_ids=None,
+    company_id=None,
+    vectorized=False,
+    save=False,
+    **kwargs):
+    # Raw and derived metrics for a batch of clients, {client_id: metric_values}.
+    # vectorized derives the whole batch with NumPy (floats, not Decimals).
+    # save also writes them to vfd_client_report_metric, with the watermarks
+    # of an incremental run.
+    if save and kwargs.get('collection_marks') is None:
+        kwargs['collection_marks']={}
+    client_metric_values=get_metrics_for_clients(
+        config,
+        client_ids=client_ids,
+        company_id=company_id,
+        **kwargs)
+    if vectorized:
+        client_metric_values=get_derived_metrics_vectorized(client_metric_values)
+    else:
+        client_metric_values={
+            client_id: get_derived_metrics(metric_values)
+            for client_id, metric_values in client_metric_values.items()
+        }
+    if save:
+        connection=kwargs.get('connection') or mysql.connector.connect(**config)
+        save_report_metrics(connection, client_metric_values, collection_marks=kwargs['collection_marks'])
+        if connection is not kwargs.get('connection'):
+            connection.close()
+    return client_metric_values
 
-    for offset in ['-0', '-12']:
-        for pr in ['accounts_receivable', 'accounts_payable']:
-            account_name_clause=''
-            for account_name in account_names[pr]:
-                account_name_clause+=f" OR account.name LIKE '{account_name}'"
-            sql=f" \
-                SELECT \
-                    SUM(transaction.net_amount) AS metric_value \
-                FROM \
-                    client_transaction transaction \
-                    LEFT JOIN vfd_client_account account ON (account.id=transaction.account_id) \
-                WHERE \
-                    transaction.client_id={client_id} AND \
-                    transaction.offset<={offset} AND \
-                    transaction.category IN ('Current assets', 'Current liabilities') AND \
-                    account.name NOT LIKE '%Other%' AND ( \
-                        account.type='{account_types[pr]}' \
-                        {account_name_clause} \
-                    )"
-            cursor.execute(sql)
-            row=cursor.fetchone()
-            if row['metric_value'] is not None:
-                metric_values[f'chart_{pr}{offset}']=row['metric_value']
-            else:
-                metric_values[f'chart_{pr}{offset}']=Decimal(0.0)
-
-    for offset in range(0, 24):
-        sql=f" \
-            SELECT \
-                SUM(transaction.net_amount) AS metric_value \
-            FROM \
-                client_transaction transaction \
-                LEFT JOIN vfd_client_account account ON (account.id=transaction.account_id) \
-            WHERE \
-                transaction.client_id={client_id} AND \
-                transaction.offset<={-1*offset} AND \
-                transaction.category IN ('Current assets', 'Current liabilities') AND ( \
-                    account.type LIKE '%Bank%' OR \
-                    account.type LIKE '%Cash%' OR \
-                    account.name LIKE '%Bank%' OR \
-                    account.name LIKE '%Cash%' OR \
-                    account.name LIKE '%Current Account%' OR \
-                    account.name LIKE '%Deposit Account%' OR \
-                    account.name LIKE '%Money Market Account%' \
-                ) "
-        cursor.execute(sql)
-        row=cursor.fetchone()
-        if row['metric_value'] is not None:
-            metric_values[f'chart_cash_balance_month-{offset}']=-1*row['metric_value']
-        else:
-            metric_values[f'chart_cash_balance_month-{offset}']=Decimal(0.0)
+def get_metrics_from_database(
+    config,
+    client_id,
+    engine=ENGINE_PER_METRIC,
+    refresh_aggregates=True,
+    use_account_flags=False,
+    connection=None,
+    profile=None,
+    use_month_buckets=False,
+    as_of=None):
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown collector engine: {engine}")
+    if engine!=ENGINE_PER_METRIC:
+        # The set based engines are the batch collector run for one client.
+        return get_metrics_for_clients(
+            config,
+            client_ids=[client_id],
+            engine=engine,
+            refresh_aggregates=refresh_aggregates,
+            use_account_flags=use_account_flags,
+            connection=connection,
+            profile=profile,
+            use_month_buckets=use_month_buckets,
+            as_of=as_of)[client_id]
+
+    # A handy query:
+    # SELECT client_id, COUNT(DISTINCT `offset`) FROM client_transaction WHERE `offset` <=0 GROUP BY client_id;
+    # nominal_name_exclude="account.name NOT IN ('Corp Tax', 'Corporation Tax', 'Dividend', 'Taxes', 'Interest', 'Depreciation', 'Depn', 'Amortisation', 'Amortization', 'Corporate Tax', 'Business Tax')"
+    # nominal_name_exclude="account.name NOT LIKE '%Corp Tax%' AND account.name NOT LIKE '%Corporation Tax%' AND account.name NOT LIKE '%Dividend%' AND account.name NOT LIKE '%Taxes%' AND account.name NOT LIKE '%Interest%' AND account.name NOT LIKE '%Depreciation%' AND account.name NOT LIKE '%Depn%' AND account.name NOT LIKE '%Amortisation%' AND account.name NOT LIKE '%Amortization%' AND account.name NOT LIKE '%Corporate Tax%' AND account.name NOT LIKE '%Business Tax%'"
+    #nominal_name_exclude="((account.name NOT LIKE '%Corp Tax%' AND account.name NOT LIKE '%Corporation Tax%' AND account.name NOT LIKE '%Dividend%' AND account.name NOT LIKE '%Taxes%' AND account.name NOT LIKE '%Interest%' AND account.name NOT LIKE '%Int.%' AND account.name NOT LIKE '%Depreciation%' AND account.name NOT LIKE '%Depn%' AND account.name NOT LIKE '%Amortisation%' AND account.name NOT LIKE '%Amortization%' AND account.name NOT LIKE '%Corporate Tax%' AND account.name NOT LIKE '%Business Tax%') OR (category NOT IN ('Cost of Sales', 'Overheads')))"
+    account_clauses=get_account_clauses(use_account_flags, use_month_buckets, as_of)
+    account_join=account_clauses['account_join']
+    metric_statements=get_metric_statements(use_account_flags, use_month_buckets, as_of)
+
+    metric_values={}
+    
+    own_connection=connection is None
+    if own_connection:
+        connection = mysql.connector.connect(**config)
+
+    if use_account_flags:
+        classify_accounts(connection, client_id)
+
+    for definition, sql in metric_statements:
+        sp_logger.debug("Collector query for %s, client %s: %s", definition.name, client_id, sql)
+        row=fetch_prepared_one(connection, sql, (client_id,), profile, definition.name)
+        metric_values[definition.name]=metric_value(definition, row['metric_value'])
+
+    #sql=f" \
+    #    SELECT \
+    #        MIN(transaction.offset) AS metric_value \
+    #    FROM \
+    #        client_transaction transaction \
+    #        LEFT JOIN vfd_client_account account ON (account.id=transaction.account_id) \
+    #    WHERE \
+    #        transaction.client_id={client_id} AND \
+    #        transaction.category='Sales' AND \
+    #        {nominal_name_exclude} AND \
+    #        {nominal_type_exclude}"
+    #cursor.execute(sql)
+    #row=cursor.fetchone()
+    #metric_values['chart_minimum_rolling_offset_sales']=row['metric_value']
+
+    # Rolling offset sales
+    sql=f" \
+        SELECT \
+            MIN({account_clauses['offset']}) AS metric_value \
+        FROM \
+            client_transaction transaction \
+            {account_join} \
+            {account_clauses['offset_join']} \
+        WHERE \
+            transaction.client_id=%s AND \
+            transaction.category='Sales'"
+            # AND \
+            #{nominal_name_exclude} AND \
+            #{nominal_type_exclude}"
+    row=fetch_prepared_one(connection, sql, (client_id,), profile, 'chart_minimum_rolling_offset_sales')
+    metric_values['chart_minimum_rolling_offset_sales']=row['metric_value']
+
+
+
+
+
+    # Revenue Drivers.
+    sql=compile_revenue_driver_query("transaction.client_id=%s", account_clauses)
+    row=fetch_prepared_one(connection, sql, (client_id,), profile, 'revenue_drivers')
+    metric_values.update(get_revenue_driver_values(row))
 
     sql=f" \
         SELECT \
@@ -633,13 +1779,17 @@ def get_metrics_from_database(
         FROM \
             vfd_client \
         WHERE \
-            id={client_id} \
+            id=%s \
         "
-    cursor.execute(sql)
-    row=cursor.fetchone()
-    metric_values['accounting_date']=row['accounting_date']
+    if as_of is None:
+        row=fetch_prepared_one(connection, sql, (client_id,), profile, 'accounting_date')
+        metric_values['accounting_date']=row['accounting_date']
+    else:
+        metric_values['accounting_date']=as_of
 
-    connection.close()
+    if own_connection:
+        close_prepared_statements(connection)
+        connection.close()
     return metric_values
 
 def get_derived_metrics(metric_values):
@@ -1192,3 +2342,245 @@ def get_derived_metrics(metric_values):
     #Expenditure = line_name = Cost of Sales or Overheads
 
     return metric_values
+
+# Indexes into PERIODS used by get_derived_metrics_vectorized(), which holds
+# the period metrics as [TY, LY] x PERIODS.
+MONTH_PERIOD, QUARTER_PERIOD, YEAR_PERIOD=0, 1, 4
+
+# Derived keys that get_derived_metrics() has always spelt this way.
+DERIVED_KEY_ALIASES={
+    'GM_Var%_vs_LY_Last_6_Months_TY': 'GM_Var%_vs_LY_ Last_6_Months_TY',
+}
+
+def divide_arrays(numerator, denominator):
+    # special_divide() over arrays: 0 wherever the denominator is 0.
+    numerator, denominator=np.broadcast_arrays(
+        np.asarray(numerator, dtype=np.float64),
+        np.asarray(denominator, dtype=np.float64))
+    return np.divide(numerator, denominator, out=np.zeros(numerator.shape), where=denominator!=0)
+
+def get_derived_metrics_vectorized(client_metric_values):
+    # get_derived_metrics() for a batch of clients, {client_id: metric_values}.
+    # The per-period and per-month series are loaded into float64 arrays with
+    # one row per client, every derivation is an array expression over all
+    # clients at once, and the dict keys are only written back at the end.
+    # Derived values are floats rather than Decimals.
+    rows=list(client_metric_values.values())
+    if not rows:
+        return client_metric_values
+
+    def column(key):
+        return np.array([float(row[key]) for row in rows], dtype=np.float64)
+
+    def columns(keys):
+        return np.stack([column(key) for key in keys], axis=1)
+
+    def periods(prefix):
+        # (clients, 2, 5): TY/LY by Month, Last 3, 6, 9 and 12 months.
+        return np.stack([columns([f'{prefix}_{period}_{year}' for period in PERIODS]) for year in PERIOD_YEARS], axis=1)
+
+    def months(prefix, count):
+        return columns([f'{prefix}{i}' for i in range(count)])
+
+    derived={}
+
+    def put(key, values):
+        derived[DERIVED_KEY_ALIASES.get(key, key)]=values
+
+    def put_periods(prefix, values):
+        for j, period in enumerate(PERIODS):
+            for k, year in enumerate(PERIOD_YEARS):
+                put(f'{prefix}_{period}_{year}', values[:, k, j])
+
+    def put_months(prefix, values):
+        for i in range(values.shape[1]):
+            put(f'{prefix}{i}', values[:, i])
+
+    def put_variances(prefix, values, percentages=None):
+        variance=values[:, 0]-values[:, 1]
+        variance_pc=divide_arrays(variance, values[:, 1])*100
+        if percentages is not None:
+            percentage_variance=percentages[:, 0]-percentages[:, 1]
+        for j, period in enumerate(PERIODS):
+            put(f'{prefix}_Var_vs_LY_{period}_TY', variance[:, j])
+            put(f'{prefix}_Var%_vs_LY_{period}_TY', variance_pc[:, j])
+            if percentages is not None:
+                put(f'{prefix}%_Var_vs_LY_{period}_TY', percentage_variance[:, j])
+        return variance, variance_pc
+
+    def put_section(name, values, variance, variance_pc, sign=1):
+        put(f'chart_{name}_this_month', values[:, 0, MONTH_PERIOD])
+        put(f'chart_{name}_this_quarter', values[:, 0, QUARTER_PERIOD])
+        put(f'chart_{name}_this_year', values[:, 0, YEAR_PERIOD])
+        put(f'chart_{name}_this_month_vs_last_year', sign*variance[:, MONTH_PERIOD])
+        put(f'chart_{name}_this_quarter_vs_last_year', sign*variance[:, QUARTER_PERIOD])
+        put(f'chart_{name}_this_year_vs_last_year', sign*variance[:, YEAR_PERIOD])
+        put(f'chart_{name}_this_month_vs_last_year%', sign*variance_pc[:, MONTH_PERIOD])
+        put(f'chart_{name}_this_quarter_vs_last_year%', sign*variance_pc[:, QUARTER_PERIOD])
+        put(f'chart_{name}_this_year_vs_last_year%', sign*variance_pc[:, YEAR_PERIOD])
+        put(f'chart_{name}_3_1_months', variance[:, 1])
+        put(f'chart_{name}_6_4_months', variance[:, 2]-variance[:, 1])
+        put(f'chart_{name}_9_7_months', variance[:, 3]-variance[:, 2])
+        put(f'chart_{name}_12_10_months', variance[:, 4]-variance[:, 3])
+
+    sales=periods('Sales')
+    cos=periods('COS')
+    overheads=periods('Overheads')
+    income=periods('Income')
+
+    # Gross Margin, Overheads, Net Profit and EBITDA by period.
+    gm=sales-cos
+    gm_pc=divide_arrays(gm, sales)*100
+    put_periods('GM', gm)
+    put_periods('GM%', gm_pc)
+    gm_ebitda=income-cos
+    put_periods('GM_EBITDA', gm_ebitda)
+    put_periods('GM_EBITDA%', divide_arrays(gm_ebitda, income)*100)
+    overheads_pc=divide_arrays(overheads, sales)*100
+    put_periods('Overheads%', overheads_pc)
+    net_profit=gm-overheads
+    net_profit_pc=divide_arrays(net_profit, sales)*100
+    put_periods('Net_Profit', net_profit)
+    put_periods('Net_Profit%', net_profit_pc)
+    ebitda=gm_ebitda-overheads
+    ebitda_pc=divide_arrays(ebitda, sales)*100
+    put_periods('EBITDA', ebitda)
+    put_periods('EBITDA%', ebitda_pc)
+
+    # Net Worth.
+    net_worth_ty=columns(['Net_Worth_Current_Month_TY']+[f'Net_Worth_Current_Month_-{i}_TY' for i in range(1, 12)])
+    net_worth_ly=columns(['Net_Worth_Current_Month_LY']+[f'Net_Worth_Current_Month_-{i}_LY' for i in range(1, 12)])
+    net_worth_ty_3=net_worth_ty[:, :3].mean(axis=1)
+    net_worth_ty_12=net_worth_ty.mean(axis=1)
+    net_worth_ly_3=net_worth_ly[:, :3].mean(axis=1)
+    net_worth_ly_12=net_worth_ly.mean(axis=1)
+    put('Net_Worth_TY_3_Month_Ave', net_worth_ty_3)
+    put('Net_Worth_TY_12_Month_Ave', net_worth_ty_12)
+    put('Net_Worth_LY_3_Month_Ave', net_worth_ly_3)
+    put('Net_Worth_LY_12_Month_Ave', net_worth_ly_12)
+    put('Profit_Movement_TYL12M', net_profit[:, 0, YEAR_PERIOD]-net_profit[:, 1, YEAR_PERIOD])
+    put('Sales_Profit_Movement_TYL12M', (sales[:, 0, YEAR_PERIOD]-sales[:, 1, YEAR_PERIOD])*gm_pc[:, 1, YEAR_PERIOD]/100)
+    put('GM%_Profit_Movement_TYL12M', (gm_pc[:, 0, YEAR_PERIOD]-gm_pc[:, 1, YEAR_PERIOD])/100*sales[:, 0, YEAR_PERIOD])
+    put('Overheads_Profit_Movement_TYL12M', overheads[:, 0, YEAR_PERIOD]-overheads[:, 1, YEAR_PERIOD])
+
+    # Variances against last year.
+    sales_var, sales_var_pc=put_variances('Sales', sales)
+    gm_var, gm_var_pc=put_variances('GM', gm, gm_pc)
+    # The 9 month Overheads% variance has always been taken against last
+    # year's 12 month Overheads.
+    overheads_pc_quirk=overheads_pc.copy()
+    overheads_pc_quirk[:, 1, 3]=overheads[:, 1, YEAR_PERIOD]
+    overheads_var, overheads_var_pc=put_variances('Overheads', overheads, overheads_pc_quirk)
+    net_profit_var, net_profit_var_pc=put_variances('Net_Profit', net_profit, net_profit_pc)
+    ebitda_var, ebitda_var_pc=put_variances('EBITDA', ebitda, ebitda_pc)
+
+    net_worth_var=net_worth_ty[:, 0]-net_worth_ly[:, 0]
+    net_worth_var_3=net_worth_ty_3-net_worth_ly_3
+    net_worth_var_12=net_worth_ty_12-net_worth_ly_12
+    net_worth_var_pc=divide_arrays(net_worth_var, net_worth_ly[:, 0])*100
+    net_worth_var_3_pc=divide_arrays(net_worth_var_3, net_worth_ly_3)*100
+    net_worth_var_12_pc=divide_arrays(net_worth_var_12, net_worth_ly_12)*100
+    put('Net_Worth_Var_vs_LY_Month_TY', net_worth_var)
+    put('Net_Worth_Var%_vs_LY_Month_TY', net_worth_var_pc)
+    put('Net_Worth_Var_vs_LY_3_Month_Ave_TY', net_worth_var_3)
+    put('Net_Worth_Var%_vs_LY_3_Month_Ave_TY', net_worth_var_3_pc)
+    put('Net_Worth_Var_vs_LY_12_Month_Ave_TY', net_worth_var_12)
+    put('Net_Worth_Var%_vs_LY_12_Month_Ave_TY', net_worth_var_12_pc)
+
+    # Revenue section.
+    put_section('revenue', sales, sales_var, sales_var_pc)
+
+    # Gross Margin section.
+    revenue_months=months('chart_revenue_month-', 13)
+    gm_months=revenue_months-months('chart_cost_of_sales_month-', 13)
+    put_months('chart_gross_margin_month-', gm_months)
+    put_months('chart_gross_margin_pc_month-', divide_arrays(gm_months, revenue_months)*100)
+    put('chart_gross_margin_pc_3_1_months', gm_pc[:, 0, QUARTER_PERIOD]-gm_pc[:, 1, QUARTER_PERIOD])
+    for label, last, first in [('6_4', 2, 1), ('9_7', 3, 2), ('12_10', 4, 3)]:
+        sales_band=sales[:, :, last]-sales[:, :, first]
+        cos_band=cos[:, :, last]-cos[:, :, first]
+        put(f'Sales_Last_{label}_Months_TY', sales_band[:, 0])
+        put(f'Sales_Last_{label}_Months_LY', sales_band[:, 1])
+        put(f'COS_Last_{label}_Months_TY', cos_band[:, 0])
+        put(f'COS_Last_{label}_Months_LY', cos_band[:, 1])
+        band_pc=divide_arrays(sales_band-cos_band, sales_band)*100
+        put(f'chart_gross_margin_pc_{label}_months', band_pc[:, 0]-band_pc[:, 1])
+
+    # Overheads, Net Profit and EBITDA sections. Overheads going down is a
+    # good thing, hence the sign.
+    put_section('overheads', overheads, overheads_var, overheads_var_pc, sign=-1)
+    net_profit_months=gm_months-months('chart_overheads_month-', 13)
+    put_section('net_profit', net_profit, net_profit_var, net_profit_var_pc)
+    put_months('chart_net_profit_month-', net_profit_months)
+    put_section('ebitda', ebitda, ebitda_var, ebitda_var_pc)
+    put_months('chart_ebitda_month-', net_profit_months)
+
+    # Net Worth section.
+    put('chart_net_worth_this_month', net_worth_ty[:, 0])
+    put('chart_net_worth_this_quarter', net_worth_ty_3)
+    put('chart_net_worth_this_year', net_worth_ty_12)
+    put('chart_net_worth_this_month_vs_last_year', net_worth_var)
+    put('chart_net_worth_this_quarter_vs_last_year', net_worth_var_3)
+    put('chart_net_worth_this_year_vs_last_year', net_worth_var_12)
+    put('chart_net_worth_this_month_vs_last_year%', net_worth_var_pc)
+    put('chart_net_worth_this_quarter_vs_last_year%', net_worth_var_3_pc)
+    put('chart_net_worth_this_year_vs_last_year%', net_worth_var_12_pc)
+    put_months('chart_net_worth_month-', np.concatenate([net_worth_ty, net_worth_ly[:, :1]], axis=1))
+
+    put('chart_assets', column('chart_assets_month-0')-column('chart_assets_month-12'))
+    put('chart_liabilities', column('chart_liabilities_month-0')-column('chart_liabilities_month-12'))
+
+    # Revenue Drivers.
+    transactions_0=column('chart_total_sales_transactions-0')
+    transactions_12=column('chart_total_sales_transactions-12')
+    invoices_0=column('chart_total_sales_invoices-0')
+    invoices_12=column('chart_total_sales_invoices-12')
+    per_transaction_0=divide_arrays(revenue_months[:, 0], transactions_0)
+    per_transaction_12=divide_arrays(revenue_months[:, 12], transactions_12)
+    per_invoice_0=divide_arrays(revenue_months[:, 0], invoices_0)
+    per_invoice_12=divide_arrays(revenue_months[:, 12], invoices_12)
+    put('chart_average_value_per_transaction-0', per_transaction_0)
+    put('chart_average_value_per_transaction-12', per_transaction_12)
+    put('chart_average_value_per_invoice-0', per_invoice_0)
+    put('chart_average_value_per_invoice-12', per_invoice_12)
+    put('chart_impact_on_revenue_transaction_value', (per_transaction_0-per_transaction_12)*transactions_12)
+    put('chart_impact_on_revenue_transaction_number', per_transaction_0*(transactions_0-transactions_12))
+    put('chart_impact_on_revenue_invoice_value', (per_invoice_0-per_invoice_12)*invoices_12)
+    put('chart_impact_on_revenue_invoice_number', per_invoice_0*(invoices_0-invoices_12))
+
+    retention_rates=[]
+    for label in ['LY_vs_TY', 'PY_vs_LY']:
+        retained=column(f'Customer_Segmentation_{label}_Retained')
+        lost=column(f'Customer_Segmentation_{label}_Lost')
+        retention_rate=np.where((retained>0)&(lost>0), divide_arrays(retained, retained+lost)*100, 100.0)
+        put(f'chart_retention_rate_{label}', retention_rate)
+        retention_rates.append(retention_rate)
+
+    # Customer drivers.
+    ty_new=column('Customer_Segmentation_TY_New')
+    ty_existing=column('Customer_Segmentation_TY_Existing')
+    mean_revenue_per_customer_TY=divide_arrays(sales[:, 0, YEAR_PERIOD], column('Customer_Count_TY'))
+    put('chart_revenue_customers_acquired', mean_revenue_per_customer_TY*(ty_new-column('Customer_Segmentation_LY_vs_PY_New')))
+    put('chart_revenue_customers_retained', np.where(
+        (ty_new>0)&(ty_existing>0),
+        (retention_rates[0]/100-retention_rates[1]/100)*
+        (column('Customer_Segmentation_LY_vs_PY_New')+column('Customer_Segmentation_LY_vs_PY_Existing'))*
+        divide_arrays(transactions_0*per_transaction_0, ty_new+ty_existing),
+        0.0))
+
+    profit_months=months('chart_profit_month-', 24)
+    put('chart_num_profit_months_ty', (profit_months[:, :12]>0).sum(axis=1))
+    put('chart_num_profit_months_ly', (profit_months[:, 12:]>0).sum(axis=1))
+
+    # Multiply by -1 because!
+    put('chart_current_ratio_TY', -1*divide_arrays(column('chart_current_assets_month-0'), column('chart_current_liabilities_month-0')))
+    put('chart_current_ratio_LY', -1*divide_arrays(column('chart_current_assets_month-12'), column('chart_current_liabilities_month-12')))
+    put('chart_debtor_days_TY', -1*divide_arrays(column('chart_accounts_receivable-0'), sales[:, 0, YEAR_PERIOD])*365.0)
+    put('chart_debtor_days_LY', -1*divide_arrays(column('chart_accounts_receivable-12'), sales[:, 1, YEAR_PERIOD])*365.0)
+    put('chart_creditor_days_TY', -1*divide_arrays(column('chart_accounts_payable-0'), overheads[:, 0, YEAR_PERIOD]+cos[:, 0, YEAR_PERIOD])*365.0)
+    put('chart_creditor_days_LY', -1*divide_arrays(column('chart_accounts_payable-12'), overheads[:, 1, YEAR_PERIOD]+cos[:, 1, YEAR_PERIOD])*365.0)
+
+    for key, values in derived.items():
+        for row, value in zip(rows, values.tolist()):
+            row[key]=value
+    return client_metric_values
@@ -0,0 +1,154 @@
+import json
+import logging
+import time
+
+sp_logger = logging.getLogger("sp_logger")
+
+DEFAULT_TOP_QUERIES=10
+
+# Summed to estimate the rows a statement examined. SHOW STATUS adds a few
+# reads of its own, so small deltas are approximate.
+HANDLER_READ_STATUS="SHOW SESSION STATUS LIKE 'Handler_read%'"
+
+def new_query_profile(explain=False, rows_examined=True, explain_format=None, keep_queries=True):
+    # Query log for one collector run. Pass it as profile= to the collector;
+    # with profile=None (the default) no query is timed or counted. explain
+    # keeps the EXPLAIN rows of every statement (EXPLAIN FORMAT=explain_format
+    # when one is given), rows_examined reads the session's Handler_read
+    # counters around it. query_count counts the statements; without
+    # keep_queries that is all that is kept, which costs next to nothing.
+    return {
+        'explain': explain,
+        'explain_format': explain_format,
+        'rows_examined': rows_examined,
+        'keep_queries': keep_queries,
+        'started': time.monotonic(),
+        'query_count': 0,
+        'queries': [],
+    }
+
+def new_query_counter():
+    # A profile that only counts statements: no EXPLAIN, no Handler_read
+    # reads, so results are still streamed.
+    return new_query_profile(rows_examined=False, keep_queries=False)
+
+def read_handler_counts(cursor):
+    cursor.execute(HANDLER_READ_STATUS)
+    total=0
+    for row in cursor.fetchall():
+        value=row['Value'] if isinstance(row, dict) else row[1]
+        total+=int(value)
+    return total
+
+def run_profiled_query(
+    profile,
+    status_cursor,
+    label,
+    client_ids,
+    sql,
+    params,
+    run):
+    # run() executes the statement and returns its rows. status_cursor must be
+    # a free cursor on the same connection; it reads the Handler_read counters
+    # and runs the EXPLAIN.
+    before=read_handler_counts(status_cursor) if profile['rows_examined'] else None
+    started=time.perf_counter()
+    rows=run()
+    seconds=time.perf_counter()-started
+    after=read_handler_counts(status_cursor) if profile['rows_examined'] else None
+    plan=None
+    if profile['explain']:
+        explain_sql=f"EXPLAIN {sql}" if profile.get('explain_format') is None else f"EXPLAIN FORMAT={profile['explain_format']} {sql}"
+        status_cursor.execute(explain_sql, params)
+        plan=status_cursor.fetchall()
+    record_query(profile, label, client_ids, seconds, len(rows), None if before is None else after-before, plan)
+    return rows
+
+def needs_buffering(profile):
+    # Reading the Handler_read counters and running EXPLAIN both need the
+    # connection free, so such a profile cannot time a streamed query.
+    return profile is not None and bool(profile['explain'] or profile['rows_examined'])
+
+def record_query(
+    profile,
+    label,
+    client_ids,
+    seconds,
+    rows,
+    rows_examined=None,
+    plan=None):
+    profile['query_count']+=1
+    if not profile.get('keep_queries', True):
+        return
+    profile['queries'].append({
+        'label': label,
+        'client_ids': list(client_ids),
+        'seconds': seconds,
+        'rows': rows,
+        'rows_examined': rows_examined,
+        'plan': plan,
+    })
+
+def summarize_query_profile(profile, top=DEFAULT_TOP_QUERIES):
+    # Totals per label (a metric name for per_metric, a query block for the
+    # set based engines) and per client, with the slowest labels and
+    # statements first. Statements covering a chunk of clients are only in
+    # the per label totals.
+    queries=profile['queries']
+    metrics={}
+    clients={}
+    for query in queries:
+        metric=metrics.setdefault(query['label'], {'queries': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rows_examined': 0})
+        metric['queries']+=1
+        metric['seconds']+=query['seconds']
+        metric['max_seconds']=max(metric['max_seconds'], query['seconds'])
+        metric['rows_examined']+=query['rows_examined'] or 0
+        if len(query['client_ids'])==1:
+            client=clients.setdefault(query['client_ids'][0], {'queries': 0, 'seconds': 0.0, 'rows_examined': 0})
+            client['queries']+=1
+            client['seconds']+=query['seconds']
+            client['rows_examined']+=query['rows_examined'] or 0
+    slowest_metrics=sorted(metrics.items(), key=lambda item: item[1]['seconds'], reverse=True)[:top]
+    slowest_queries=sorted(queries, key=lambda query: query['seconds'], reverse=True)[:top]
+    return {
+        'queries': len(queries),
+        'wall_seconds': round(time.monotonic()-profile['started'], 3),
+        'query_seconds': round(sum(query['seconds'] for query in queries), 3),
+        'rows_examined': sum(query['rows_examined'] or 0 for query in queries),
+        'metrics': {
+            label: dict(metric, seconds=round(metric['seconds'], 6), max_seconds=round(metric['max_seconds'], 6))
+            for label, metric in metrics.items()
+        },
+        'clients': {
+            client_id: dict(client, seconds=round(client['seconds'], 6))
+            for client_id, client in clients.items()
+        },
+        'slowest_metrics': [
+            {'label': label, 'seconds': round(metric['seconds'], 6), 'queries': metric['queries'], 'rows_examined': metric['rows_examined']}
+            for label, metric in slowest_metrics
+        ],
+        'slowest_queries': [
+            {
+                'label': query['label'],
+                'client_ids': query['client_ids'],
+                'seconds': round(query['seconds'], 6),
+                'rows': query['rows'],
+                'rows_examined': query['rows_examined'],
+                'plan': query['plan'],
+            }
+            for query in slowest_queries
+        ],
+    }
+
+def format_slow_metrics_report(summary):
+    lines=[f"{'seconds':>10} {'queries':>8} {'examined':>12}  metric"]
+    for metric in summary['slowest_metrics']:
+        lines.append(f"{metric['seconds']:>10.3f} {metric['queries']:>8} {metric['rows_examined']:>12}  {metric['label']}")
+    return '\n'.join(lines)
+
+def log_query_profile(profile, top=DEFAULT_TOP_QUERIES):
+    # Log the run's JSON summary and its top slow metrics; returns the summary.
+    summary=summarize_query_profile(profile, top)
+    sp_logger.info("Collector query profile: %s", json.dumps(summary, default=str))
+    sp_logger.info("Collector slowest metrics:\n%s", format_slow_metrics_report(summary))
+    return summary
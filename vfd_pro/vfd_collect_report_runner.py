@@ -0,0 +1,340 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+import logging
+import os
+import signal
+import time
+
+import mysql.connector
+
+from vfd_pro.vfd_collect_report_data import (
+    ENGINE_PER_METRIC,
+    ENGINE_PREFIX_SUM,
+    close_prepared_statements,
+    get_changed_client_ids,
+    get_collection_watermarks,
+    get_derived_metrics,
+    get_derived_metrics_vectorized,
+    get_collection_marks,
+    get_metrics_from_database,
+    get_transaction_marks,
+)
+from vfd_pro.vfd_collect_report_profile import log_query_profile, new_query_counter, new_query_profile
+
+sp_logger = logging.getLogger("sp_logger")
+
+DEFAULT_WORKERS=os.cpu_count() or 1
+DEFAULT_CLIENT_TIMEOUT=600
+DEFAULT_RETRIES=2
+DEFAULT_BACKOFF=2.0
+# MySQL's error for a SELECT aborted by MAX_EXECUTION_TIME.
+ER_QUERY_TIMEOUT=3024
+
+# Per-process state, set up by init_worker() in every pool worker.
+worker_config=None
+worker_connection=None
+
+class ClientTimeout(Exception):
+    pass
+
+def init_worker(config):
+    global worker_config, worker_connection
+    worker_config=config
+    worker_connection=None
+
+def set_statement_time_limit(connection, seconds):
+    # Server side counterpart of client_time_limit(). SIGALRM only interrupts
+    # Python code: a query blocking inside MySQL would keep running after the
+    # worker gave up, and the alarm is not handled until the driver's socket
+    # read returns. MAX_EXECUTION_TIME makes the server abort any SELECT
+    # running past the client's whole time limit; other statements, such as
+    # the aggregate refresh's INSERT ... SELECT, are not covered.
+    if not seconds:
+        return
+    cursor=connection.cursor()
+    cursor.execute(f"SET SESSION MAX_EXECUTION_TIME={max(1, int(seconds*1000))}")
+    cursor.close()
+
+def get_worker_connection(timeout=None):
+    # The worker's long-lived connection, reopened if it was dropped. Keeping
+    # it lets every client reuse the per_metric prepared statements.
+    global worker_connection
+    if worker_connection is None or not worker_connection.is_connected():
+        worker_connection=mysql.connector.connect(**worker_config)
+        set_statement_time_limit(worker_connection, timeout)
+    return worker_connection
+
+def discard_worker_connection():
+    # After a failure or timeout the connection may be mid-result, so it is
+    # thrown away rather than reused.
+    global worker_connection
+    if worker_connection is not None:
+        close_prepared_statements(worker_connection)
+        try:
+            worker_connection.close()
+        except Exception:
+            pass
+    worker_connection=None
+
+def raise_client_timeout(signum, frame):
+    raise ClientTimeout()
+
+@contextmanager
+def client_time_limit(seconds):
+    # SIGALRM based, so only enforced on POSIX and in a process's main thread,
+    # which is where pool workers run the collector.
+    if not seconds or not hasattr(signal, 'SIGALRM'):
+        yield
+        return
+    previous=signal.signal(signal.SIGALRM, raise_client_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+def collect_client(
+    client_id,
+    engine=ENGINE_PER_METRIC,
+    use_account_flags=False,
+    timeout=DEFAULT_CLIENT_TIMEOUT,
+    retries=DEFAULT_RETRIES,
+    backoff=DEFAULT_BACKOFF,
+    vectorized=False,
+    profile_queries=False,
+    explain_queries=False,
+    examine_rows=True,
+    use_month_buckets=False,
+    as_of=None):
+    # Raw and derived metrics for one client on the worker's connection,
+    # retried with exponential backoff. Never raises; failures are reported in
+    # the returned result, which counts the client's statements, failed
+    # attempts included. With profile_queries it also carries their log.
+    started=time.monotonic()
+    attempts=0
+    profile=new_query_profile(explain=explain_queries, rows_examined=examine_rows) if profile_queries else new_query_counter()
+    while True:
+        attempts+=1
+        try:
+            with client_time_limit(timeout):
+                metric_values=get_metrics_from_database(
+                    worker_config,
+                    client_id,
+                    engine=engine,
+                    use_account_flags=use_account_flags,
+                    connection=get_worker_connection(timeout),
+                    profile=profile,
+                    use_month_buckets=use_month_buckets,
+                    as_of=as_of)
+                if vectorized:
+                    metric_values=get_derived_metrics_vectorized({client_id: metric_values})[client_id]
+                else:
+                    metric_values=get_derived_metrics(metric_values)
+            return {
+                'client_id': client_id,
+                'metric_values': metric_values,
+                'error': None,
+                'attempts': attempts,
+                'seconds': time.monotonic()-started,
+                'query_count': profile['query_count'],
+                'queries': profile['queries'] if profile_queries else None,
+            }
+        except Exception as e:
+            discard_worker_connection()
+            timed_out=isinstance(e, ClientTimeout) or getattr(e, 'errno', None)==ER_QUERY_TIMEOUT
+            error='timed out' if timed_out else repr(e)
+            if attempts>retries:
+                return {
+                    'client_id': client_id,
+                    'metric_values': None,
+                    'error': error,
+                    'attempts': attempts,
+                    'seconds': time.monotonic()-started,
+                    'query_count': profile['query_count'],
+                    'queries': profile['queries'] if profile_queries else None,
+                }
+            delay=backoff*2**(attempts-1)
+            sp_logger.warning("Collector client %s attempt %s failed (%s), retrying in %ss", client_id, attempts, error, delay)
+            time.sleep(delay)
+
+def worker_died_result(client_id, deaths, profile_queries):
+    return {
+        'client_id': client_id,
+        'metric_values': None,
+        'error': 'worker process died',
+        'attempts': deaths,
+        'seconds': 0.0,
+        'query_count': 0,
+        'queries': [] if profile_queries else None,
+    }
+
+def collect_in_pool(config, client_ids, workers, options):
+    # collect_client() for every client across a pool of workers, with at
+    # most one client in flight per worker. A worker that dies (killed for
+    # memory, say) breaks the whole pool: the clients that were in flight
+    # become suspects, the pool is rebuilt, and each suspect is rerun alone
+    # so a second death names the client. A client whose worker dies more
+    # than options['retries'] times is reported as failed; results already
+    # collected are kept.
+    results=[]
+    pending=deque(client_ids)
+    suspects=deque()
+    deaths={}
+    while pending or suspects:
+        broken=[]
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(config,)) as executor:
+            in_flight={}
+            while not broken and (pending or suspects or in_flight):
+                queue, limit=(suspects, 1) if suspects else (pending, workers)
+                while queue and len(in_flight)<limit:
+                    client_id=queue.popleft()
+                    try:
+                        in_flight[executor.submit(collect_client, client_id, **options)]=client_id
+                    except BrokenProcessPool:
+                        broken.append(client_id)
+                        break
+                if not in_flight:
+                    break
+                done, _=wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    client_id=in_flight.pop(future)
+                    try:
+                        results.append(future.result())
+                    except BrokenProcessPool:
+                        broken.append(client_id)
+                if broken:
+                    # Every future still in flight fails with the pool.
+                    broken+=in_flight.values()
+        if not broken:
+            continue
+        sp_logger.warning("Collector worker died with clients %s in flight, restarting the pool", broken)
+        if len(broken)>1:
+            suspects.extend(broken)
+            continue
+        client_id=broken[0]
+        deaths[client_id]=deaths.get(client_id, 0)+1
+        if deaths[client_id]>options['retries']:
+            results.append(worker_died_result(client_id, deaths[client_id], options['profile_queries']))
+        else:
+            suspects.appendleft(client_id)
+    return results
+
+def summarize_results(results, workers, wall_seconds, slowest=5):
+    seconds=[result['seconds'] for result in results]
+    failed=[result for result in results if result['error'] is not None]
+    return {
+        'clients': len(results),
+        'succeeded': len(results)-len(failed),
+        'failed': len(failed),
+        'retried': sum(1 for result in results if result['attempts']>1),
+        'workers': workers,
+        'wall_seconds': round(wall_seconds, 3),
+        'client_seconds_total': round(sum(seconds), 3),
+        'client_seconds_mean': round(sum(seconds)/len(seconds), 3) if seconds else 0.0,
+        'client_seconds_max': round(max(seconds), 3) if seconds else 0.0,
+        'clients_per_second': round(len(results)/wall_seconds, 3) if wall_seconds else 0.0,
+        'queries': sum(result['query_count'] for result in results),
+        'slowest_clients': [
+            (result['client_id'], round(result['seconds'], 3))
+            for result in sorted(results, key=lambda result: result['seconds'], reverse=True)[:slowest]
+        ],
+        'errors': {result['client_id']: result['error'] for result in failed},
+    }
+
+def run_collector(
+    config,
+    client_ids,
+    workers=DEFAULT_WORKERS,
+    engine=ENGINE_PER_METRIC,
+    use_account_flags=False,
+    timeout=DEFAULT_CLIENT_TIMEOUT,
+    retries=DEFAULT_RETRIES,
+    backoff=DEFAULT_BACKOFF,
+    incremental=False,
+    vectorized=False,
+    profile_queries=False,
+    explain_queries=False,
+    examine_rows=True,
+    use_month_buckets=False,
+    as_of=None,
+    collection_marks=None):
+    # Collect every client across a pool of worker processes, each holding its
+    # own connection. Returns ({client_id: metric_values}, summary); failed
+    # clients are left out of the metrics and listed in summary['errors'],
+    # and summary['queries'] counts the statements run.
+    # With incremental, unchanged clients are skipped and counted in
+    # summary['skipped'], and the watermarks of the clients collected are put
+    # in collection_marks for save_report_metrics() to store with their
+    # metrics. With profile_queries, every worker's query log is
+    # merged, logged and returned as summary['query_profile']. See
+    # get_metrics_for_clients() for use_month_buckets and as_of.
+    if as_of is not None and incremental:
+        raise ValueError("as_of cannot be combined with incremental")
+    client_ids=[int(client_id) for client_id in client_ids]
+    requested=len(client_ids)
+    transaction_marks={}
+    if incremental and client_ids:
+        connection=mysql.connector.connect(**config)
+        cursor=connection.cursor(dictionary=True)
+        transaction_marks=get_transaction_marks(cursor, client_ids)
+        client_ids=get_changed_client_ids(transaction_marks, get_collection_watermarks(cursor, client_ids))
+        cursor.close()
+        connection.close()
+    workers=max(1, min(workers, len(client_ids) or 1))
+    options={
+        'engine': engine,
+        'use_account_flags': use_account_flags,
+        'timeout': timeout,
+        'retries': retries,
+        'backoff': backoff,
+        'vectorized': vectorized,
+        'profile_queries': profile_queries,
+        'explain_queries': explain_queries,
+        'examine_rows': examine_rows,
+        'use_month_buckets': use_month_buckets,
+        'as_of': as_of,
+    }
+
+    started=time.monotonic()
+    profile=new_query_profile(explain=explain_queries, rows_examined=examine_rows) if profile_queries else None
+    results=[]
+    if workers==1:
+        init_worker(config)
+        try:
+            for client_id in client_ids:
+                results.append(collect_client(client_id, **options))
+        finally:
+            discard_worker_connection()
+    else:
+        results=collect_in_pool(config, client_ids, workers, options)
+    wall_seconds=time.monotonic()-started
+
+    summary=summarize_results(results, workers, wall_seconds)
+    summary['skipped']=requested-len(client_ids)
+    if profile is not None:
+        for result in results:
+            profile['queries']+=result['queries']
+        summary['query_profile']=log_query_profile(profile)
+    if incremental and collection_marks is not None:
+        succeeded_marks={
+            result['client_id']: transaction_marks[result['client_id']]
+            for result in results
+            if result['error'] is None
+        }
+        collection_marks.update(get_collection_marks(succeeded_marks, engine==ENGINE_PREFIX_SUM))
+    sp_logger.info(
+        "Collector run: %s clients, %s skipped, %s failed, %s workers, %.1fs",
+        summary['clients'],
+        summary['skipped'],
+        summary['failed'],
+        workers,
+        wall_seconds)
+    client_metric_values={
+        result['client_id']: result['metric_values']
+        for result in results
+        if result['error'] is None
+    }
+    return client_metric_values, summary
@@ -1 +1,21 @@
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.http import require_GET
 
+from vfd_pro.common.db_metrics import get_slow_calls, render_prometheus
+
+
+@staff_member_required
+@require_GET
+def db_metrics(request):
+    """Stored procedure and SQL latency histograms, Prometheus text format."""
+    return HttpResponse(
+        render_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@staff_member_required
+@require_GET
+def db_slow_calls(request):
+    """The rolling log of slow stored procedure and SQL calls, newest first."""
+    return JsonResponse({"ok": True, "calls": get_slow_calls()})